@@ -0,0 +1,296 @@
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+class AudioRingBuffer:
+    """Кольцевой буфер float32 для одного писателя и одного читателя.
+
+    write_pos меняет только писатель, read_pos - только читатель, поэтому
+    блокировки не нужны: позиция публикуется после копирования данных.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.write_pos = 0
+        self.read_pos = 0
+        self.overruns = 0
+
+    def available(self):
+        """Сколько сэмплов можно прочитать"""
+        return self.write_pos - self.read_pos
+
+    def write(self, samples):
+        """Записать блок целиком; при нехватке места блок отбрасывается"""
+        n = len(samples)
+        if n > self.capacity - self.available():
+            self.overruns += 1
+            return False
+
+        start = self.write_pos % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        if first < n:
+            self.buffer[:n - first] = samples[first:]
+        self.write_pos += n
+        return True
+
+    def read(self, out):
+        """Заполнить out, только если накоплено len(out) сэмплов"""
+        n = len(out)
+        if self.available() < n:
+            return False
+
+        start = self.read_pos % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        if first < n:
+            out[first:] = self.buffer[:n - first]
+        self.read_pos += n
+        return True
+
+    def read_some(self, out):
+        """Прочитать до len(out) сэмплов; возвращает сколько прочитано"""
+        n = min(len(out), self.available())
+        if n == 0:
+            return 0
+
+        start = self.read_pos % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        if first < n:
+            out[first:n] = self.buffer[:n - first]
+        self.read_pos += n
+        return n
+
+    def skip(self, n):
+        """Отбросить n самых старых сэмплов (вызывает читатель)"""
+        self.read_pos += min(n, self.available())
+
+class StreamingDenoiser:
+    """Потоковое шумоподавление спектральным гейтом (STFT, перекрытие 50%).
+
+    Оценка шума, сглаженная маска и хвост overlap-add сохраняются между
+    блоками, поэтому профиль шума не пересчитывается для каждого блока и
+    на стыках блоков нет артефактов. Задержка - fft_size // 2 сэмплов.
+    """
+    def __init__(self, fft_size=512, threshold=6.0, noise_rise=1.01, psd_smoothing=0.7, mask_smoothing=0.6,
+                 warmup_frames=32):
+        self.fft_size = fft_size
+        self.hop = fft_size // 2
+        # Во сколько раз мощность бина должна превышать шум, чтобы пройти гейт
+        self.threshold = threshold
+        # Рост оценки шума за кадр: минимум отслеживается с медленным подъёмом
+        self.noise_rise = noise_rise
+        self.psd_smoothing = psd_smoothing
+        self.mask_smoothing = mask_smoothing
+        # Пока оценка шума не устоялась, гейт открыт, чтобы не глушить речь
+        self.warmup_frames = warmup_frames
+
+        # sqrt-Hann для анализа и синтеза: при перекрытии 50% сумма квадратов окон равна 1
+        n = np.arange(fft_size)
+        self.window = np.sqrt(0.5 - 0.5 * np.cos(2 * np.pi * n / fft_size)).astype(np.float32)
+
+        bins = fft_size // 2 + 1
+        self.history = np.zeros(fft_size - self.hop, dtype=np.float32)
+        self.tail = np.zeros(self.hop, dtype=np.float32)
+        self.smoothed_psd = np.zeros(bins, dtype=np.float32)
+        self.noise_psd = np.zeros(bins, dtype=np.float32)
+        self.mask = np.ones(bins, dtype=np.float32)
+        self.gate = np.zeros(bins, dtype=bool)
+        self.target = np.zeros(bins, dtype=np.float32)
+        self.work = np.zeros(0, dtype=np.float32)
+        self.frames_seen = 0
+
+    def reset(self):
+        """Сбросить состояние (новый поток)"""
+        self.history.fill(0)
+        self.tail.fill(0)
+        self.mask.fill(1)
+        self.frames_seen = 0
+
+    def process(self, block, strength):
+        """Обработать блок длиной кратной hop; возвращает столько же сэмплов"""
+        hop = self.hop
+        frames_count = len(block) // hop
+        if frames_count == 0 or len(block) % hop:
+            raise ValueError(f'длина блока должна быть кратна {hop}')
+
+        # История прошлого блока + новый блок, окна с шагом hop
+        total = len(self.history) + len(block)
+        if len(self.work) < total:
+            self.work = np.zeros(total, dtype=np.float32)
+        buf = self.work[:total]
+        buf[:len(self.history)] = self.history
+        buf[len(self.history):] = block
+        self.history[:] = buf[total - len(self.history):]
+
+        frames = sliding_window_view(buf, self.fft_size)[::hop]
+        spectrum = np.fft.rfft(frames * self.window, axis=1)
+        psd = spectrum.real ** 2 + spectrum.imag ** 2
+
+        floor = 1.0 - strength
+        for i in range(frames_count):
+            frame_psd = psd[i]
+            self.frames_seen += 1
+            if self.frames_seen == 1:
+                self.smoothed_psd[:] = frame_psd
+                self.noise_psd[:] = frame_psd
+            else:
+                self.smoothed_psd *= self.psd_smoothing
+                self.smoothed_psd += (1.0 - self.psd_smoothing) * frame_psd
+                self.noise_psd *= self.noise_rise
+                np.minimum(self.noise_psd, self.smoothed_psd, out=self.noise_psd)
+            if self.frames_seen <= self.warmup_frames:
+                continue
+
+            # Бины выше порога проходят, остальные ослабляются на strength
+            np.greater(frame_psd, self.noise_psd * self.threshold, out=self.gate)
+            self.target.fill(floor)
+            self.target[self.gate] = 1.0
+            self.mask *= self.mask_smoothing
+            self.mask += (1.0 - self.mask_smoothing) * self.target
+            spectrum[i] *= self.mask
+
+        restored = np.fft.irfft(spectrum, n=self.fft_size, axis=1).astype(np.float32)
+        restored *= self.window
+
+        # Overlap-add: первая половина кадра + вторая половина предыдущего
+        out = restored[:, :hop].copy()
+        out[0] += self.tail
+        out[1:] += restored[:-1, hop:]
+        self.tail[:] = restored[-1, hop:]
+        return out.reshape(-1)
+
+class VoiceActivityDetector:
+    """Детектор речи по энергии с адаптивным порогом, hangover и pre-roll.
+
+    Окно считается речью, если RMS выше порога из настроек и в noise_ratio
+    раз выше оценки фонового шума. После речи передача продолжается ещё
+    hangover_frames окон, а preroll_frames последних тихих окон
+    отправляются перед началом речи, чтобы не обрезать начало слов.
+
+    Hangover и pre-roll нужны, только когда речь от фона отделяет оценка шума.
+    Если фон в паузах ниже порога из настроек, окно передаётся по одному
+    порогу, как у прежнего гейта, без окон вокруг речи: на чистом звуке они
+    были бы лишним трафиком.
+    """
+    def __init__(self, frame_size, hangover_frames=4, preroll_frames=2, noise_ratio=1.5, floor_rise=1.02):
+        self.hangover_frames = hangover_frames
+        self.noise_ratio = noise_ratio
+        self.floor_rise = floor_rise
+        self.noise_floor = 0.0
+        self.level = 0.0
+        self.hangover = 0
+        # Фон ниже порога из настроек: hangover и pre-roll не нужны
+        self.quiet_background = False
+        self.preroll = np.zeros((preroll_frames, frame_size), dtype=np.float32)
+        self.preroll_count = 0
+        self.preroll_pos = 0
+
+    def update(self, frame, threshold):
+        """Решение для окна: True - передавать"""
+        # dot вместо mean(frame**2) - без временного массива
+        self.level = float(np.sqrt(np.dot(frame, frame) / len(frame)))
+        if self.noise_floor == 0.0:
+            self.noise_floor = max(self.level, 1e-5)
+        else:
+            self.noise_floor = max(min(self.noise_floor * self.floor_rise, self.level), 1e-5)
+
+        if self.quiet_background:
+            if self.level > threshold:
+                return True
+        elif self.level > threshold and self.level > self.noise_floor * self.noise_ratio:
+            self.hangover = self.hangover_frames
+            return True
+        # Оценка шума растёт во время речи, поэтому фон сравнивается с порогом только в паузах
+        self.quiet_background = self.noise_floor < threshold
+        if self.hangover > 0:
+            self.hangover -= 1
+            return True
+        return False
+
+    def remember(self, frame):
+        """Сохранить тихое окно для pre-roll"""
+        if len(self.preroll) == 0:
+            return
+        self.preroll[self.preroll_pos] = frame
+        self.preroll_pos = (self.preroll_pos + 1) % len(self.preroll)
+        self.preroll_count = min(self.preroll_count + 1, len(self.preroll))
+
+    def take_preroll(self):
+        """Сохранённые окна от старых к новым (при тихом фоне - ни одного); буфер очищается"""
+        size = len(self.preroll)
+        count = 0 if self.quiet_background else self.preroll_count
+        frames = [self.preroll[(self.preroll_pos - count + i) % size] for i in range(count)]
+        self.preroll_count = 0
+        return frames
+
+# Общая таблица шума для комфортного шума на воспроизведении
+COMFORT_NOISE = np.random.default_rng(0).standard_normal(16384).astype(np.float32)
+
+class JitterBuffer:
+    """Буфер воспроизведения одного говорящего.
+
+    Писатель - поток приёма, читатель - callback воспроизведения.
+    После опустошения копит целевую задержку, при росте задержки
+    вдвое сверх целевой отбрасывает старые сэмплы.
+    """
+    def __init__(self, capacity, max_frames, volume=1.0):
+        self.ring = AudioRingBuffer(capacity)
+        self.frame = np.zeros(max_frames, dtype=np.float32)
+        self.volume = volume
+        self.prebuffering = True
+        self.underruns = 0
+        self.trims = 0
+        self.last_packet = 0.0
+        # Говорящий прислал маркер тишины: паузу заполняем комфортным шумом
+        self.silent = False
+        self.comfort_level = 0.0
+        self.noise_pos = 0
+
+    def write(self, samples):
+        """Добавить пакет говорящего"""
+        self.last_packet = time.monotonic()
+        return self.ring.write(samples)
+
+    def mark_silence(self, level):
+        """Маркер тишины (DTX): дальше пакетов не будет до начала речи"""
+        self.comfort_level = level
+        self.silent = True
+
+    def read(self, frames, target):
+        """Заполнить self.frame[:frames]; возвращает число заполненных сэмплов"""
+        out = self.frame[:frames]
+        available = self.ring.available()
+
+        if self.prebuffering:
+            if available < target:
+                return self.fill_comfort_noise(out, 0)
+            self.prebuffering = False
+            self.silent = False
+
+        if available > 2 * target + frames:
+            self.ring.skip(available - target)
+            self.trims += 1
+
+        n = self.ring.read_some(out)
+        if n < frames:
+            # Опустошение после маркера тишины - ожидаемая пауза, а не потеря
+            if not self.silent:
+                self.underruns += 1
+            self.prebuffering = True
+            return self.fill_comfort_noise(out, n)
+        return n
+
+    def fill_comfort_noise(self, out, start):
+        """Дополнить out комфортным шумом (или нулями) начиная с start"""
+        rest = out[start:]
+        if not self.silent or self.comfort_level <= 0.0:
+            rest.fill(0)
+            return start
+        count = len(rest)
+        if self.noise_pos + count > len(COMFORT_NOISE):
+            self.noise_pos = 0
+        np.multiply(COMFORT_NOISE[self.noise_pos:self.noise_pos + count], self.comfort_level, out=rest)
+        self.noise_pos += count
+        return len(out)
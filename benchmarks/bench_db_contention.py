@@ -0,0 +1,156 @@
+"""Конкуренция чтения и записи в SQLite: старая схема против WAL с пулом чтения.
+
+Старая схема - новое соединение на каждый вызов и журнал отката (DELETE):
+читатель берёт SHARED-блокировку файла, а писатель ждёт, пока все читатели
+её отпустят, и наоборот. Новая - SQLiteStorage: WAL, пул соединений только
+для чтения и единственный писатель. Потоки-читатели вызывают get_messages и
+get_friends, потоки-писатели - save_message; печатаются p50/p99 задержек,
+пропускная способность, ошибки "database is locked" и ожидание соединений
+(те же chat_db_*_wait_seconds, что собирает сервер).
+
+Запуск: python benchmarks/bench_db_contention.py [--seconds 10] [--readers 8] [--writers 2] [--rows 100000]
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+import statistics
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from storage import SQLiteStorage
+
+USERS = 200
+
+class LegacyStorage(SQLiteStorage):
+    """Поведение до пула: соединение на вызов, журнал отката"""
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.init_database()
+        conn = self.get_connection()
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.close()
+
+    @contextmanager
+    def reading(self):
+        conn = self.get_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def writing(self):
+        conn = self.get_connection()
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+class WaitMetrics:
+    """Ожидание соединений в том же виде, что в Metrics сервера"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, name, value):
+        with self.lock:
+            self.values.setdefault(name, []).append(value)
+
+def fill(db, rows):
+    """Начальная история и дружбы"""
+    conn = db.get_connection()
+    conn.executemany(
+        'INSERT INTO messages (sender, message, is_private, recipient) VALUES (?, ?, ?, ?)',
+        [(f'user{i % USERS}', f'сообщение {i}', int(i % 10 == 0), f'user{(i * 7) % USERS}' if i % 10 == 0 else None)
+         for i in range(rows)]
+    )
+    conn.executemany(
+        'INSERT OR IGNORE INTO friendships (user1, user2) VALUES (?, ?)',
+        [(f'user{i}', f'user{(i + step) % USERS}') for i in range(USERS) for step in (1, 2, 3, 5, 8)]
+    )
+    conn.commit()
+    conn.close()
+
+def worker(stop, action, latencies, errors):
+    """Вызывать action до остановки; задержки в мс"""
+    counter = 0
+    while not stop.is_set():
+        counter += 1
+        start = time.perf_counter()
+        try:
+            action(counter)
+        except sqlite3.OperationalError as e:
+            errors.append(str(e))
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+
+def run(db, seconds, readers, writers):
+    """Нагрузка на db; {'read': [...], 'write': [...], 'errors': [...]}"""
+    def read(counter):
+        username = f'user{counter % USERS}'
+        if counter % 2:
+            db.get_messages(limit=100, username=username)
+        else:
+            db.get_friends(username)
+
+    def write(counter):
+        db.save_message(f'user{counter % USERS}', f'нагрузка {counter}')
+
+    result = {'read': [], 'write': [], 'errors': []}
+    stop = threading.Event()
+    threads = [threading.Thread(target=worker, args=(stop, read, result['read'], result['errors']))
+               for _ in range(readers)]
+    threads += [threading.Thread(target=worker, args=(stop, write, result['write'], result['errors']))
+                for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return result
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0.0
+
+def report(title, result, seconds, metrics):
+    print(f'\n{title}')
+    for kind in ('read', 'write'):
+        values = result[kind]
+        print(f'  {kind:<6} {len(values) / seconds:9,.0f} оп/с   p50 {statistics.median(values) if values else 0:7.2f} мс   '
+              f'p99 {percentile(values, 0.99):8.2f} мс')
+    locked = sum('locked' in error for error in result['errors'])
+    print(f'  ошибок "database is locked": {locked}, прочих: {len(result["errors"]) - locked}')
+    for name, values in sorted(metrics.values.items()):
+        print(f'  {name}: p50 {statistics.median(values) * 1000:.3f} мс, p99 {percentile(values, 0.99) * 1000:.3f} мс')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=100_000, help='начальный размер истории')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    for title, factory in (('Соединение на вызов, журнал отката', LegacyStorage),
+                           ('WAL, пул чтения и единственный писатель', SQLiteStorage)):
+        path = os.path.join(directory, f'{factory.__name__}.db')
+        db = factory(path)
+        fill(db, args.rows)
+        db.metrics = WaitMetrics()
+        result = run(db, args.seconds, args.readers, args.writers)
+        report(title, result, args.seconds, db.metrics)
+        db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Сравнение StreamingDenoiser с поблочным noisereduce: качество (SNR) и CPU.
+
+Запуск: python benchmarks/bench_denoise.py [--seconds 10] [--snr 10]
+"""
+import os
+import sys
+import time
+import argparse
+import importlib.util
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio import StreamingDenoiser
+
+SAMPLE_RATE = 16000
+BLOCK = 512
+DSP_HOP = 1024
+
+def make_signal(seconds, snr_db, seed=0):
+    """Речеподобный сигнал (гармоники с паузами) и белый шум заданного SNR"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 8))
+    envelope = np.clip(np.sin(2 * np.pi * 0.8 * t), 0, None) ** 0.5
+    clean = (0.2 * voiced * envelope).astype(np.float32)
+
+    noise = rng.standard_normal(len(t)).astype(np.float32)
+    noise *= np.sqrt(np.mean(clean ** 2) / np.mean(noise ** 2) / 10 ** (snr_db / 10))
+    return clean, clean + noise
+
+def snr(reference, estimate):
+    return 10 * np.log10(np.sum(reference ** 2) / np.sum((reference - estimate) ** 2))
+
+def run_streaming(noisy, strength):
+    denoiser = StreamingDenoiser()
+    blocks = []
+    start = time.perf_counter()
+    for i in range(0, len(noisy) - DSP_HOP + 1, DSP_HOP):
+        blocks.append(denoiser.process(noisy[i:i + DSP_HOP], strength))
+    elapsed = time.perf_counter() - start
+    out = np.concatenate(blocks)
+    # Компенсация задержки overlap-add
+    delay = denoiser.hop
+    return out[delay:], elapsed, len(out) // BLOCK
+
+def run_noisereduce(noisy, strength, **params):
+    """Прежний путь клиента: reduce_noise на каждый блок, при ошибке блок без обработки"""
+    import noisereduce as nr
+    blocks = []
+    failures = 0
+    start = time.perf_counter()
+    for i in range(0, len(noisy) - BLOCK + 1, BLOCK):
+        block = noisy[i:i + BLOCK]
+        try:
+            block = nr.reduce_noise(
+                y=block,
+                sr=SAMPLE_RATE,
+                prop_decrease=strength,
+                stationary=True,
+                **params
+            )
+        except Exception:
+            failures += 1
+        blocks.append(block)
+    elapsed = time.perf_counter() - start
+    if failures:
+        print(f'  noisereduce: {failures} блоков завершились ошибкой и ушли без обработки')
+    out = np.concatenate(blocks)
+    return out, elapsed, len(out) // BLOCK
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--snr', type=float, default=10, help='SNR входа, дБ')
+    parser.add_argument('--strength', type=float, default=0.9)
+    args = parser.parse_args()
+
+    clean, noisy = make_signal(args.seconds, args.snr)
+    block_ms = BLOCK / SAMPLE_RATE * 1000
+    print(f'Сигнал: {args.seconds:.0f} с, блок {BLOCK} сэмплов ({block_ms:.0f} мс), SNR входа {snr(clean, noisy):.2f} дБ')
+
+    results = [('streaming', run_streaming)]
+    if importlib.util.find_spec('noisereduce') is not None:
+        results.append(('noisereduce', run_noisereduce))
+        # С параметрами по умолчанию блок короче n_fft; вариант с n_fft под размер блока
+        results.append(('nr n_fft=256', lambda noisy, strength: run_noisereduce(noisy, strength, n_fft=256)))
+    else:
+        print('noisereduce не установлен - сравнение только для streaming')
+
+    for name, runner in results:
+        out, elapsed, blocks = runner(noisy, args.strength)
+        n = len(out)
+        per_block = elapsed / blocks * 1000
+        print(f'{name:<12} SNR {snr(clean[:n], out):6.2f} дБ   {per_block:7.3f} мс/блок   '
+              f'{per_block / block_ms * 100:5.1f}% реального времени')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Пропускная способность пересылки голоса: прежний recv_exact (data += packet
+и склейка кадра) против FrameReader (recv_into в общий буфер, отправка memoryview).
+
+Один говорящий, кадры по 512 сэмплов float32, пересылка --listeners слушателям
+через socketpair. Результат - пересланных пакетов в секунду.
+
+--chunk задаёт размер кусков, которыми приходят данные: при мелких кусках
+кадр собирается из многих recv, и прежняя склейка перевыделяет буфер на каждом.
+
+Запуск: python benchmarks/bench_relay.py [--packets 20000] [--listeners 3] [--chunk 65536]
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from protocol import MAX_VOICE_FRAME, FrameReader, speaker_header
+
+PAYLOAD = 512 * 4
+
+def old_recv_exact(sock, num_bytes):
+    """Прежняя реализация ChatServer.recv_exact"""
+    data = b''
+    while len(data) < num_bytes:
+        packet = sock.recv(num_bytes - len(data))
+        if not packet:
+            return None
+        data += packet
+    return data
+
+def relay_old(source, listeners, header):
+    packets = 0
+    while True:
+        length_bytes = old_recv_exact(source, 4)
+        if not length_bytes:
+            return packets
+        length = int.from_bytes(length_bytes, 'big')
+        audio_data = old_recv_exact(source, length)
+        if not audio_data:
+            return packets
+        frame = (len(header) + length).to_bytes(4, 'big') + header + audio_data
+        for listener in listeners:
+            listener.sendall(frame)
+        packets += 1
+
+def relay_reader(source, listeners, header):
+    packets = 0
+    reader = FrameReader(source, MAX_VOICE_FRAME, prefix=header)
+    while True:
+        if reader.read() is None:
+            return packets
+        frame = reader.relay_frame()
+        for listener in listeners:
+            listener.sendall(frame)
+        packets += 1
+
+def produce(sock, packets, chunk):
+    frame = PAYLOAD.to_bytes(4, 'big') + bytes(PAYLOAD)
+    # Отправка кусками по chunk байт: границы кадров не совпадают с recv
+    data = memoryview(frame * packets)
+    for start in range(0, len(data), chunk):
+        sock.sendall(data[start:start + chunk])
+    sock.shutdown(socket.SHUT_WR)
+
+def drain(sock):
+    buffer = bytearray(1 << 16)
+    while sock.recv_into(buffer):
+        pass
+
+def run(relay, packets, listener_count, chunk):
+    source_out, source_in = socket.socketpair()
+    pairs = [socket.socketpair() for _ in range(listener_count)]
+    threads = [threading.Thread(target=drain, args=(inner,), daemon=True) for _, inner in pairs]
+    for thread in threads:
+        thread.start()
+    threading.Thread(target=produce, args=(source_out, packets, chunk), daemon=True).start()
+
+    start = time.perf_counter()
+    relayed = relay(source_in, [outer for outer, _ in pairs], speaker_header('speaker'))
+    elapsed = time.perf_counter() - start
+
+    for outer, _ in pairs:
+        outer.close()
+    for thread in threads:
+        thread.join()
+    source_in.close()
+    source_out.close()
+    return relayed, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--listeners', type=int, default=3)
+    parser.add_argument('--chunk', type=int, default=65536, help='размер кусков входящего потока, байт')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{args.packets} пакетов по {PAYLOAD} байт, {args.listeners} слушателя, куски по {args.chunk} байт')
+    for name, relay in (('recv_exact', relay_old), ('FrameReader', relay_reader)):
+        best = min(run(relay, args.packets, args.listeners, args.chunk)[1] for _ in range(args.repeat))
+        print(f'{name:<12} {args.packets / best:9.0f} пакетов/с  {best / args.packets * 1e6:6.1f} мкс/пакет')
+
+if __name__ == '__main__':
+    main()
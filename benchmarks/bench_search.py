@@ -0,0 +1,134 @@
+"""Задержка полнотекстового поиска (FTS5) по истории против LIKE-скана.
+
+База заполняется --rows сообщениями через ChatDatabase (триггеры FTS
+срабатывают на каждую вставку), 5% сообщений - ЛС. Слова берутся из
+словаря с распределением Ципфа, поэтому есть редкие, средние и частые
+термины. Для каждого термина - первая и глубокая (через before) страница.
+
+Запуск: python benchmarks/bench_search.py [--rows 1000000] [--queries 50] [--db путь]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from storage import ChatDatabase
+
+VOCABULARY = 50000
+USERS = 1000
+BATCH = 10000
+
+def word(rank):
+    return f'w{rank}'
+
+WORDS = [word(rank) for rank in range(VOCABULARY)]
+ZIPF = 1 / np.arange(1, VOCABULARY + 1)
+ZIPF /= ZIPF.sum()
+
+def generate(count, rng):
+    """Пачка сообщений: слова по Ципфу, 5% - ЛС"""
+    lengths = rng.integers(3, 16, size=count)
+    ranks = rng.choice(VOCABULARY, size=int(lengths.sum()), p=ZIPF)
+    senders = rng.integers(USERS, size=count)
+    private = rng.random(count) < 0.05
+    recipients = rng.integers(USERS, size=count)
+    batch = []
+    position = 0
+    for i in range(count):
+        text = ' '.join(WORDS[rank] for rank in ranks[position:position + lengths[i]])
+        position += lengths[i]
+        if private[i]:
+            batch.append((f'user{senders[i]}', text, 1, f'user{recipients[i]}'))
+        else:
+            batch.append((f'user{senders[i]}', text, 0, None))
+    return batch
+
+def fill(db, rows, seed=0):
+    """Заполнить messages; возвращает сообщений в секунду (только вставка с индексом)"""
+    rng = np.random.default_rng(seed)
+    conn = db.get_connection()
+    elapsed = 0.0
+    for offset in range(0, rows, BATCH):
+        batch = generate(min(BATCH, rows - offset), rng)
+        start = time.perf_counter()
+        conn.executemany('INSERT INTO messages (sender, message, is_private, recipient) VALUES (?, ?, ?, ?)', batch)
+        conn.commit()
+        elapsed += time.perf_counter() - start
+        print(f'\r  заполнено {offset + len(batch)}/{rows}', end='', flush=True)
+    conn.close()
+    print()
+    return rows / elapsed
+
+def percentiles(values):
+    values = sorted(values)
+    return statistics.median(values), values[int(len(values) * 0.95) - 1] if len(values) >= 20 else values[-1]
+
+def run_queries(db, terms, queries, rng):
+    """Первая и глубокая страница; задержки в мс"""
+    first, deep = [], []
+    for _ in range(queries):
+        term = rng.choice(terms)
+        username = f'user{rng.randrange(USERS)}'
+        start = time.perf_counter()
+        page = db.search_messages(username, term, limit=20)
+        first.append((time.perf_counter() - start) * 1000)
+        if len(page) == 20:
+            # Пять страниц вглубь
+            before = page[-1]['id']
+            for _ in range(4):
+                page = db.search_messages(username, term, before_id=before, limit=20) or page
+                before = page[-1]['id']
+            start = time.perf_counter()
+            db.search_messages(username, term, before_id=before, limit=20)
+            deep.append((time.perf_counter() - start) * 1000)
+    return first, deep
+
+def like_scan(db, term, username):
+    """Наивный поиск без индекса, для сравнения"""
+    conn = db.get_connection()
+    start = time.perf_counter()
+    conn.execute('''SELECT id FROM messages WHERE message LIKE ? AND (is_private = 0 OR recipient = ? OR sender = ?)
+        ORDER BY id DESC LIMIT 20''', (f'% {term} %', username, username)).fetchall()
+    conn.close()
+    return (time.perf_counter() - start) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=50, help='запросов на группу терминов')
+    parser.add_argument('--db', help='готовая база (иначе временная с --rows сообщениями)')
+    args = parser.parse_args()
+
+    if args.db:
+        db = ChatDatabase(args.db)
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'bench_search.db')
+        db = ChatDatabase(path)
+        print(f'Заполнение {args.rows} сообщений...')
+        rate = fill(db, args.rows)
+        print(f'Вставка с триггерами FTS: {rate:,.0f} сообщений/с')
+
+    rng = random.Random(1)
+    groups = (
+        ('частые (ранг 1-10)', [word(rank) for rank in range(10)]),
+        ('средние (ранг 100-1000)', [word(rank) for rank in range(100, 1000)]),
+        ('редкие (ранг 20000+)', [word(rank) for rank in range(20000, VOCABULARY)]),
+        ('два слова', [f'{word(rng.randrange(10))} {word(rng.randrange(100, 1000))}' for _ in range(100)]),
+    )
+    print(f'\n{"термины":<26} {"первая стр. p50/p95":>22} {"6-я стр. p50/p95":>20}')
+    for title, terms in groups:
+        first, deep = run_queries(db, terms, args.queries, rng)
+        line = f'{title:<26} {"%.2f / %.2f мс" % percentiles(first):>22}'
+        line += f' {"%.2f / %.2f мс" % percentiles(deep):>20}' if deep else f' {"-":>20}'
+        print(line)
+
+    print(f'\nLIKE-скан без индекса: частый термин {like_scan(db, word(0), "user1"):.1f} мс, '
+          f'редкий {like_scan(db, word(VOCABULARY - 1), "user1"):.1f} мс')
+
+if __name__ == '__main__':
+    main()
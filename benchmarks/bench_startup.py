@@ -0,0 +1,144 @@
+"""Время запуска клиента: импорт client.py, показ ChatWindow и открытие кэша.
+
+Каждый замер - отдельный процесс (холодный импорт). Отчёт -X importtime
+показывает самые дорогие модули; если при старте загрузились голосовые
+зависимости (numpy, sounddevice), бенчмарк завершается с кодом 1.
+
+Если установлен cryptography, после показа окна открывается заранее
+заполненный локальный кэш (--cache-rows строк): замеряется, сколько
+open_cache держит поток интерфейса и когда переписка появляется в окне.
+Вывод ключа (PBKDF2) идёт в фоне; больше CACHE_GUI_BUDGET_MS в потоке
+интерфейса - регрессия, код 1.
+
+Запуск: python benchmarks/bench_startup.py [--runs 5] [--top 15] [--offscreen]
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from message_cache import MessageCache, cache_available, cache_path
+
+# Модули, которые должны грузиться только при включении голоса
+VOICE_MODULES = ('numpy', 'sounddevice', 'voice', 'audio')
+
+# Сколько open_cache может занимать поток интерфейса
+CACHE_GUI_BUDGET_MS = 20
+
+# Аккаунт заранее заполненного кэша
+CACHE_ACCOUNT = ('127.0.0.1', 5555, 'bench', 'bench-password')
+
+# Замер в дочернем процессе; окно входа не показывается
+STARTUP_SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+import client
+imported = time.perf_counter()
+from PySide6.QtWidgets import QApplication
+app = QApplication(sys.argv)
+client.ChatWindow.show_login_dialog = lambda self: None
+window = client.ChatWindow()
+window.show()
+app.processEvents()
+shown = time.perf_counter()
+voice = [name for name in %r if name in sys.modules]
+result = {'import': imported - start, 'window': shown - imported, 'voice': voice}
+if client.cache_available():
+    started = time.perf_counter()
+    window.open_cache(*%r)
+    result['cache_gui'] = time.perf_counter() - started
+    while window.cache is None and time.perf_counter() - started < 10:
+        app.processEvents()
+        time.sleep(0.001)
+    result['cache_ready'] = time.perf_counter() - started
+    result['cache_rows'] = len(window.chat_display.chat_model)
+print(json.dumps(result))
+''' % (VOICE_MODULES, CACHE_ACCOUNT)
+
+def child_env(offscreen, cache_dir=None):
+    env = dict(os.environ)
+    if offscreen:
+        env['QT_QPA_PLATFORM'] = 'offscreen'
+    if cache_dir:
+        env['PYMESSENGER_CACHE_DIR'] = cache_dir
+    return env
+
+def fill_cache(rows):
+    """Каталог с кэшем CACHE_ACCOUNT на rows строк общего чата"""
+    directory = tempfile.mkdtemp()
+    host, port, username, password = CACHE_ACCOUNT
+    cache = MessageCache(cache_path(host, port, username, directory), password)
+    cache.open()
+    cache.store([(None, {'kind': 'message', 'username': f'user{i % 20}', 'text': f'сообщение {i}',
+                         'timestamp': '2026-01-01 12:00:00', 'id': i}) for i in range(1, rows + 1)])
+    cache.close()
+    return directory
+
+def measure_startup(offscreen, cache_dir=None):
+    """Один холодный запуск: секунды импорта, показа окна и открытия кэша, загруженные голосовые модули"""
+    result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=ROOT, env=child_env(offscreen, cache_dir),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def import_report(offscreen):
+    """Разбор -X importtime: {модуль: (собственное, суммарное время в мкс)}"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import client'], cwd=ROOT,
+                            env=child_env(offscreen), capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(own), int(cumulative))
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='сколько модулей показать в отчёте импорта')
+    parser.add_argument('--offscreen', action='store_true', help='Qt без дисплея (QT_QPA_PLATFORM=offscreen)')
+    parser.add_argument('--cache-rows', type=int, default=500, help='строк в заранее заполненном кэше')
+    args = parser.parse_args()
+
+    cache_dir = fill_cache(args.cache_rows) if cache_available() else None
+    runs = [measure_startup(args.offscreen, cache_dir) for _ in range(args.runs)]
+    for key, title in (('import', 'импорт client'), ('window', 'показ окна')):
+        values = [run[key] * 1000 for run in runs]
+        print(f'{title:<14} медиана {statistics.median(values):7.1f} мс   мин {min(values):7.1f} мс')
+    total = [(run['import'] + run['window']) * 1000 for run in runs]
+    print(f'{"всего":<14} медиана {statistics.median(total):7.1f} мс')
+
+    slow_cache = False
+    if cache_dir:
+        gui = [run['cache_gui'] * 1000 for run in runs]
+        ready = [run['cache_ready'] * 1000 for run in runs]
+        print(f'\nКэш на {args.cache_rows} строк (показано {runs[0]["cache_rows"]}):')
+        print(f'  open_cache в потоке интерфейса  медиана {statistics.median(gui):7.1f} мс   макс {max(gui):7.1f} мс')
+        print(f'  переписка в окне через          медиана {statistics.median(ready):7.1f} мс')
+        slow_cache = max(gui) > CACHE_GUI_BUDGET_MS
+    else:
+        print('\nКэш не замерялся: нет пакета cryptography')
+
+    modules = import_report(args.offscreen)
+    print(f'\nСамые дорогие импорты (суммарно, из {len(modules)} модулей):')
+    top_level = {name: times for name, times in modules.items() if '.' not in name}
+    for name, (own, cumulative) in sorted(top_level.items(), key=lambda item: -item[1][1])[:args.top]:
+        print(f'  {name:<28} {cumulative / 1000:8.1f} мс   (собственное {own / 1000:.1f} мс)')
+
+    loaded = sorted(set(runs[0]['voice']) | {name for name in VOICE_MODULES if name in modules})
+    if loaded:
+        print(f'\nРЕГРЕССИЯ: при старте загружены голосовые модули: {", ".join(loaded)}')
+    else:
+        print('\nГолосовые модули при старте не загружаются')
+    if slow_cache:
+        print(f'РЕГРЕССИЯ: open_cache держит поток интерфейса дольше {CACHE_GUI_BUDGET_MS} мс')
+    if loaded or slow_cache:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""Нагрузка индикаторов набора: много пишущих пользователей одновременно.
+
+Сервер (MemoryStorage) запускается в этом процессе, --users клиентов
+подключаются по TCP, --typers из них печатают: половина в общем чате,
+половина в ЛС случайному собеседнику. Режим keystroke - кадр typing на
+каждое нажатие (--keys в секунду, худший клиент), throttled - как
+client.py, не чаще раза в TYPING_SEND_INTERVAL. Сравнивается с наивной
+пересылкой каждого события всем через broadcast: принятые сервером
+события × (users - 1) кадров.
+
+Запуск: python benchmarks/bench_typing.py [--users 300] [--typers 100] [--seconds 10] [--keys 8]
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import selectors
+import threading
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chat_logging import setup_logging
+from protocol import SEPARATOR
+from storage import MemoryStorage
+import server
+
+# Как в client.py; клиент не импортируется, чтобы не тянуть Qt
+TYPING_SEND_INTERVAL = 3
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server():
+    """Сервер в фоновом потоке; flush_typing замеряется в мс"""
+    os.chdir(tempfile.mkdtemp())
+    port = free_port()
+    # Клиенты бенчмарка не шлют ping: таймаут heartbeat не должен их отключать
+    chat = server.ChatServer(host='127.0.0.1', port=port, voice_port=free_port(), storage=MemoryStorage(),
+                             heartbeat_timeout=3600)
+    flushes = []
+    flush = chat.flush_typing
+
+    def timed_flush():
+        start = time.perf_counter()
+        flush()
+        flushes.append((time.perf_counter() - start) * 1000)
+
+    chat.flush_typing = timed_flush
+    threading.Thread(target=chat.start, daemon=True).start()
+    time.sleep(0.3)
+    return chat, port, flushes
+
+class Receiver:
+    """Один поток читает все клиентские сокеты и считает кадры typing"""
+    def __init__(self, sockets):
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        for sock in sockets:
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+            self.buffers[sock] = b''
+        self.frames = 0
+        self.bytes = 0
+        self.counting = False
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    data = key.fileobj.recv(65536)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    self.selector.unregister(key.fileobj)
+                    continue
+                buffer = self.buffers[key.fileobj] + data
+                *frames, self.buffers[key.fileobj] = buffer.split(SEPARATOR)
+                if self.counting:
+                    for frame in frames:
+                        if b'"type": "typing"' in frame:
+                            self.frames += 1
+                            self.bytes += len(frame) + len(SEPARATOR)
+
+def connect(port, users):
+    sockets = []
+    for i in range(users):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(json.dumps({'type': 'register', 'username': f'user{i}', 'password': 'bench'}).encode() + SEPARATOR)
+        sockets.append(sock)
+    time.sleep(1 + users / 500)
+    return sockets
+
+def type_keys(sockets, typers, seconds, keys, throttled, rng):
+    """Нажатия клавиш у typers пользователей; возвращает отправленных кадров typing"""
+    targets = [None if rng.random() < 0.5 else f'user{rng.randrange(len(sockets))}' for _ in range(typers)]
+    last_sent = [-TYPING_SEND_INTERVAL] * typers
+    sent = 0
+    interval = 1 / keys
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        tick = time.monotonic()
+        for i in range(typers):
+            if throttled and tick - last_sent[i] < TYPING_SEND_INTERVAL:
+                continue
+            last_sent[i] = tick
+            frame = json.dumps({'type': 'typing', 'to': targets[i]}).encode() + SEPARATOR
+            try:
+                sockets[i].sendall(frame)
+                sent += 1
+            except BlockingIOError:
+                pass
+        time.sleep(max(0.0, interval - (time.monotonic() - tick)))
+    return sent
+
+def accepted_typing(chat):
+    frames = chat.metrics.counters.get('chat_frames_in_total', {}).get((('type', 'typing'),), 0)
+    limited = chat.metrics.counters.get('chat_rate_limited_total', {}).get((('type', 'typing'),), 0)
+    return frames - limited
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--typers', type=int, default=100)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--keys', type=float, default=8, help='нажатий в секунду у каждого пишущего')
+    args = parser.parse_args()
+    setup_logging(level='WARNING')
+
+    chat, port, flushes = start_server()
+    sockets = connect(port, args.users)
+    receiver = Receiver(sockets)
+    threading.Thread(target=receiver.run, daemon=True).start()
+    time.sleep(0.5)
+    rng = random.Random(1)
+
+    print(f'{args.users} пользователей, {args.typers} печатают, {args.keys:g} нажатий/с, {args.seconds:g} с')
+    for mode, throttled in (('keystroke', False), ('throttled', True)):
+        # Корзины лимитера наполняются заново, как после паузы
+        chat.rate_limiter.buckets.clear()
+        accepted_before = accepted_typing(chat)
+        flushes.clear()
+        receiver.frames = receiver.bytes = 0
+        receiver.counting = True
+        sent = type_keys(sockets, args.typers, args.seconds, args.keys, throttled, rng)
+        time.sleep(server.TYPING_TICK * 2)
+        receiver.counting = False
+        accepted = accepted_typing(chat) - accepted_before
+        naive = accepted * (args.users - 1)
+
+        print(f'\n{mode}')
+        print(f'  отправлено клиентами  {sent / args.seconds:10,.0f} кадров/с')
+        print(f'  принято сервером      {accepted / args.seconds:10,.0f} событий/с (остальное отсёк лимит)')
+        print(f'  доставлено typing     {receiver.frames / args.seconds:10,.0f} кадров/с, '
+              f'{receiver.bytes / args.seconds / 1024:,.1f} КиБ/с')
+        print(f'  наивный broadcast     {naive / args.seconds:10,.0f} кадров/с '
+              f'(в {naive / max(receiver.frames, 1):.1f} раза больше)')
+        if flushes:
+            flushes.sort()
+            print(f'  flush_typing за тик   p50 {statistics.median(flushes):.2f} мс, '
+                  f'p99 {flushes[int(len(flushes) * 0.99) - 1 if len(flushes) >= 100 else -1]:.2f} мс, '
+                  f'тиков {len(flushes)}')
+
+    receiver.stopped = True
+    for sock in sockets:
+        sock.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Трафик голоса: прежний RMS-гейт против VAD с hangover, pre-roll и DTX.
+
+Сигнал - реплики 0.5-2 с с паузами, участник говорит долю времени --activity
+(в звонке на N человек каждый говорит примерно 1/N времени). Потерянная речь -
+доля энергии чистой речи в окнах, которые не были отправлены (обрезанные слоги).
+
+Кроме заданного SNR всегда проверяются два случая (CHECKS): на чистом звуке
+VAD+DTX не должен слать больше гейта и терять больше речи, на шумном - должен
+слать как минимум вдвое меньше без заметных потерь речи. Иначе код выхода 1.
+
+Запуск: python benchmarks/bench_vad.py [--seconds 60] [--snr 20] [--speakers 4]
+"""
+import os
+import sys
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from audio import VoiceActivityDetector
+from protocol import SILENCE_FRAME_SIZE
+
+SAMPLE_RATE = 16000
+DSP_HOP = 1024
+BLOCK = 512
+HEADER = 4
+
+# Проверки - звонок на 4 участника при пороге по умолчанию из настроек клиента:
+# (название, SNR дБ, макс. трафик VAD к гейту, макс. прирост потерянной речи)
+CHECK_THRESHOLD = 0.02
+CHECK_ACTIVITY = 0.25
+CHECKS = (
+    ('чистый звук', 40, 1.01, 0.0001),
+    ('шумный звук', 10, 0.5, 0.001),
+)
+
+def make_conversation(seconds, snr_db, activity, seed=0):
+    """Реплики со слоговой огибающей, паузы между ними и белый шум"""
+    rng = np.random.default_rng(seed)
+    total = int(seconds * SAMPLE_RATE)
+    envelope = np.zeros(total, dtype=np.float32)
+    pos = int(rng.uniform(0.2, 1.0) * SAMPLE_RATE)
+    while pos < total:
+        talk = int(rng.uniform(0.5, 2.0) * SAMPLE_RATE)
+        n = min(talk, total - pos)
+        t = np.arange(n) / SAMPLE_RATE
+        envelope[pos:pos + n] = np.abs(np.sin(np.pi * 4 * t + rng.uniform(0, np.pi))) ** 0.7
+        pause = rng.exponential(1.25 * (1 - activity) / activity)
+        pos += talk + int(pause * SAMPLE_RATE)
+
+    t = np.arange(total) / SAMPLE_RATE
+    phase = 2 * np.pi * np.cumsum(140 + 30 * np.sin(2 * np.pi * 0.7 * t)) / SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 8))
+    clean = (0.2 * voiced * envelope).astype(np.float32)
+
+    speech_power = np.mean(clean[envelope > 0] ** 2)
+    noise = rng.standard_normal(total).astype(np.float32)
+    noise *= np.sqrt(speech_power / 10 ** (snr_db / 10))
+    return clean, clean + noise
+
+def frames(signal):
+    for i in range(0, len(signal) - DSP_HOP + 1, DSP_HOP):
+        yield signal[i:i + DSP_HOP]
+
+def run_gate(signal, threshold):
+    """Прежний путь: каждое окно с RMS выше порога уходит целиком"""
+    sent = []
+    for frame in frames(signal):
+        sent.append(np.sqrt(np.dot(frame, frame) / len(frame)) > threshold)
+    packets = sum(sent) * (DSP_HOP // BLOCK)
+    return packets, packets * (HEADER + BLOCK * 4), sent
+
+def run_vad(signal, threshold):
+    """VAD: pre-roll перед речью, hangover после, один маркер тишины на паузу"""
+    vad = VoiceActivityDetector(DSP_HOP)
+    transmitting = False
+    packets = 0
+    data_bytes = 0
+    sent = []
+    for frame in frames(signal):
+        if vad.update(frame, threshold):
+            preroll = 0
+            if not transmitting:
+                transmitting = True
+                preroll = len(vad.take_preroll())
+                sent[len(sent) - preroll:] = [True] * preroll
+            sent.append(True)
+            packets += (preroll + 1) * (DSP_HOP // BLOCK)
+            data_bytes += (preroll + 1) * (DSP_HOP // BLOCK) * (HEADER + BLOCK * 4)
+        else:
+            if transmitting:
+                transmitting = False
+                packets += 1
+                data_bytes += HEADER + SILENCE_FRAME_SIZE
+            vad.remember(frame)
+            sent.append(False)
+    return packets, data_bytes, sent
+
+def lost_speech(clean, sent):
+    """Доля энергии речи в неотправленных окнах"""
+    energy = np.array([np.dot(frame, frame) for frame in frames(clean)])
+    return energy[~np.array(sent)].sum() / energy.sum()
+
+def compare(seconds, snr, threshold, activity):
+    """Гейт и VAD на одном сигнале: {имя: (пакеты, байты, потеряно речи)}"""
+    clean, noisy = make_conversation(seconds, snr, activity)
+    result = {}
+    for name, runner in (('rms-гейт', run_gate), ('vad+dtx', run_vad)):
+        packets, data_bytes, sent = runner(noisy, threshold)
+        result[name] = (packets, data_bytes, lost_speech(clean, sent))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--snr', type=float, default=20, help='SNR входа, дБ')
+    parser.add_argument('--threshold', type=float, default=0.02)
+    parser.add_argument('--speakers', type=int, default=4, help='участников звонка')
+    parser.add_argument('--activity', type=float, default=None, help='доля времени речи (по умолчанию 1/speakers)')
+    args = parser.parse_args()
+
+    activity = args.activity or 1 / args.speakers
+    listeners = args.speakers - 1
+    print(f'Сигнал: {args.seconds:.0f} с, речь {activity:.0%} времени, SNR {args.snr:.0f} дБ, '
+          f'порог {args.threshold}, {args.speakers} участника')
+
+    for name, (packets, data_bytes, lost) in compare(args.seconds, args.snr, args.threshold, activity).items():
+        rate = data_bytes * 8 / args.seconds / 1000
+        # Каждый участник отправляет свой поток, сервер пересылает его остальным
+        relayed = packets * listeners * args.speakers / args.seconds
+        print(f'{name:<9} {rate:7.1f} кбит/с на отправителя  {relayed:6.0f} пересылок/с на сервере  '
+              f'потеряно речи {lost:6.2%}')
+
+    print(f'\nПроверки (порог {CHECK_THRESHOLD}, речь {CHECK_ACTIVITY:.0%} времени):')
+    failed = False
+    for title, snr, max_ratio, max_extra_loss in CHECKS:
+        result = compare(args.seconds, snr, CHECK_THRESHOLD, CHECK_ACTIVITY)
+        _, gate_bytes, gate_lost = result['rms-гейт']
+        _, vad_bytes, vad_lost = result['vad+dtx']
+        ok = vad_bytes <= gate_bytes * max_ratio and vad_lost <= gate_lost + max_extra_loss
+        failed = failed or not ok
+        print(f'  {title:<12} SNR {snr:2} дБ  трафик VAD/гейт {vad_bytes / gate_bytes:5.2f} (не больше {max_ratio})  '
+              f'потеряно речи {vad_lost:6.2%} против {gate_lost:6.2%}  {"OK" if ok else "РЕГРЕССИЯ"}')
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
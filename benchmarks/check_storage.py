@@ -0,0 +1,217 @@
+"""Проверка хранилищ на соответствие интерфейсу ChatStorage.
+
+Один сценарий (регистрация, сообщения, история, поиск, дружба, запросы в
+друзья, отложенные события) выполняется на SQLiteStorage - эталоне - и на
+проверяемых хранилищах; результаты должны совпасть. MemoryStorage проверяется
+всегда, PostgreSQL - если передан адрес пустой базы.
+
+Без сервера PostgresStorage проверяется на поддельных соединениях psycopg2:
+open_storage('postgresql://...'), разделение чтения и записи при read_dsn и
+закрытие соединения пула после ошибки запроса.
+
+Запуск: python benchmarks/check_storage.py [--postgres postgresql://...]
+"""
+import os
+import sys
+import time
+import types
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import storage
+from storage import ChatStorage, SQLiteStorage, MemoryStorage, PostgresStorage, open_storage
+
+# Колонки, которые возвращают все хранилища; is_private и recipient в страницах истории SQLite нет
+ROW_KEYS = {'id', 'sender', 'message', 'timestamp'}
+
+def texts(rows):
+    return [(row['sender'], row['message']) for row in rows]
+
+def scenario(db):
+    """Вызовы всех методов интерфейса; {шаг: результат}"""
+    out = {}
+    out['register'] = db.register_user('alice', 'secret')
+    out['register_taken'] = db.register_user('alice', 'other')
+    db.register_user('bob', 'secret')
+    out['verify'] = (db.verify_user('alice', 'secret'), db.verify_user('alice', 'other'), db.verify_user('carol', 'x'))
+
+    ids = [db.save_message('alice', f'привет мир {i}') for i in range(5)]
+    ids.append(db.save_message('alice', 'секретный привет', True, 'bob'))
+    ids.append(db.save_message('bob', 'чужой привет', True, 'carol'))
+    out['ids'] = ids == sorted(ids) and len(set(ids)) == len(ids)
+
+    out['messages'] = texts(db.get_messages(limit=3, username='alice'))
+    out['messages_after'] = texts(db.get_messages(limit=10, username='carol', after_id=ids[3]))
+    out['history'] = texts(db.get_history('alice', before_id=ids[2], limit=5))
+    out['history_peer'] = texts(db.get_history('alice', 'bob'))
+    out['history_hidden'] = texts(db.get_history('alice', 'carol'))
+    row = db.get_messages(limit=1)[0]
+    out['row'] = (ROW_KEYS <= set(row.keys()), len(row['timestamp']))
+
+    if db.search_enabled:
+        out['search'] = texts(db.search_messages('alice', 'Привет', limit=3))
+        out['search_peer'] = texts(db.search_messages('alice', 'привет', peer='bob'))
+        out['search_hidden'] = texts(db.search_messages('alice', 'чужой'))
+
+    out['friendship'] = (db.add_friendship('alice', 'bob'), db.add_friendship('bob', 'alice'))
+    out['friends'] = (db.get_friends('alice'), db.get_friends('bob'), db.get_friends('carol'))
+
+    expires = time.time() + 60
+    out['friend_request'] = (db.add_friend_request('alice', 'bob', expires), db.add_friend_request('alice', 'bob', expires),
+                             db.add_friend_request('alice', 'carol', expires))
+    db.add_friend_request('bob', 'alice', time.time() - 1)
+    out['friend_requests'] = (db.get_friend_requests('bob'), db.get_friend_requests('alice'))
+    out['remove_request'] = (db.remove_friend_request('alice', 'bob'), db.remove_friend_request('alice', 'bob'),
+                             db.remove_friend_request('bob', 'alice'))
+
+    db.queue_offline('bob', {'type': 'friend_request', 'from': 'alice'})
+    db.queue_offline('bob', {'type': 'system', 'message': 'x'})
+    out['offline'] = (db.take_offline('bob'), db.take_offline('bob'))
+    return out
+
+def check(name, db, expected):
+    """Сравнить результаты db с эталоном; число расхождений"""
+    missing = [attr for attr, value in vars(ChatStorage).items()
+               if callable(value) and getattr(type(db), attr) is value and attr not in ('observe', 'hash_password', 'close')]
+    if missing:
+        print(f'{name}: не реализованы {", ".join(missing)}')
+        return len(missing)
+    failures = 0
+    got = scenario(db)
+    # Поиск проверяется только там, где он есть у обоих
+    for step, want in expected.items():
+        if step in got and got[step] != want:
+            failures += 1
+            print(f'{name}: шаг {step}: {got[step]!r} вместо {want!r}')
+    db.close()
+    print(f'{name}: {"OK" if not failures else f"расхождений {failures}"}')
+    return failures
+
+class FakeError(Exception):
+    """Ошибка драйвера поддельного соединения"""
+
+class FakeConnection:
+    """Соединение psycopg2 без сервера: запоминает запросы и отвечает заготовками"""
+    def __init__(self, dsn, queries, **options):
+        self.dsn = dsn
+        self.options = options
+        self.queries = queries
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+        self.row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=()):
+        verb = sql.split()[0].upper()
+        self.conn.queries.append((self.conn.dsn, verb))
+        if 'missing_table' in sql:
+            raise FakeError('relation "missing_table" does not exist')
+        self.rowcount = 1
+        self.row = {'id': 1} if 'RETURNING id' in sql else None
+
+    def fetchone(self):
+        return self.row
+
+    def fetchall(self):
+        return []
+
+def check_postgres_offline():
+    """PostgresStorage на поддельных соединениях; число расхождений"""
+    failures = 0
+
+    def expect(what, ok):
+        nonlocal failures
+        if not ok:
+            failures += 1
+            print(f'PostgresStorage без сервера: {what}')
+
+    opened = []
+    queries = []
+
+    def connect(dsn, **options):
+        conn = FakeConnection(dsn, queries, **options)
+        opened.append(conn)
+        return conn
+
+    # open_storage со стандартной фабрикой: psycopg2 подменён модулем-заглушкой
+    fake_psycopg2 = types.SimpleNamespace(connect=connect, extras=types.SimpleNamespace(RealDictCursor=dict))
+    real_psycopg2, storage.psycopg2 = storage.psycopg2, fake_psycopg2
+    try:
+        db = open_storage('postgresql://chat@db/chat')
+    finally:
+        storage.psycopg2 = real_psycopg2
+    expect('open_storage вернул не PostgresStorage', isinstance(db, PostgresStorage))
+    expect('соединение открыто не по адресу из open_storage',
+           [conn.dsn for conn in opened] == ['postgresql://chat@db/chat'])
+    expect('соединение без RealDictCursor', opened[0].options.get('cursor_factory') is dict)
+    db.close()
+
+    # Чтение - с реплики, запись и запросы в друзья - в основную базу
+    opened.clear()
+    db = PostgresStorage('primary', pool_size=2, connect=connect, read_dsn='replica')
+    queries.clear()
+    db.verify_user('alice', 'secret')
+    db.get_friends('alice')
+    db.save_message('alice', 'привет')
+    db.get_friend_requests('alice')
+    expect(f'маршрутизация запросов {queries}',
+           queries == [('replica', 'SELECT'), ('replica', 'SELECT'), ('primary', 'INSERT'), ('primary', 'SELECT')])
+
+    # Соединение после ошибки закрывается и не возвращается в пул
+    primary = lambda: [conn for conn in opened if conn.dsn == 'primary']
+    try:
+        db.execute('SELECT * FROM missing_table')
+        expect('ошибка запроса не дошла до вызывающего', False)
+    except FakeError:
+        pass
+    expect('соединение после ошибки не закрыто', len(primary()) == 1 and primary()[0].closed
+           and db.pool.idle.qsize() == 0)
+    db.save_message('alice', 'после ошибки')
+    db.save_message('alice', 'ещё раз')
+    expect('после ошибки не открыто одно новое соединение', len(primary()) == 2 and not primary()[1].closed
+           and db.pool.idle.qsize() == 1)
+    db.close()
+    expect('close не закрыл соединения пулов', all(conn.closed for conn in opened))
+
+    print(f'PostgresStorage без сервера: {"OK" if not failures else f"расхождений {failures}"}')
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--postgres', help='адрес пустой базы PostgreSQL')
+    args = parser.parse_args()
+
+    reference = SQLiteStorage(os.path.join(tempfile.mkdtemp(), 'reference.db'))
+    expected = scenario(reference)
+    reference.close()
+
+    failures = check('MemoryStorage', MemoryStorage(), expected)
+    failures += check_postgres_offline()
+    if args.postgres:
+        failures += check('PostgresStorage', open_storage(args.postgres), expected)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
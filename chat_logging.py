@@ -0,0 +1,128 @@
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import itertools
+import os
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Поля LogRecord, которые не попадают в структурированный вывод
+RESERVED_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """Форматирование записей в одну строку JSON"""
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RESERVED_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Человекочитаемый формат: [СОБЫТИЕ] сообщение"""
+    def format(self, record):
+        line = f'{self.formatTime(record, "%H:%M:%S")} {record.levelname:<7} {record.getMessage()}'
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю запись высокочастотных событий (поле event)"""
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)  # {event: N}
+        self.counters = {event: itertools.count() for event in self.rates}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        every = self.rates.get(event)
+        if not every or every <= 1:
+            return True
+        # next() у itertools.count атомарен под GIL
+        return next(self.counters[event]) % every == 0
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler, который никогда не блокирует вызывающий поток"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # В вызывающем потоке только подставляем аргументы,
+        # JSON и время форматирует поток-слушатель
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class StructuredLoggingHandle:
+    """Результат setup_logging: слушатель очереди и обработчик"""
+    def __init__(self, listener, handler):
+        self.listener = listener
+        self.handler = handler
+
+    def stop(self):
+        """Дописать оставшиеся записи и остановить поток-слушатель"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+_handle = None
+
+def setup_logging(level=None, fmt=None, sample_rates=None, queue_size=10000, stream=None):
+    """Неблокирующее логирование: QueueHandler в вызывающих потоках,
+    запись в stream из отдельного потока QueueListener.
+
+    level и fmt ('json' или 'text') по умолчанию берутся из переменных
+    окружения PYMESSENGER_LOG_LEVEL и PYMESSENGER_LOG_FORMAT.
+    """
+    global _handle
+    if _handle is not None:
+        return _handle
+
+    level = level or os.environ.get('PYMESSENGER_LOG_LEVEL', 'INFO')
+    fmt = fmt or os.environ.get('PYMESSENGER_LOG_FORMAT', 'json')
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    handler = DroppingQueueHandler(log_queue)
+    if sample_rates:
+        handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger('pymessenger')
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.addHandler(handler)
+    root.propagate = False
+
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+
+    _handle = StructuredLoggingHandle(listener, handler)
+    atexit.register(_handle.stop)
+    return _handle
+
+def get_logger(name):
+    """Логгер в иерархии pymessenger"""
+    return logging.getLogger(f'pymessenger.{name}')
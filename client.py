@@ -1,19 +1,25 @@
 import sys
+import bisect
+from collections import deque
 import socket
 import threading
 import json
-import numpy as np
-import sounddevice as sd
-import queue
-import noisereduce as nr
+import time
+import random
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
-                               QHBoxLayout, QTextEdit, QLineEdit, QPushButton, 
+                               QHBoxLayout, QLineEdit, QPushButton, 
                                QListWidget, QLabel, QDialog, QDialogButtonBox,
                                QSlider, QCheckBox, QTabWidget, QListWidgetItem,
                                QGroupBox, QComboBox, QMessageBox, QMenu, QStatusBar,
-                               QSplitter, QRadioButton, QButtonGroup)
-from PySide6.QtCore import Qt, Signal, QObject, QTimer, QPropertyAnimation, QEasingCurve
-from PySide6.QtGui import QFont, QTextCursor, QAction, QColor, QPalette
+                               QSplitter, QRadioButton, QButtonGroup, QInputDialog, QAbstractScrollArea)
+from PySide6.QtCore import Qt, Signal, QObject, QTimer, QPropertyAnimation, QEasingCurve, QRect
+from PySide6.QtGui import QFont, QAction, QColor, QPalette, QPainter, QFontMetrics
+from chat_logging import setup_logging, get_logger
+from protocol import (SEPARATOR, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, RECONNECT_MIN_DELAY,
+                      RECONNECT_MAX_DELAY, enable_keepalive, DEFAULT_VOICE_CHANNEL, MAX_VOICE_CHANNEL_LENGTH)
+from message_cache import MessageCache, cache_available, cache_path
+
+log = get_logger('client')
 
 # Темы приложения
 THEMES = {
@@ -126,18 +132,350 @@ THEMES = {
 
 class Communicator(QObject):
     """Сигналы для обновления UI из потоков"""
-    message_received = Signal(dict)
+    # Есть принятые кадры в ChatWindow.pending_messages
+    messages_ready = Signal()
     connected = Signal()
     disconnected = Signal()
     friend_request = Signal(str)
     connection_error = Signal(str)
+    # Итог установки TCP-соединения в фоновом потоке: сокет или текст ошибки
+    socket_opened = Signal(object, bool, bool)
+    connect_failed = Signal(str, bool)
+    # Локальный кэш открыт в фоновом потоке: MessageCache и {собеседник: строки}
+    cache_loaded = Signal(object, object)
+
+# Кадры из сети применяются к UI пачками не чаще раза в UI_FLUSH_INTERVAL_MS
+UI_FLUSH_INTERVAL_MS = 16
+MAX_FRAMES_PER_FLUSH = 1000
+
+# Сколько строк чата держать в памяти на вкладку и размер страницы истории
+CHAT_HISTORY_LIMIT = 2000
+HISTORY_PAGE_SIZE = 50
+
+# Индикатор набора: отправляется не чаще раза в TYPING_SEND_INTERVAL секунд,
+# чужой индикатор гаснет через TYPING_DISPLAY_TIMEOUT без обновления
+TYPING_SEND_INTERVAL = 3
+TYPING_DISPLAY_TIMEOUT = 6
+
+# Голосовой модуль (numpy, sounddevice) грузится в фоне через столько мс после входа
+VOICE_WARMUP_DELAY_MS = 2000
+
+def import_voice():
+    """Ленивый импорт голосового модуля; None, если numpy, sounddevice или PortAudio недоступны"""
+    try:
+        import voice
+    except (ImportError, OSError) as e:
+        log.warning('[ГОЛОС] Модуль голоса недоступен: %s', e, extra={'event': 'voice_unavailable'})
+        return None
+    return voice
+
+# Цвета строк чата по виду: (акцент, выравнивание)
+CHAT_ROW_STYLES = {
+    'own': ('#2196F3', Qt.AlignLeft),
+    'message': ('#4CAF50', Qt.AlignLeft),
+    'incoming': ('#2196F3', Qt.AlignLeft),
+    'outgoing': ('#4CAF50', Qt.AlignRight),
+    'system': ('#FF9800', Qt.AlignHCenter),
+}
+
+class ChatLogModel:
+    """Строки чата с ограничением по количеству и их вертикальные позиции.
+
+    Строка - dict: kind, username, text, timestamp, id (id есть у сообщений
+    с сервера и нужен для подгрузки более старой истории). tops[i] - верх
+    строки i, отсчитанный от верха самой первой строки за всё время, поэтому
+    добавление в конец не пересчитывает остальные строки. При добавлении
+    сверх max_rows старые строки отбрасываются пачкой, при подгрузке старой
+    истории - самые новые (newest_complete становится False).
+    """
+    def __init__(self, max_rows=CHAT_HISTORY_LIMIT):
+        self.rows = []
+        self.heights = []
+        self.tops = []
+        self.bottom = 0
+        self.max_rows = max_rows
+        self.trim_batch = max(1, max_rows // 10)
+        self.history_complete = False
+        # В конце лежат самые новые строки, ничего после них не отброшено
+        self.newest_complete = True
+
+    def __len__(self):
+        return len(self.rows)
+
+    def total_height(self):
+        return self.bottom - self.tops[0] if self.rows else 0
+
+    def row_top(self, i):
+        """Верх строки относительно первой хранимой строки"""
+        return self.tops[i] - self.tops[0]
+
+    def append(self, row, height):
+        """Добавить строку в конец; возвращает, сколько строк отброшено сверху"""
+        self.rows.append(row)
+        self.heights.append(height)
+        self.tops.append(self.bottom)
+        self.bottom += height
+
+        excess = len(self.rows) - self.max_rows
+        if excess < self.trim_batch:
+            return 0
+        del self.rows[:excess]
+        del self.heights[:excess]
+        del self.tops[:excess]
+        self.history_complete = False
+        return excess
+
+    def prepend(self, rows, heights):
+        """Вставить страницу более старой истории в начало; возвращает, сколько
+        самых новых строк отброшено снизу сверх max_rows"""
+        self.rows[:0] = rows
+        self.heights[:0] = heights
+        excess = len(self.rows) - self.max_rows
+        if excess > 0:
+            del self.rows[-excess:]
+            del self.heights[-excess:]
+            self.newest_complete = False
+        self.relayout(self.heights)
+        return max(0, excess)
+
+    def relayout(self, heights):
+        """Пересчитать позиции по новым высотам (смена ширины, вставка сверху)"""
+        self.heights = list(heights)
+        self.tops = []
+        top = 0
+        for height in self.heights:
+            self.tops.append(top)
+            top += height
+        self.bottom = top
+
+    def row_at(self, y):
+        """Индекс строки, на которую приходится y"""
+        return max(0, bisect.bisect_right(self.tops, y + (self.tops[0] if self.rows else 0)) - 1)
+
+    def oldest_id(self):
+        """id самой старой строки с сервера"""
+        for row in self.rows:
+            if row.get('id') is not None:
+                return row['id']
+        return None
+
+    def can_load_older(self):
+        """Есть ли смысл запрашивать следующую страницу истории"""
+        return not self.history_complete
+
+    def clear(self):
+        self.rows = []
+        self.heights = []
+        self.tops = []
+        self.bottom = 0
+        self.history_complete = False
+        self.newest_complete = True
+
+class ChatRowPainter:
+    """Раскладка и отрисовка строки чата: пузырь с именем, временем и текстом"""
+    MARGIN = 4
+    PADDING = 8
+
+    def __init__(self):
+        self.body_font = QFont('Arial', 10)
+        self.name_font = QFont('Arial', 10, QFont.Bold)
+        self.time_font = QFont('Arial', 8)
+        self.system_font = QFont('Arial', 9)
+        self.system_font.setItalic(True)
+        self.body_metrics = QFontMetrics(self.body_font)
+        self.name_metrics = QFontMetrics(self.name_font)
+        self.system_metrics = QFontMetrics(self.system_font)
+
+    def text_width(self, width):
+        return max(50, width - 2 * (self.MARGIN + self.PADDING))
+
+    def header_height(self, row):
+        return 0 if row['kind'] == 'system' else self.name_metrics.height()
+
+    def row_text(self, row):
+        return f'⚙️ {row["text"]}' if row['kind'] == 'system' else row['text']
+
+    def height(self, row, width):
+        """Высота строки при ширине области width"""
+        metrics = self.system_metrics if row['kind'] == 'system' else self.body_metrics
+        body = metrics.boundingRect(0, 0, self.text_width(width), 100000, Qt.TextWordWrap, self.row_text(row))
+        return self.header_height(row) + body.height() + 2 * (self.MARGIN + self.PADDING)
+
+    def paint(self, painter, rect, row, text_color):
+        color, align = CHAT_ROW_STYLES[row['kind']]
+        accent = QColor(color)
+
+        rect = rect.adjusted(self.MARGIN, self.MARGIN, -self.MARGIN, -self.MARGIN)
+        background = QColor(accent)
+        background.setAlpha(26)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(background)
+        painter.drawRoundedRect(rect, 8, 8)
+
+        inner = rect.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING)
+        if row['kind'] == 'system':
+            painter.setFont(self.system_font)
+            painter.setPen(accent)
+            painter.drawText(inner, align | Qt.TextWordWrap, self.row_text(row))
+            return
+
+        header = self.header_height(row)
+        header_rect = inner.adjusted(0, 0, 0, header - inner.height())
+        painter.setFont(self.name_font)
+        painter.setPen(accent)
+        name = row['username']
+        painter.drawText(header_rect, align | Qt.AlignVCenter, name)
+        if row.get('timestamp') and align == Qt.AlignLeft:
+            offset = self.name_metrics.horizontalAdvance(name + ' ')
+            painter.setFont(self.time_font)
+            painter.setPen(QColor('#999'))
+            painter.drawText(header_rect.adjusted(offset, 0, 0, 0), Qt.AlignLeft | Qt.AlignVCenter,
+                             f'[{row["timestamp"]}]')
+        painter.setFont(self.body_font)
+        painter.setPen(text_color)
+        painter.drawText(inner.adjusted(0, header, 0, 0), align | Qt.TextWordWrap, row['text'])
+
+class ChatView(QAbstractScrollArea):
+    """Лента чата: рисуются только видимые строки, история ограничена.
+
+    Добавление строки раскладывает только её саму, поэтому стоимость не
+    зависит от длины сессии. Прокрутка к началу запрашивает следующую
+    страницу истории (load_older), прокрутка к концу после того, как новые
+    строки были отброшены, - возврат к последней странице (load_newer).
+    """
+    load_older = Signal()
+    load_newer = Signal()
+
+    def __init__(self, max_rows=CHAT_HISTORY_LIMIT):
+        super().__init__()
+        self.setObjectName('chatLog')
+        self.chat_model = ChatLogModel(max_rows)
+        self.row_painter = ChatRowPainter()
+        self.layout_width = 0
+        self.loading_older = False
+        self.loading_newer = False
+        # Пачка строк: прокрутка и перерисовка один раз в end_batch
+        self.batching = False
+        self.batch_keep_bottom = False
+        self.batch_removed = 0
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.verticalScrollBar().setSingleStep(20)
+
+    def at_bottom(self):
+        scroll_bar = self.verticalScrollBar()
+        return scroll_bar.value() >= scroll_bar.maximum() - 4
+
+    def update_scroll_range(self, keep_bottom):
+        scroll_bar = self.verticalScrollBar()
+        viewport_height = self.viewport().height()
+        scroll_bar.setPageStep(viewport_height)
+        scroll_bar.setRange(0, max(0, self.chat_model.total_height() - viewport_height))
+        if keep_bottom:
+            scroll_bar.setValue(scroll_bar.maximum())
+        self.viewport().update()
+
+    def append_row(self, row):
+        """Добавить строку; прокрутка вниз, только если пользователь уже внизу"""
+        if not self.batching:
+            self.begin_batch()
+            self.append_row(row)
+            self.end_batch()
+            return
+        # Хвост отброшен: строка придёт вместе с последней страницей по load_newer
+        if not self.chat_model.newest_complete:
+            return
+        old_total = self.chat_model.total_height()
+        self.chat_model.append(row, self.row_painter.height(row, self.viewport().width()))
+        # Отброшенные сверху строки не должны сдвигать видимую область
+        self.batch_removed += old_total + self.chat_model.heights[-1] - self.chat_model.total_height()
+
+    def begin_batch(self):
+        """Начать пачку добавлений"""
+        self.batching = True
+        self.batch_keep_bottom = self.at_bottom()
+        self.batch_removed = 0
+
+    def end_batch(self):
+        """Закончить пачку: одно обновление прокрутки и перерисовка"""
+        if not self.batching:
+            return
+        self.batching = False
+        if self.batch_keep_bottom:
+            self.update_scroll_range(True)
+        else:
+            scroll_bar = self.verticalScrollBar()
+            value = scroll_bar.value()
+            self.update_scroll_range(False)
+            scroll_bar.setValue(value - self.batch_removed)
+
+    def prepend_rows(self, rows, complete):
+        """Вставить страницу старой истории, сохранив видимую позицию"""
+        self.loading_older = False
+        self.chat_model.history_complete = complete
+        if not rows:
+            return
+        width = self.viewport().width()
+        heights = [self.row_painter.height(row, width) for row in rows]
+        self.chat_model.prepend(rows, heights)
+        self.update_scroll_range(False)
+        self.verticalScrollBar().setValue(self.verticalScrollBar().value() + sum(heights))
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        width = self.viewport().width()
+        keep_bottom = self.at_bottom()
+        if width != self.layout_width:
+            # Перенос строк зависит от ширины - пересчитываем высоты
+            self.layout_width = width
+            self.chat_model.relayout(self.row_painter.height(row, width) for row in self.chat_model.rows)
+        self.update_scroll_range(keep_bottom)
+
+    def scrollContentsBy(self, dx, dy):
+        self.viewport().update()
+        scroll_bar = self.verticalScrollBar()
+        if scroll_bar.value() == scroll_bar.minimum() and scroll_bar.maximum() > 0 and not self.loading_older \
+                and self.chat_model.can_load_older():
+            self.loading_older = True
+            self.load_older.emit()
+        elif scroll_bar.value() == scroll_bar.maximum() and not self.chat_model.newest_complete \
+                and not self.loading_newer:
+            self.loading_newer = True
+            self.load_newer.emit()
+
+    def paintEvent(self, event):
+        model = self.chat_model
+        if not model.rows:
+            return
+        painter = QPainter(self.viewport())
+        painter.setRenderHint(QPainter.Antialiasing)
+        text_color = self.palette().color(QPalette.Text)
+        offset = self.verticalScrollBar().value()
+        width = self.viewport().width()
+        bottom = offset + self.viewport().height()
+
+        # Только видимые строки: первая находится бинарным поиском
+        i = model.row_at(offset)
+        while i < len(model.rows):
+            top = model.row_top(i)
+            if top >= bottom:
+                break
+            rect = QRect(0, top - offset, width, model.heights[i])
+            self.row_painter.paint(painter, rect, model.rows[i], text_color)
+            i += 1
+        painter.end()
+
+    def clear(self):
+        self.loading_older = False
+        self.loading_newer = False
+        self.chat_model.clear()
+        self.update_scroll_range(True)
 
 class SettingsDialog(QDialog):
     """Диалог настроек"""
     def __init__(self, parent=None, current_settings=None):
         super().__init__(parent)
         self.setWindowTitle('⚙️ Настройки')
-        self.setFixedSize(550, 500)
+        self.setFixedSize(550, 560)
         
         self.settings = current_settings or {
             'noise_reduction': True,
@@ -146,6 +484,7 @@ class SettingsDialog(QDialog):
             'voice_gate_threshold': 0.01,
             'input_gain': 1.0,
             'output_volume': 1.0,
+            'playback_latency_ms': 80,
             'theme': 'Светлая'
         }
         
@@ -245,6 +584,24 @@ class SettingsDialog(QDialog):
         output_volume_layout.addWidget(self.output_volume_label)
         volume_layout.addLayout(output_volume_layout)
         
+        latency_layout = QHBoxLayout()
+        latency_layout.addWidget(QLabel('Буфер:'))
+        self.latency_slider = QSlider(Qt.Horizontal)
+        self.latency_slider.setRange(20, 300)
+        self.latency_slider.setValue(int(self.settings['playback_latency_ms']))
+        self.latency_label = QLabel(f"{int(self.settings['playback_latency_ms'])} мс")
+        self.latency_slider.valueChanged.connect(
+            lambda v: self.latency_label.setText(f"{v} мс")
+        )
+        latency_layout.addWidget(self.latency_slider)
+        latency_layout.addWidget(self.latency_label)
+        volume_layout.addLayout(latency_layout)
+        
+        latency_hint = QLabel('💡 Увеличьте если голос прерывается, уменьшите для меньшей задержки')
+        latency_hint.setStyleSheet('color: gray; font-size: 9px;')
+        latency_hint.setWordWrap(True)
+        volume_layout.addWidget(latency_hint)
+        
         volume_group.setLayout(volume_layout)
         audio_layout.addWidget(volume_group)
         
@@ -319,6 +676,7 @@ class SettingsDialog(QDialog):
             'voice_gate_threshold': self.gate_threshold_slider.value() / 1000.0,
             'input_gain': self.input_gain_slider.value() / 100.0,
             'output_volume': self.output_volume_slider.value() / 100.0,
+            'playback_latency_ms': self.latency_slider.value(),
             'theme': self.theme_combo.currentText()
         }
 
@@ -603,238 +961,6 @@ class LoginDialog(QDialog):
             self.is_login
         )
 
-class VoiceChat:
-    """Голосовой чат с обработкой аудио"""
-    def __init__(self, host, port, username, settings):
-        self.host = host
-        self.port = port
-        self.username = username
-        self.voice_socket = None
-        self.is_active = False
-        self.settings = settings
-        
-        # Параметры аудио
-        self.sample_rate = 16000
-        self.channels = 1
-        self.blocksize = 512
-        
-        # Очереди
-        self.audio_send_queue = queue.Queue(maxsize=10)
-        self.audio_play_queue = queue.Queue(maxsize=20)
-        
-    def start(self):
-        """Запуск голосового чата"""
-        try:
-            self.voice_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.voice_socket.connect((self.host, self.port))
-            
-            join_message = json.dumps({
-                'type': 'voice_join',
-                'username': self.username
-            })
-            self.voice_socket.send(join_message.encode('utf-8'))
-            
-            self.is_active = True
-            
-            threading.Thread(target=self.send_audio_worker, daemon=True).start()
-            threading.Thread(target=self.receive_audio, daemon=True).start()
-            
-            self.input_stream = sd.InputStream(
-                samplerate=self.sample_rate,
-                channels=self.channels,
-                dtype='float32',
-                callback=self.input_callback,
-                blocksize=self.blocksize
-            )
-            
-            self.output_stream = sd.OutputStream(
-                samplerate=self.sample_rate,
-                channels=self.channels,
-                dtype='float32',
-                callback=self.output_callback,
-                blocksize=self.blocksize
-            )
-            
-            self.input_stream.start()
-            self.output_stream.start()
-            
-            print('[ГОЛОС] Подключено')
-            return True
-        except Exception as e:
-            print(f'[ОШИБКА ГОЛОСА] {e}')
-            return False
-    
-    def apply_gain(self, audio, gain):
-        """Применить усиление"""
-        return np.clip(audio * gain, -1.0, 1.0)
-    
-    def apply_noise_reduction(self, audio):
-        """Применить шумоподавление"""
-        if not self.settings['noise_reduction']:
-            return audio
-        
-        try:
-            reduced = nr.reduce_noise(
-                y=audio,
-                sr=self.sample_rate,
-                prop_decrease=self.settings['noise_reduction_strength'],
-                stationary=True
-            )
-            return reduced
-        except:
-            return audio
-    
-    def is_above_threshold(self, audio_data):
-        """Проверка превышения порога"""
-        if not self.settings['voice_gate_enabled']:
-            return True
-        
-        rms = np.sqrt(np.mean(audio_data**2))
-        return rms > self.settings['voice_gate_threshold']
-    
-    def input_callback(self, indata, frames, time, status):
-        """Callback для захвата аудио"""
-        if status:
-            print(f'[АУДИО ВХОД] {status}')
-        
-        try:
-            audio_1d = indata.flatten()
-            
-            # Применяем усиление
-            audio_1d = self.apply_gain(audio_1d, self.settings['input_gain'])
-            
-            # Применяем шумоподавление
-            audio_1d = self.apply_noise_reduction(audio_1d)
-            
-            # Проверяем порог
-            if self.is_above_threshold(audio_1d):
-                self.audio_send_queue.put_nowait(audio_1d.copy())
-        except queue.Full:
-            pass
-        except Exception as e:
-            pass
-    
-    def output_callback(self, outdata, frames, time, status):
-        """Callback для воспроизведения"""
-        if status:
-            print(f'[АУДИО ВЫХОД] {status}')
-        
-        try:
-            data = self.audio_play_queue.get_nowait()
-            
-            # Применяем громкость
-            data = self.apply_gain(data, self.settings['output_volume'])
-            
-            if len(data) < frames:
-                padded = np.zeros(frames, dtype='float32')
-                padded[:len(data)] = data
-                outdata[:] = padded.reshape(-1, 1)
-            else:
-                outdata[:] = data[:frames].reshape(-1, 1)
-                
-        except queue.Empty:
-            outdata.fill(0)
-    
-    def send_audio_worker(self):
-        """Отправка аудио"""
-        while self.is_active:
-            try:
-                audio_data = self.audio_send_queue.get(timeout=0.1)
-                audio_bytes = audio_data.tobytes()
-                length = len(audio_bytes).to_bytes(4, 'big')
-                self.voice_socket.sendall(length + audio_bytes)
-            except queue.Empty:
-                continue
-            except Exception as e:
-                if self.is_active:
-                    print(f'[ОШИБКА ОТПРАВКИ] {e}')
-                break
-    
-    def receive_audio(self):
-        """Получение аудио"""
-        while self.is_active:
-            try:
-                length_bytes = self.recv_exact(4)
-                if not length_bytes:
-                    break
-                    
-                length = int.from_bytes(length_bytes, 'big')
-                audio_data = self.recv_exact(length)
-                if not audio_data:
-                    break
-                
-                audio_array = np.frombuffer(audio_data, dtype='float32')
-                
-                try:
-                    self.audio_play_queue.put_nowait(audio_array)
-                except queue.Full:
-                    try:
-                        self.audio_play_queue.get_nowait()
-                        self.audio_play_queue.put_nowait(audio_array)
-                    except:
-                        pass
-                
-            except Exception as e:
-                if self.is_active:
-                    print(f'[ОШИБКА ПОЛУЧЕНИЯ] {e}')
-                break
-    
-    def recv_exact(self, num_bytes):
-        """Получить точное количество байт"""
-        data = b''
-        while len(data) < num_bytes:
-            try:
-                packet = self.voice_socket.recv(num_bytes - len(data))
-                if not packet:
-                    return None
-                data += packet
-            except:
-                return None
-        return data
-    
-    def update_settings(self, settings):
-        """Обновить настройки на лету"""
-        self.settings = settings
-    
-    def stop(self):
-        """Остановка"""
-        self.is_active = False
-        
-        if hasattr(self, 'input_stream') and self.input_stream:
-            try:
-                self.input_stream.stop()
-                self.input_stream.close()
-            except:
-                pass
-            
-        if hasattr(self, 'output_stream') and self.output_stream:
-            try:
-                self.output_stream.stop()
-                self.output_stream.close()
-            except:
-                pass
-            
-        if self.voice_socket:
-            try:
-                self.voice_socket.shutdown(socket.SHUT_RDWR)
-                self.voice_socket.close()
-            except:
-                pass
-                
-        while not self.audio_send_queue.empty():
-            try:
-                self.audio_send_queue.get_nowait()
-            except:
-                pass
-                
-        while not self.audio_play_queue.empty():
-            try:
-                self.audio_play_queue.get_nowait()
-            except:
-                pass
-                
-        print('[ГОЛОС] Отключено')
-
 class ChatWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -845,8 +971,42 @@ class ChatWindow(QMainWindow):
         self.username = None
         self.voice_chat = None
         self.friends = []
+        self.friends_online = set()
+        # Ожидающие ответа запросы в друзья (пришли, пока мы были не в сети)
+        self.friend_requests = []
         self.private_chats = {}
         self.is_connected = False
+        self.is_connecting = False
+        self.is_closing = False
+        
+        # Heartbeat и переподключение
+        self.password = None
+        self.last_received = 0.0
+        self.reconnect_delay = RECONNECT_MIN_DELAY
+        self.voice_was_active = False
+        
+        # Громкость отдельных говорящих сохраняется между сеансами голоса
+        self.speaker_volumes = {}
+        self.voice_channels = {}  # {канал: [участники]}
+        self.voice_token = None  # выдаётся сервером после входа
+        self.voice_warmup_started = False
+        
+        # Индикаторы набора: свои - время последней отправки, чужие - до какого момента показывать
+        self.typing_sent = {}  # {собеседник или None: monotonic}
+        self.typing_users = {}  # {собеседник или None: {имя: monotonic}}
+        
+        # Список онлайн запрашивается страницами (who_online)
+        self.who_online_loading = False
+        self.who_online_complete = True
+        
+        # Вкладка результатов поиска и текущий запрос
+        self.search_display = None
+        self.search_query = None
+        
+        # Локальный кэш переписки: показывается сразу, с сервера - только дельта
+        self.cache = None
+        self.cache_pending = []
+        self.last_message_id = None
         
         self.settings = {
             'noise_reduction': True,
@@ -855,13 +1015,38 @@ class ChatWindow(QMainWindow):
             'voice_gate_threshold': 0.02,
             'input_gain': 1.0,
             'output_volume': 1.0,
+            'playback_latency_ms': 80,
             'theme': 'Светлая'
         }
         
         self.communicator = Communicator()
-        self.communicator.message_received.connect(self.handle_message)
-        self.communicator.friend_request.connect(self.handle_friend_request)
+        self.communicator.messages_ready.connect(self.schedule_flush)
+        # Очередью: модальный вопрос открывается после пачки кадров, а не внутри flush_messages
+        self.communicator.friend_request.connect(self.handle_friend_request, Qt.QueuedConnection)
         self.communicator.connection_error.connect(self.handle_connection_error)
+        self.communicator.socket_opened.connect(self.on_socket_opened)
+        self.communicator.connect_failed.connect(self.on_connect_failed)
+        self.communicator.cache_loaded.connect(self.on_cache_loaded)
+        
+        self.heartbeat_timer = QTimer(self)
+        self.heartbeat_timer.setInterval(HEARTBEAT_INTERVAL * 1000)
+        self.heartbeat_timer.timeout.connect(self.send_heartbeat)
+        
+        # Кадры от потока приёма копятся здесь и применяются пачкой по таймеру
+        self.pending_messages = deque()
+        self.flush_scheduled = False
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(UI_FLUSH_INTERVAL_MS)
+        self.flush_timer.timeout.connect(self.flush_messages)
+        
+        self.typing_timer = QTimer(self)
+        self.typing_timer.setInterval(1000)
+        self.typing_timer.timeout.connect(self.update_typing_label)
+        
+        self.speakers_timer = QTimer(self)
+        self.speakers_timer.setInterval(200)
+        self.speakers_timer.timeout.connect(self.update_speakers_label)
         
         self.init_ui()
         self.show_login_dialog()
@@ -883,7 +1068,7 @@ class ChatWindow(QMainWindow):
                 background-color: {theme['bg']};
                 color: {theme['fg']};
             }}
-            QTextEdit {{
+            #chatLog {{
                 background-color: {theme['chat_bg']};
                 color: {theme['fg']};
                 border: 1px solid {theme['border']};
@@ -1016,6 +1201,13 @@ class ChatWindow(QMainWindow):
         chat_layout = QVBoxLayout()
         chat_layout.setSpacing(10)
         
+        # Поиск по истории: результаты открываются во вкладке
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText('🔍 Поиск по истории...')
+        self.search_input.setMaxLength(200)
+        self.search_input.returnPressed.connect(self.start_search)
+        chat_layout.addWidget(self.search_input)
+        
         # Вкладки чатов
         self.chat_tabs = QTabWidget()
         self.chat_tabs.setTabsClosable(True)
@@ -1025,9 +1217,9 @@ class ChatWindow(QMainWindow):
         main_chat_widget = QWidget()
         main_chat_layout = QVBoxLayout()
         
-        self.chat_display = QTextEdit()
-        self.chat_display.setReadOnly(True)
-        self.chat_display.setFont(QFont('Arial', 10))
+        self.chat_display = ChatView()
+        self.chat_display.load_older.connect(lambda: self.request_history(None))
+        self.chat_display.load_newer.connect(lambda: self.reload_latest(None))
         
         main_chat_layout.addWidget(self.chat_display)
         main_chat_widget.setLayout(main_chat_layout)
@@ -1035,6 +1227,13 @@ class ChatWindow(QMainWindow):
         self.chat_tabs.addTab(main_chat_widget, '💬 Общий чат')
         
         chat_layout.addWidget(self.chat_tabs)
+        self.chat_tabs.currentChanged.connect(lambda index: self.update_typing_label())
+        
+        # Кто печатает в открытом разговоре
+        self.typing_label = QLabel('')
+        self.typing_label.setFont(QFont('Arial', 9))
+        self.typing_label.hide()
+        chat_layout.addWidget(self.typing_label)
         
         # Кнопки управления
         voice_layout = QHBoxLayout()
@@ -1049,10 +1248,27 @@ class ChatWindow(QMainWindow):
         self.settings_button.setFixedHeight(45)
         self.settings_button.setFixedWidth(130)
         
+        # Голосовой канал: выбор из существующих или ввод нового
+        self.channel_combo = QComboBox()
+        self.channel_combo.setEditable(True)
+        self.channel_combo.addItem(DEFAULT_VOICE_CHANNEL)
+        self.channel_combo.lineEdit().setMaxLength(MAX_VOICE_CHANNEL_LENGTH)
+        self.channel_combo.setFixedHeight(45)
+        self.channel_combo.setFixedWidth(150)
+        self.channel_combo.setToolTip('Голосовой канал')
+        self.channel_combo.activated.connect(self.change_voice_channel)
+        
         voice_layout.addWidget(self.voice_button)
+        voice_layout.addWidget(self.channel_combo)
         voice_layout.addWidget(self.settings_button)
         chat_layout.addLayout(voice_layout)
         
+        # Кто сейчас говорит в голосовом чате
+        self.speakers_label = QLabel('')
+        self.speakers_label.setFont(QFont('Arial', 10))
+        self.speakers_label.hide()
+        chat_layout.addWidget(self.speakers_label)
+        
         # Панель ввода
         input_layout = QHBoxLayout()
         input_layout.setSpacing(10)
@@ -1061,6 +1277,7 @@ class ChatWindow(QMainWindow):
         self.message_input.setPlaceholderText('Введите сообщение...')
         self.message_input.setFont(QFont('Arial', 11))
         self.message_input.returnPressed.connect(self.send_message)
+        self.message_input.textChanged.connect(self.on_input_changed)
         self.message_input.setFixedHeight(45)
         
         self.send_button = QPushButton('📤 Отправить')
@@ -1092,6 +1309,7 @@ class ChatWindow(QMainWindow):
         self.users_list = QListWidget()
         self.users_list.setContextMenuPolicy(Qt.CustomContextMenu)
         self.users_list.customContextMenuRequested.connect(self.show_user_context_menu)
+        self.users_list.verticalScrollBar().valueChanged.connect(self.on_users_scrolled)
         
         online_layout.addWidget(online_label)
         online_layout.addWidget(self.users_list)
@@ -1108,12 +1326,32 @@ class ChatWindow(QMainWindow):
         self.friends_list = QListWidget()
         self.friends_list.itemDoubleClicked.connect(self.open_private_chat)
         
+        # Запросы, пришедшие пока мы были не в сети: список вместо очереди модальных окон
+        self.requests_label = QLabel()
+        self.requests_label.setFont(QFont('Arial', 10, QFont.Bold))
+        self.requests_list = QListWidget()
+        self.requests_list.setMaximumHeight(120)
+        self.requests_list.itemDoubleClicked.connect(lambda item: self.answer_selected_request(True))
+        self.accept_request_button = QPushButton('✅ Принять')
+        self.accept_request_button.clicked.connect(lambda: self.answer_selected_request(True))
+        self.decline_request_button = QPushButton('❌ Отклонить')
+        self.decline_request_button.clicked.connect(lambda: self.answer_selected_request(False))
+        request_buttons = QHBoxLayout()
+        request_buttons.addWidget(self.accept_request_button)
+        request_buttons.addWidget(self.decline_request_button)
+        
         friends_layout.addWidget(friends_label)
         friends_layout.addWidget(self.friends_list)
+        friends_layout.addWidget(self.requests_label)
+        friends_layout.addWidget(self.requests_list)
+        friends_layout.addLayout(request_buttons)
         friends_widget.setLayout(friends_layout)
+        self.update_requests_list()
         
         user_tabs.addTab(online_widget, '👥 Онлайн')
         user_tabs.addTab(friends_widget, '⭐ Друзья')
+        # Список онлайн обновляется при открытии вкладки
+        user_tabs.currentChanged.connect(lambda index: index == 0 and self.request_who_online())
         
         right_layout.addWidget(user_tabs)
         right_panel.setLayout(right_layout)
@@ -1135,6 +1373,8 @@ class ChatWindow(QMainWindow):
         """Закрытие вкладки чата"""
         if index > 0:  # Не закрываем основной чат
             tab_name = self.chat_tabs.tabText(index)
+            if tab_name.startswith('🔍'):
+                self.search_display = None
             username = tab_name.replace('🔒 ', '')
             if username in self.private_chats:
                 del self.private_chats[username]
@@ -1158,6 +1398,7 @@ class ChatWindow(QMainWindow):
                 
                 add_friend_action = menu.addAction('➕ Добавить в друзья')
                 pm_action = menu.addAction('💬 Личное сообщение')
+                volume_action = menu.addAction('🔊 Громкость голоса...')
                 
                 action = menu.exec(self.users_list.mapToGlobal(position))
                 
@@ -1165,14 +1406,38 @@ class ChatWindow(QMainWindow):
                     self.send_friend_request(username)
                 elif action == pm_action:
                     self.open_private_chat_by_username(username)
+                elif action == volume_action:
+                    self.set_speaker_volume(username)
+    
+    def set_speaker_volume(self, username):
+        """Громкость голоса отдельного пользователя"""
+        current = int(self.speaker_volumes.get(username, 1.0) * 100)
+        value, ok = QInputDialog.getInt(
+            self, '🔊 Громкость', f'Громкость {username} (%):', current, 0, 200, 10
+        )
+        if ok:
+            self.speaker_volumes[username] = value / 100
+            if self.voice_chat and self.voice_chat.is_active:
+                self.voice_chat.set_speaker_volume(username, value / 100)
+    
+    def update_speakers_label(self):
+        """Показать, кто сейчас говорит"""
+        if not self.voice_chat or not self.voice_chat.is_active:
+            self.speakers_label.hide()
+            return
+        speakers = self.voice_chat.get_active_speakers()
+        if speakers:
+            self.speakers_label.setText('🔊 Говорят: ' + ', '.join(speakers))
+        else:
+            self.speakers_label.setText('🔈 Тишина')
+        self.speakers_label.show()
     
     def send_json(self, data):
         """Вспомогательный метод для отправки JSON с разделителем"""
         try:
-            message = json.dumps(data) + '\n###END###\n'
-            self.socket.send(message.encode('utf-8'))
+            self.socket.sendall(json.dumps(data).encode('utf-8') + SEPARATOR)
         except Exception as e:
-            print(f'Ошибка отправки: {e}')
+            log.warning('Ошибка отправки: %s', e, extra={'event': 'send_error'})
             self.communicator.connection_error.emit(str(e))
     
     def send_friend_request(self, username):
@@ -1187,22 +1452,52 @@ class ChatWindow(QMainWindow):
             self.add_system_message(f'Ошибка: {e}')
     
     def handle_friend_request(self, from_user):
-        """Обработка запроса в друзья"""
+        """Запрос в друзья, пришедший в сети: сразу спросить"""
         reply = QMessageBox.question(
             self,
             '👋 Запрос в друзья',
             f'<b>{from_user}</b> хочет добавить вас в друзья.<br><br>Принять запрос?',
             QMessageBox.Yes | QMessageBox.No
         )
-        
+        self.respond_friend_request(from_user, reply == QMessageBox.Yes)
+    
+    def respond_friend_request(self, from_user, accepted):
+        """Ответить на запрос и убрать его из списка ожидающих"""
         try:
             self.send_json({
                 'type': 'friend_response',
                 'to': from_user,
-                'accepted': reply == QMessageBox.Yes
+                'accepted': accepted
             })
         except Exception as e:
-            print(f'Ошибка: {e}')
+            log.warning('Ошибка: %s', e, extra={'event': 'friend_response_error'})
+        if from_user in self.friend_requests:
+            self.friend_requests.remove(from_user)
+            self.update_requests_list()
+    
+    def answer_selected_request(self, accepted):
+        """Принять или отклонить выбранный в списке запрос"""
+        item = self.requests_list.currentItem()
+        if item is None:
+            return
+        if not self.is_connected:
+            QMessageBox.warning(self, '⚠️ Ошибка', 'Нет подключения к серверу!')
+            return
+        self.respond_friend_request(item.data(Qt.UserRole), accepted)
+    
+    def update_requests_list(self):
+        """Показать ожидающие запросы в друзья; без запросов список скрыт"""
+        self.requests_list.clear()
+        for from_user in self.friend_requests:
+            item = QListWidgetItem(f'👋 {from_user}')
+            item.setData(Qt.UserRole, from_user)
+            self.requests_list.addItem(item)
+        if self.friend_requests:
+            self.requests_list.setCurrentRow(0)
+        visible = bool(self.friend_requests)
+        self.requests_label.setText(f'📨 Запросы ({len(self.friend_requests)})')
+        for widget in (self.requests_label, self.requests_list, self.accept_request_button, self.decline_request_button):
+            widget.setVisible(visible)
     
     def open_private_chat_by_username(self, username):
         """Открыть ЛС по имени пользователя"""
@@ -1216,9 +1511,9 @@ class ChatWindow(QMainWindow):
         pm_widget = QWidget()
         pm_layout = QVBoxLayout()
         
-        pm_display = QTextEdit()
-        pm_display.setReadOnly(True)
-        pm_display.setFont(QFont('Arial', 10))
+        pm_display = ChatView()
+        pm_display.load_older.connect(lambda: self.request_history(username))
+        pm_display.load_newer.connect(lambda: self.reload_latest(username))
         
         pm_layout.addWidget(pm_display)
         pm_widget.setLayout(pm_layout)
@@ -1228,9 +1523,123 @@ class ChatWindow(QMainWindow):
         index = self.chat_tabs.addTab(pm_widget, f'🔒 {username}')
         self.chat_tabs.setCurrentIndex(index)
     
+    def request_history(self, peer):
+        """Запросить страницу истории старше самой старой строки вкладки"""
+        view = self.private_chats.get(peer) if peer else self.chat_display
+        if view is None or not self.is_connected:
+            if view is not None:
+                view.loading_older = False
+            return
+        self.send_json({
+            'type': 'history',
+            'with': peer,
+            'before': view.chat_model.oldest_id(),
+            'limit': HISTORY_PAGE_SIZE
+        })
+    
+    def reload_latest(self, peer):
+        """Новые строки вкладки отброшены при подгрузке старых: заново с последней страницы"""
+        view = self.private_chats.get(peer) if peer else self.chat_display
+        if view is None:
+            return
+        if not self.is_connected:
+            view.loading_newer = False
+            return
+        view.clear()
+        self.request_history(peer)
+    
+    def handle_history(self, message):
+        """Страница истории от сервера"""
+        peer = message.get('with')
+        view = self.private_chats.get(peer) if peer else self.chat_display
+        if view is None:
+            return
+        rows = []
+        for msg in message['messages']:
+            if peer is None:
+                kind = 'own' if msg['username'] == self.username else 'message'
+                rows.append(self.make_row(kind, msg['username'], msg['message'], msg.get('timestamp', ''), msg['id']))
+            elif msg['username'] == self.username:
+                rows.append(self.make_row('outgoing', 'Вы', msg['message'], '', msg['id']))
+            else:
+                rows.append(self.make_row('incoming', msg['username'], msg['message'], msg.get('timestamp', ''), msg['id']))
+        view.prepend_rows(rows, message.get('complete', False))
+        for row in rows:
+            self.remember_row(peer, row)
+    
+    def start_search(self):
+        """Новый поиск: открыть вкладку результатов и запросить первую страницу"""
+        query = self.search_input.text().strip()
+        if not query:
+            return
+        if not self.is_connected:
+            QMessageBox.warning(self, '⚠️ Ошибка', 'Нет подключения к серверу!')
+            return
+        
+        if self.search_display is None:
+            search_widget = QWidget()
+            search_layout = QVBoxLayout()
+            self.search_display = ChatView()
+            self.search_display.load_older.connect(self.request_search_page)
+            self.search_display.load_newer.connect(self.restart_search)
+            search_layout.addWidget(self.search_display)
+            search_widget.setLayout(search_layout)
+            self.chat_tabs.addTab(search_widget, '🔍 Поиск')
+        
+        self.search_query = query
+        self.search_display.clear()
+        self.chat_tabs.setCurrentIndex(self.chat_tabs.indexOf(self.search_display.parentWidget()))
+        self.request_search_page(first=True)
+    
+    def request_search_page(self, first=False):
+        """Следующая страница результатов, старше уже показанных"""
+        view = self.search_display
+        if view is None or not self.is_connected or self.search_query is None:
+            if view is not None:
+                view.loading_older = False
+            return
+        self.send_json({
+            'type': 'search',
+            'query': self.search_query,
+            'before': None if first else view.chat_model.oldest_id(),
+            'limit': HISTORY_PAGE_SIZE
+        })
+    
+    def restart_search(self):
+        """Первые результаты отброшены при подгрузке старых: поиск с первой страницы"""
+        view = self.search_display
+        if not self.is_connected or self.search_query is None:
+            view.loading_newer = False
+            return
+        view.clear()
+        self.request_search_page(first=True)
+    
+    def handle_search_results(self, message):
+        """Страница результатов поиска: от сервера новые первыми"""
+        view = self.search_display
+        if view is None or message.get('query') != self.search_query:
+            return
+        rows = []
+        for msg in reversed(message['messages']):
+            kind = 'own' if msg['username'] == self.username else 'message'
+            username = msg['username']
+            if msg.get('chat'):
+                username = f'{username} (ЛС с {msg["chat"]})' if msg['username'] == self.username \
+                    else f'{username} (ЛС)'
+            rows.append(self.make_row(kind, username, msg['message'], msg.get('timestamp', ''), msg['id']))
+        if message.get('before') is None and not rows:
+            view.append_row(self.make_row('system', '', f'🔍 Ничего не найдено: {self.search_query}'))
+            view.chat_model.history_complete = True
+            return
+        view.prepend_rows(rows, message.get('complete', False))
+    
+    def make_row(self, kind, username, text, timestamp='', message_id=None):
+        """Строка ленты чата"""
+        return {'kind': kind, 'username': username, 'text': text, 'timestamp': timestamp, 'id': message_id}
+    
     def open_private_chat(self, item):
         """Открыть ЛС через двойной клик"""
-        username = item.text().replace('👤 ', '')
+        username = item.data(Qt.UserRole) or item.text().replace('👤 ', '')
         self.open_private_chat_by_username(username)
     
     def show_settings(self):
@@ -1254,62 +1663,238 @@ class ChatWindow(QMainWindow):
         if dialog.exec():
             username, password, host, port, theme, is_login = dialog.get_credentials()
             self.username = username
+            self.password = password
             self.host = host
             self.port = port
             self.settings['theme'] = theme
             self.setWindowTitle(f'💬 PyMessenger Pro - {username}')
             self.apply_theme(theme)
-            self.connect_to_server(host, port, username, password, is_login)
+            cache_loading = self.open_cache(host, port, username, password)
+            self.connect_to_server(host, port, username, password, is_login, cache_loading)
         else:
             self.close()
     
-    def connect_to_server(self, host, port, username, password, is_login):
-        """Подключение к серверу"""
+    def open_cache(self, host, port, username, password):
+        """Открыть кэш аккаунта в фоне (PBKDF2 и расшифровка); итог - сигнал cache_loaded, возвращает поток или None"""
+        if not cache_available():
+            log.info('Локальный кэш отключён: нет пакета cryptography', extra={'event': 'cache_disabled'})
+            return None
+        
+        def load():
+            cache = MessageCache(cache_path(host, port, username), password)
+            try:
+                if not cache.open():
+                    # Пароль сменился или введён с ошибкой: кэш сбросится после успешного входа
+                    log.info('Кэш не расшифрован текущим паролем', extra={'event': 'cache_locked'})
+                chats = cache.load()
+            except Exception as e:
+                log.warning('Локальный кэш недоступен: %s', e, extra={'event': 'cache_error'})
+                cache.close()
+                return
+            self.communicator.cache_loaded.emit(cache, chats)
+        
+        thread = threading.Thread(target=load, daemon=True, name='cache')
+        thread.start()
+        return thread
+    
+    def on_cache_loaded(self, cache, chats):
+        """Кэш открыт: показать сохранённую переписку"""
+        if self.is_closing:
+            cache.close()
+            return
+        self.cache = cache
+        self.last_message_id = cache.last_seen_id()
+        
+        for peer in chats:
+            if peer is not None and peer not in self.private_chats:
+                self.open_private_chat_by_username(peer)
+        self.chat_tabs.setCurrentIndex(0)
+        
+        for peer, rows in chats.items():
+            view = self.private_chats[peer] if peer else self.chat_display
+            view.begin_batch()
+            for row in rows:
+                view.append_row(row)
+            view.end_batch()
+    
+    def remember_row(self, peer, row):
+        """Строка с id от сервера: запомнить последний id и отложить запись в кэш"""
+        if row['id'] is None:
+            return
+        if self.last_message_id is None or row['id'] > self.last_message_id:
+            self.last_message_id = row['id']
+        if self.cache is not None:
+            self.cache_pending.append((peer, row))
+    
+    def save_cache(self):
+        """Записать накопленные строки в кэш одной транзакцией"""
+        if not self.cache_pending:
+            return
+        entries, self.cache_pending = self.cache_pending, []
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(10)
-            self.socket.connect((host, port))
-            self.socket.settimeout(None)
-            
-            # Отправляем login или register
-            if is_login:
-                self.send_json({
-                    'type': 'login',
-                    'username': username,
-                    'password': password
-                })
-            else:
-                self.send_json({
-                    'type': 'register',
-                    'username': username,
-                    'password': password
-                })
-            
-            threading.Thread(target=self.receive_messages, daemon=True).start()
-            
-            self.is_connected = True
-            self.status_bar.showMessage(f'✅ Подключено к {host}:{port}')
-            self.add_system_message(f'✅ Успешно подключено к серверу {host}:{port}')
+            self.cache.store(entries)
         except Exception as e:
-            self.is_connected = False
-            self.status_bar.showMessage(f'❌ Ошибка подключения: {e}')
-            self.add_system_message(f'❌ Ошибка подключения: {e}')
-            QMessageBox.critical(
-                self, 
-                '❌ Ошибка подключения', 
-                f'Не удалось подключиться к серверу:\n\n{e}\n\nПроверьте:\n• Запущен ли сервер\n• Правильность IP адреса\n• Правильность порта\n• Правильность логина/пароля'
-            )
-            self.close()
+            log.warning('Ошибка записи кэша: %s', e, extra={'event': 'cache_error'})
+    
+    def handle_history_sync(self, message):
+        """Начало выдачи истории после входа: дельта или полная выдача заново"""
+        if not message.get('reset'):
+            return
+        # Разрыв между кэшем и сервером слишком велик: старые строки не склеить с новыми
+        if message.get('since') is not None:
+            self.chat_display.clear()
+            for pm_display in self.private_chats.values():
+                pm_display.clear()
+        self.last_message_id = None
+        self.cache_pending = []
+        if self.cache is not None:
+            self.cache.clear()
+    
+    def connect_to_server(self, host, port, username, password, is_login, cache_loading=None):
+        """Подключение к серверу"""
+        self.status_bar.showMessage(f'🔄 Подключение к {host}:{port}...')
+        self.start_connect(host, port, is_login, False, cache_loading)
+    
+    def start_connect(self, host, port, is_login, reconnecting, cache_loading=None):
+        """TCP-соединение в фоновом потоке: до 10 с ожидания не блокируют интерфейс"""
+        self.is_connecting = True
+        
+        def dial():
+            try:
+                sock = socket.create_connection((host, port), timeout=10)
+            except OSError as e:
+                self.communicator.connect_failed.emit(str(e), reconnecting)
+                return
+            # login несёт since из кэша: cache_loaded должен прийти раньше socket_opened
+            if cache_loading is not None:
+                cache_loading.join()
+            self.communicator.socket_opened.emit(sock, is_login, reconnecting)
+        
+        threading.Thread(target=dial, daemon=True, name='connect').start()
+    
+    def on_socket_opened(self, sock, is_login, reconnecting):
+        """Сокет открыт: вход и запуск приёма в потоке интерфейса"""
+        if self.is_closing:
+            self.is_connecting = False
+            sock.close()
+            return
+        try:
+            self.open_connection(sock, self.username, self.password, is_login)
+        except OSError as e:
+            sock.close()
+            self.on_connect_failed(str(e), reconnecting)
+            return
+        self.is_connecting = False
+        
+        if reconnecting:
+            self.reconnect_delay = RECONNECT_MIN_DELAY
+            self.status_bar.showMessage(f'✅ Подключено к {self.host}:{self.port}')
+            self.add_system_message('✅ Соединение восстановлено')
+            log.info('Переподключено', extra={'event': 'reconnect'})
+        else:
+            self.status_bar.showMessage(f'✅ Подключено к {self.host}:{self.port}')
+            self.add_system_message(f'✅ Успешно подключено к серверу {self.host}:{self.port}')
+    
+    def on_connect_failed(self, error, reconnecting):
+        """Соединение не установлено: при первом входе - сообщение и выход, иначе новая попытка"""
+        self.is_connecting = False
+        if self.is_closing:
+            return
+        if reconnecting:
+            log.warning('Переподключение не удалось: %s', error, extra={'event': 'reconnect_error'})
+            self.schedule_reconnect()
+            return
+        
+        self.is_connected = False
+        self.status_bar.showMessage(f'❌ Ошибка подключения: {error}')
+        self.add_system_message(f'❌ Ошибка подключения: {error}')
+        QMessageBox.critical(
+            self, 
+            '❌ Ошибка подключения', 
+            f'Не удалось подключиться к серверу:\n\n{error}\n\nПроверьте:\n• Запущен ли сервер\n• Правильность IP адреса\n• Правильность порта\n• Правильность логина/пароля'
+        )
+        self.close()
+    
+    def open_connection(self, sock, username, password, is_login):
+        """Отправить login/register в открытый сокет и запустить приём"""
+        sock.settimeout(None)
+        enable_keepalive(sock)
+        
+        # Отправляем login или register
+        if is_login:
+            request = {
+                'type': 'login',
+                'username': username,
+                'password': password
+            }
+        else:
+            request = {
+                'type': 'register',
+                'username': username,
+                'password': password
+            }
+        # Сервер пришлёт только сообщения новее последнего показанного
+        if self.last_message_id is not None:
+            request['since'] = self.last_message_id
+        sock.sendall(json.dumps(request).encode('utf-8') + SEPARATOR)
+        
+        self.socket = sock
+        self.last_received = time.monotonic()
+        self.is_connected = True
+        threading.Thread(target=self.receive_messages, args=(sock,), daemon=True).start()
+        self.heartbeat_timer.start()
+    
+    def send_heartbeat(self):
+        """Ping серверу и проверка, что соединение живо"""
+        if not self.is_connected:
+            return
+        
+        if time.monotonic() - self.last_received > HEARTBEAT_TIMEOUT:
+            self.handle_connection_error('Сервер не отвечает')
+            return
+        
+        self.send_json({'type': 'ping'})
     
     def handle_connection_error(self, error):
         """Обработка ошибки соединения"""
+        if not self.is_connected:
+            return
+        
         self.is_connected = False
+        self.voice_token = None
+        self.heartbeat_timer.stop()
+        if self.socket:
+            try:
+                self.socket.close()
+            except:
+                pass
+        
         self.status_bar.showMessage(f'❌ Ошибка: {error}')
         self.add_system_message(f'❌ Соединение потеряно: {error}')
         
         if self.voice_chat and self.voice_chat.is_active:
+            self.voice_was_active = True
             self.voice_chat.stop()
             self.voice_button.setText('🎤 Включить голос')
+            self.speakers_timer.stop()
+            self.speakers_label.hide()
+        
+        if not self.is_closing:
+            self.schedule_reconnect()
+    
+    def schedule_reconnect(self):
+        """Запланировать переподключение с экспоненциальной задержкой"""
+        delay = self.reconnect_delay * random.uniform(0.8, 1.2)
+        self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_MAX_DELAY)
+        self.status_bar.showMessage(f'🔄 Переподключение через {delay:.0f} с...')
+        QTimer.singleShot(int(delay * 1000), self.reconnect)
+    
+    def reconnect(self):
+        """Попытка переподключения к серверу"""
+        if self.is_closing or self.is_connected or self.is_connecting:
+            return
+        
+        self.start_connect(self.host, self.port, True, True)
     
     def toggle_voice(self):
         """Переключение голоса"""
@@ -1318,10 +1903,23 @@ class ChatWindow(QMainWindow):
             return
             
         if self.voice_chat is None or not self.voice_chat.is_active:
+            if self.voice_token is None:
+                QMessageBox.warning(self, '⚠️ Ошибка', 'Сервер ещё не выдал голосовой токен, попробуйте позже')
+                return
+            voice = import_voice()
+            if voice is None:
+                QMessageBox.warning(
+                    self,
+                    '⚠️ Ошибка голоса',
+                    'Голосовой чат недоступен: не установлены numpy и sounddevice или не найден PortAudio.'
+                )
+                return
             voice_port = self.port + 1
-            self.voice_chat = VoiceChat(self.host, voice_port, self.username, self.settings)
+            self.voice_chat = voice.VoiceChat(self.host, voice_port, self.username, self.voice_token, self.settings,
+                                              self.speaker_volumes, self.current_voice_channel())
             if self.voice_chat.start():
                 self.voice_button.setText('🔇 Выключить голос')
+                self.speakers_timer.start()
                 self.add_system_message('🎤 Голосовой чат включен')
                 self.status_bar.showMessage('🎤 Голосовой чат активен')
             else:
@@ -1333,21 +1931,70 @@ class ChatWindow(QMainWindow):
         else:
             self.voice_chat.stop()
             self.voice_button.setText('🎤 Включить голос')
+            self.speakers_timer.stop()
+            self.speakers_label.hide()
             self.add_system_message('🔇 Голосовой чат выключен')
             self.status_bar.showMessage(f'✅ Подключено к {self.host}:{self.port}')
     
-    def receive_messages(self):
+    def warm_up_voice(self):
+        """Импортировать голосовой модуль в фоне, чтобы первое включение было мгновенным"""
+        threading.Thread(target=import_voice, daemon=True, name='voice-warmup').start()
+    
+    def current_voice_channel(self):
+        """Выбранный голосовой канал"""
+        return self.channel_combo.currentText().strip() or DEFAULT_VOICE_CHANNEL
+    
+    def change_voice_channel(self, index=None):
+        """Смена канала на лету, если голос включен"""
+        channel = self.current_voice_channel()
+        if self.voice_chat and self.voice_chat.is_active and channel != self.voice_chat.channel:
+            self.voice_chat.switch_channel(channel)
+            self.add_system_message(f'🎧 Голосовой канал: {channel}')
+    
+    def update_voice_channels(self):
+        """Обновить список каналов с участниками в подсказках"""
+        current = self.channel_combo.currentText()
+        self.channel_combo.blockSignals(True)
+        self.channel_combo.clear()
+        channels = dict(self.voice_channels)
+        channels.setdefault(DEFAULT_VOICE_CHANNEL, [])
+        for channel in sorted(channels):
+            self.channel_combo.addItem(channel)
+            members = channels[channel]
+            tooltip = ', '.join(members) if members else 'пусто'
+            self.channel_combo.setItemData(self.channel_combo.count() - 1, tooltip, Qt.ToolTipRole)
+        self.channel_combo.setCurrentText(current)
+        self.channel_combo.blockSignals(False)
+    
+    def handle_voice_presence(self, message):
+        """Вход/выход участника голосового канала"""
+        channel = message['channel']
+        if message['members']:
+            self.voice_channels[channel] = message['members']
+        else:
+            self.voice_channels.pop(channel, None)
+        self.update_voice_channels()
+        
+        # О чужих каналах не сообщаем, чтобы не засорять чат
+        in_channel = self.voice_chat and self.voice_chat.is_active and self.voice_chat.channel == channel
+        if in_channel and message['username'] != self.username:
+            sign = '+' if message['action'] == 'join' else '−'
+            self.add_system_message(f'🎧 {channel}: {sign}{message["username"]}')
+    
+    def receive_messages(self, sock):
         """Получение сообщений с разделителем"""
         buffer = b""
-        separator = b'\n###END###\n'
+        separator = SEPARATOR
         
         while True:
             try:
-                data = self.socket.recv(4096)
+                data = sock.recv(4096)
                 if not data:
-                    self.communicator.connection_error.emit('Соединение закрыто сервером')
+                    if sock is self.socket:
+                        self.communicator.connection_error.emit('Соединение закрыто сервером')
                     break
                 
+                self.last_received = time.monotonic()
                 buffer += data
                 
                 while separator in buffer:
@@ -1355,23 +2002,84 @@ class ChatWindow(QMainWindow):
                     
                     try:
                         message = json.loads(message_data.decode('utf-8'))
-                        self.communicator.message_received.emit(message)
+                        if message.get('type') == 'pong':
+                            continue
+                        self.queue_message(message)
                     except json.JSONDecodeError as e:
-                        print(f'Ошибка JSON: {e}')
+                        log.warning('Ошибка JSON: %s', e, extra={'event': 'bad_frame'})
                         
             except Exception as e:
-                self.communicator.connection_error.emit(str(e))
-                print(f'Ошибка получения: {e}')
+                if sock is self.socket:
+                    self.communicator.connection_error.emit(str(e))
+                    log.warning('Ошибка получения: %s', e, extra={'event': 'receive_error'})
                 break
     
+    def queue_message(self, message):
+        """Из потока приёма: положить кадр в очередь, сигнал - только первому кадру пачки"""
+        self.pending_messages.append(message)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.communicator.messages_ready.emit()
+    
+    def schedule_flush(self):
+        """Запустить таймер пачки, если он ещё не идёт"""
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+    
+    def flush_messages(self):
+        """Применить накопленные кадры: одна перерисовка на вкладку"""
+        # Сначала сбрасываем флаг: кадры, пришедшие во время разбора, вызовут новый сигнал
+        self.flush_scheduled = False
+        messages = []
+        while self.pending_messages and len(messages) < MAX_FRAMES_PER_FLUSH:
+            messages.append(self.pending_messages.popleft())
+        
+        # Список пользователей - снимок состояния, достаточно последнего
+        last_users = None
+        for i, message in enumerate(messages):
+            if message.get('type') == 'users':
+                last_users = i
+        
+        views = [self.chat_display, *self.private_chats.values()]
+        for view in views:
+            view.begin_batch()
+        try:
+            for i, message in enumerate(messages):
+                if message.get('type') == 'users' and i != last_users:
+                    continue
+                try:
+                    self.handle_message(message)
+                except Exception as e:
+                    log.warning('Ошибка обработки кадра %s: %s', message.get('type'), e,
+                                extra={'event': 'bad_frame'})
+        finally:
+            for view in [self.chat_display, *self.private_chats.values()]:
+                view.end_batch()
+            self.save_cache()
+        
+        # Остаток большой пачки - в следующий тик, чтобы окно оставалось отзывчивым
+        if self.pending_messages:
+            self.flush_scheduled = True
+            self.flush_timer.start()
+    
     def handle_message(self, message):
         """Обработка сообщений"""
         if message['type'] == 'login_response' or message['type'] == 'register_response':
             if not message['success']:
                 QMessageBox.critical(self, '❌ Ошибка', message['message'])
                 self.close()
+            else:
+                if self.cache is not None and not self.cache.valid:
+                    # Вход подтвердил пароль: кэш под старым паролем больше не нужен
+                    self.cache.reset()
+                # Ответ на запрос прошлого соединения уже не придёт
+                self.who_online_loading = False
+                self.request_who_online()
+                if not self.voice_warmup_started:
+                    self.voice_warmup_started = True
+                    QTimer.singleShot(VOICE_WARMUP_DELAY_MS, self.warm_up_voice)
         elif message['type'] == 'message':
-            self.add_message(message['username'], message['message'], message.get('timestamp', ''))
+            self.add_message(message['username'], message['message'], message.get('timestamp', ''), message.get('id'))
         elif message['type'] == 'private_message':
             self.handle_private_message(message)
         elif message['type'] == 'private_message_sent':
@@ -1383,9 +2091,54 @@ class ChatWindow(QMainWindow):
         elif message['type'] == 'friend_request':
             self.communicator.friend_request.emit(message['from'])
         elif message['type'] == 'friend_added':
-            self.add_friend(message['friend'])
+            self.add_friend(message['friend'], message.get('online', False))
         elif message['type'] == 'friends_list':
-            self.update_friends_list(message['friends'])
+            self.update_friends_list(message['friends'], message.get('online', ()))
+            # Запросы, пришедшие пока мы были не в сети: сервер присылает весь список при каждом входе
+            self.friend_requests = list(message.get('requests', ()))
+            self.update_requests_list()
+            if self.friend_requests:
+                self.add_system_message(f'📨 Запросов в друзья: {len(self.friend_requests)} - см. вкладку «Друзья»')
+        elif message['type'] == 'presence':
+            self.handle_presence(message)
+        elif message['type'] == 'who_online':
+            self.handle_who_online(message)
+        elif message['type'] == 'typing':
+            self.handle_typing(message)
+        elif message['type'] == 'voice_token':
+            self.voice_token = message['token']
+            # Голос восстанавливается после переподключения, когда сессия готова
+            if self.voice_was_active:
+                self.voice_was_active = False
+                self.toggle_voice()
+        elif message['type'] == 'voice_channels':
+            self.voice_channels = message['channels']
+            self.update_voice_channels()
+        elif message['type'] == 'voice_presence':
+            self.handle_voice_presence(message)
+        elif message['type'] == 'history':
+            self.handle_history(message)
+        elif message['type'] == 'history_sync':
+            self.handle_history_sync(message)
+        elif message['type'] == 'search_results':
+            self.handle_search_results(message)
+        elif message['type'] == 'rate_limited':
+            self.reset_history_requests(message)
+            self.add_system_message('⏳ Слишком много сообщений, подождите немного')
+        elif message['type'] == 'error':
+            self.reset_history_requests(message)
+            self.add_system_message(f'❌ Сервер отклонил запрос: {message.get("message", "")}')
+    
+    def reset_history_requests(self, message):
+        """Отклонённый запрос истории можно повторить прокруткой"""
+        if message.get('for') == 'history':
+            self.chat_display.loading_older = False
+            for pm_display in self.private_chats.values():
+                pm_display.loading_older = False
+        elif message.get('for') == 'search' and self.search_display is not None:
+            self.search_display.loading_older = False
+        elif message.get('for') == 'who_online':
+            self.who_online_loading = False
     
     def handle_private_message(self, message):
         """Обработка личных сообщений"""
@@ -1394,33 +2147,23 @@ class ChatWindow(QMainWindow):
         if sender not in self.private_chats:
             self.open_private_chat_by_username(sender)
         
-        pm_display = self.private_chats[sender]
-        pm_display.append(
-            f'<div style="margin: 8px 0; padding: 8px; background-color: rgba(33, 150, 243, 0.1); border-radius: 8px;">'
-            f'<span style="color: #2196F3; font-weight: bold; font-size: 11px;">{sender}</span> '
-            f'<span style="color: #999; font-size: 9px;">[{message.get("timestamp", "")}]</span><br>'
-            f'<span style="font-size: 11px; margin-top: 5px;">{message["message"]}</span>'
-            f'</div>'
-        )
-        pm_display.moveCursor(QTextCursor.End)
+        row = self.make_row('incoming', sender, message['message'], message.get('timestamp', ''), message.get('id'))
+        self.private_chats[sender].append_row(row)
+        self.clear_typing(sender, sender)
+        self.remember_row(sender, row)
         
         self.add_system_message(f'💬 Новое ЛС от {sender}')
     
     def handle_sent_private_message(self, message):
-        """Обработка истории отправленных ЛС"""
+        """Отправленное ЛС: подтверждение сервера или история"""
         recipient = message['to']
         
         if recipient not in self.private_chats:
             self.open_private_chat_by_username(recipient)
         
-        pm_display = self.private_chats[recipient]
-        pm_display.append(
-            f'<div style="margin: 8px 0; padding: 8px; background-color: rgba(76, 175, 80, 0.1); border-radius: 8px; text-align: right;">'
-            f'<span style="color: #4CAF50; font-weight: bold; font-size: 11px;">Вы</span><br>'
-            f'<span style="font-size: 11px; margin-top: 5px;">{message["message"]}</span>'
-            f'</div>'
-        )
-        pm_display.moveCursor(QTextCursor.End)
+        row = self.make_row('outgoing', 'Вы', message['message'], '', message.get('id'))
+        self.private_chats[recipient].append_row(row)
+        self.remember_row(recipient, row)
     
     def send_message(self):
         """Отправка сообщения"""
@@ -1434,24 +2177,17 @@ class ChatWindow(QMainWindow):
         
         try:
             current_tab = self.chat_tabs.tabText(self.chat_tabs.currentIndex())
+            # Сообщение само гасит индикатор у получателей
+            self.typing_sent.pop(self.current_peer(), None)
             
             if current_tab.startswith('🔒'):
                 to_user = current_tab.replace('🔒 ', '')
+                # Строка появится по подтверждению сервера (private_message_sent) вместе с id
                 self.send_json({
                     'type': 'private_message',
                     'to': to_user,
                     'message': text
                 })
-                
-                if to_user in self.private_chats:
-                    pm_display = self.private_chats[to_user]
-                    pm_display.append(
-                        f'<div style="margin: 8px 0; padding: 8px; background-color: rgba(76, 175, 80, 0.1); border-radius: 8px; text-align: right;">'
-                        f'<span style="color: #4CAF50; font-weight: bold; font-size: 11px;">Вы</span><br>'
-                        f'<span style="font-size: 11px; margin-top: 5px;">{text}</span>'
-                        f'</div>'
-                    )
-                    pm_display.moveCursor(QTextCursor.End)
             else:
                 self.send_json({
                     'type': 'message',
@@ -1462,36 +2198,91 @@ class ChatWindow(QMainWindow):
         except Exception as e:
             self.add_system_message(f'❌ Ошибка отправки: {e}')
     
-    def add_message(self, username, text, timestamp):
-        """Добавить сообщение в общий чат"""
-        color = '#2196F3' if username == self.username else '#4CAF50'
-        self.chat_display.append(
-            f'<div style="margin: 8px 0; padding: 8px; background-color: rgba({self.get_rgb_from_hex(color)}, 0.1); border-radius: 8px;">'
-            f'<span style="color: {color}; font-weight: bold; font-size: 11px;">{username}</span> '
-            f'<span style="color: #999; font-size: 9px;">[{timestamp}]</span><br>'
-            f'<span style="font-size: 11px; margin-top: 5px;">{text}</span>'
-            f'</div>'
-        )
-        self.chat_display.moveCursor(QTextCursor.End)
+    def current_peer(self):
+        """Собеседник открытой вкладки ЛС, None - общий чат или поиск"""
+        current_tab = self.chat_tabs.tabText(self.chat_tabs.currentIndex())
+        return current_tab.replace('🔒 ', '') if current_tab.startswith('🔒') else None
+    
+    def on_input_changed(self, text):
+        """Сообщить, что мы печатаем; не чаще раза в TYPING_SEND_INTERVAL"""
+        if not self.is_connected or self.chat_tabs.currentIndex() < 0:
+            return
+        if self.chat_tabs.tabText(self.chat_tabs.currentIndex()).startswith('🔍'):
+            return
+        peer = self.current_peer()
+        now = time.monotonic()
+        if text.strip():
+            if now - self.typing_sent.get(peer, -TYPING_SEND_INTERVAL) >= TYPING_SEND_INTERVAL:
+                self.typing_sent[peer] = now
+                self.send_json({'type': 'typing', 'to': peer})
+        elif self.typing_sent.pop(peer, None) is not None:
+            self.send_json({'type': 'typing', 'to': peer, 'active': False})
+    
+    def handle_typing(self, message):
+        """Кто начал или перестал печатать; в ЛС разговор - сам печатающий"""
+        until = time.monotonic() + TYPING_DISPLAY_TIMEOUT
+        private = message.get('chat') == 'private'
+        for user in message.get('users', ()):
+            if user != self.username:
+                self.typing_users.setdefault(user if private else None, {})[user] = until
+        for user in message.get('stopped', ()):
+            self.clear_typing(user if private else None, user)
+        self.update_typing_label()
     
-    def get_rgb_from_hex(self, hex_color):
-        """Конвертация HEX в RGB строку для rgba"""
-        hex_color = hex_color.lstrip('#')
-        r, g, b = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-        return f'{r}, {g}, {b}'
+    def clear_typing(self, peer, username):
+        """Убрать индикатор username в разговоре peer"""
+        typing = self.typing_users.get(peer)
+        if typing and typing.pop(username, None) is not None:
+            self.update_typing_label()
+    
+    def update_typing_label(self):
+        """Показать, кто печатает в открытой вкладке; устаревшие индикаторы гаснут"""
+        now = time.monotonic()
+        for peer in list(self.typing_users):
+            typing = {user: until for user, until in self.typing_users[peer].items() if until > now}
+            if typing:
+                self.typing_users[peer] = typing
+            else:
+                del self.typing_users[peer]
+        
+        current_tab = self.chat_tabs.tabText(self.chat_tabs.currentIndex())
+        users = [] if current_tab.startswith('🔍') else sorted(self.typing_users.get(self.current_peer(), ()))
+        if not users:
+            self.typing_label.hide()
+            self.typing_timer.stop()
+            return
+        
+        if len(users) == 1:
+            text = f'✏️ {users[0]} печатает...'
+        elif len(users) <= 3:
+            text = f'✏️ {", ".join(users)} печатают...'
+        else:
+            text = f'✏️ {", ".join(users[:3])} и ещё {len(users) - 3} печатают...'
+        self.typing_label.setText(text)
+        self.typing_label.show()
+        if not self.typing_timer.isActive():
+            self.typing_timer.start()
+    
+    def add_message(self, username, text, timestamp, message_id=None):
+        """Добавить сообщение в общий чат"""
+        kind = 'own' if username == self.username else 'message'
+        row = self.make_row(kind, username, text, timestamp, message_id)
+        self.chat_display.append_row(row)
+        self.remember_row(None, row)
+        self.clear_typing(None, username)
     
     def add_system_message(self, text):
         """Системное сообщение"""
-        self.chat_display.append(
-            f'<div style="margin: 8px 0; padding: 8px; background-color: rgba(255, 152, 0, 0.1); border-radius: 8px; text-align: center;">'
-            f'<span style="color: #FF9800; font-style: italic; font-size: 10px;">⚙️ {text}</span>'
-            f'</div>'
-        )
-        self.chat_display.moveCursor(QTextCursor.End)
+        self.chat_display.append_row(self.make_row('system', '', text))
     
     def update_users_list(self, users):
         """Обновить список пользователей"""
         self.users_list.clear()
+        self.append_users(users)
+        self.who_online_complete = True
+    
+    def append_users(self, users):
+        """Добавить пользователей в конец списка онлайн"""
         for user in users:
             item = QListWidgetItem(f'👤 {user}')
             if user == self.username:
@@ -1500,22 +2291,64 @@ class ChatWindow(QMainWindow):
                 item.setFont(font)
             self.users_list.addItem(item)
     
-    def add_friend(self, friend):
+    def request_who_online(self, after=None):
+        """Запросить страницу списка онлайн; без after - с начала"""
+        if not self.is_connected or self.who_online_loading:
+            return
+        self.who_online_loading = True
+        self.send_json({'type': 'who_online', 'after': after})
+    
+    def handle_who_online(self, message):
+        """Страница списка онлайн по алфавиту"""
+        self.who_online_loading = False
+        if message.get('after') is None:
+            self.users_list.clear()
+        self.append_users(message['users'])
+        self.who_online_complete = message.get('complete', True)
+    
+    def on_users_scrolled(self, value):
+        """Прокрутка списка онлайн до конца подгружает следующую страницу"""
+        if value == self.users_list.verticalScrollBar().maximum() and not self.who_online_complete \
+                and self.users_list.count():
+            self.request_who_online(self.users_list.item(self.users_list.count() - 1).text().replace('👤 ', ''))
+    
+    def handle_presence(self, message):
+        """Друг вошёл в сеть или вышел"""
+        friend = message['username']
+        if message['online']:
+            self.friends_online.add(friend)
+            self.add_system_message(f'🟢 {friend} в сети')
+        else:
+            self.friends_online.discard(friend)
+            self.add_system_message(f'⚪ {friend} вышел из сети')
+        self.update_friends_list(self.friends, self.friends_online)
+    
+    def add_friend(self, friend, online=False):
         """Добавить друга"""
+        if friend in self.friend_requests:
+            self.friend_requests.remove(friend)
+            self.update_requests_list()
         if friend not in self.friends:
             self.friends.append(friend)
-            self.friends_list.addItem(f'👤 {friend}')
+            if online:
+                self.friends_online.add(friend)
+            self.update_friends_list(self.friends, self.friends_online)
             self.add_system_message(f'⭐ {friend} добавлен в друзья')
     
-    def update_friends_list(self, friends):
-        """Обновить список друзей"""
-        self.friends = friends
+    def update_friends_list(self, friends, online=()):
+        """Обновить список друзей; друзья в сети - первыми"""
+        self.friends = list(friends)
+        self.friends_online = set(online)
         self.friends_list.clear()
-        for friend in friends:
-            self.friends_list.addItem(f'👤 {friend}')
+        for friend in sorted(self.friends, key=lambda name: (name not in self.friends_online, name)):
+            item = QListWidgetItem(f'{"🟢" if friend in self.friends_online else "⚪"} {friend}')
+            item.setData(Qt.UserRole, friend)
+            self.friends_list.addItem(item)
     
     def closeEvent(self, event):
         """Закрытие окна"""
+        self.is_closing = True
+        self.heartbeat_timer.stop()
         if self.voice_chat:
             self.voice_chat.stop()
         if self.socket:
@@ -1523,9 +2356,15 @@ class ChatWindow(QMainWindow):
                 self.socket.close()
             except:
                 pass
+        if self.cache is not None:
+            self.save_cache()
+            self.cache.trim()
+            self.cache.close()
         event.accept()
 
 if __name__ == '__main__':
+    setup_logging()
+    
     app = QApplication(sys.argv)
     app.setStyle('Fusion')
     
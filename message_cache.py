@@ -0,0 +1,161 @@
+import os
+import hmac
+import json
+import base64
+import sqlite3
+import hashlib
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:  # без cryptography локальный кэш отключён
+    Fernet = None
+    InvalidToken = ValueError
+
+# Каталог кэша; переопределяется переменной окружения PYMESSENGER_CACHE_DIR
+CACHE_DIR = os.environ.get('PYMESSENGER_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.pymessenger', 'cache'))
+
+# Сколько последних строк каждого чата хранится и показывается при запуске
+CACHE_ROWS_PER_CHAT = 500
+
+KDF_ITERATIONS = 200_000
+CHECK_VALUE = b'pymessenger-cache'
+
+def cache_available():
+    """Есть ли библиотека шифрования для кэша"""
+    return Fernet is not None
+
+def cache_path(host, port, username, directory=None):
+    """Файл кэша для аккаунта на сервере; имя не раскрывает логин и адрес"""
+    digest = hashlib.sha256(f'{username}@{host}:{port}'.encode('utf-8')).hexdigest()[:32]
+    return os.path.join(directory or CACHE_DIR, f'{digest}.db')
+
+class MessageCache:
+    """Локальный зашифрованный кэш переписки одного аккаунта на одном сервере.
+
+    Ключ выводится из пароля (PBKDF2 с солью из файла), тело каждой строки
+    шифруется Fernet, а чат хранится как HMAC от имени собеседника. Пароль
+    проверяется по контрольному значению: если он сменился, кэш не читается
+    (valid = False) и сбрасывается через reset() после успешного входа.
+    """
+    def __init__(self, path, password):
+        self.path = path
+        self.password = password
+        self.conn = None
+        self.fernet = None
+        self.chat_key = None
+        self.valid = False
+
+    def open(self):
+        """Открыть или создать файл кэша; True, если пароль подошёл"""
+        if Fernet is None:
+            raise RuntimeError('для локального кэша нужен пакет cryptography')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Открывается в фоновом потоке клиента, дальше используется в потоке интерфейса
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            chat TEXT NOT NULL,
+            data BLOB NOT NULL
+        )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat, id)')
+        self.conn.commit()
+
+        meta = dict(self.conn.execute('SELECT name, value FROM meta'))
+        if 'salt' not in meta or 'check' not in meta:
+            self.reset()
+            return True
+
+        self.derive_keys(meta['salt'])
+        try:
+            self.valid = self.fernet.decrypt(meta['check']) == CHECK_VALUE
+        except InvalidToken:
+            self.valid = False
+        return self.valid
+
+    def derive_keys(self, salt):
+        """Ключ шифрования и ключ HMAC для имён чатов из пароля"""
+        material = hashlib.pbkdf2_hmac('sha256', self.password.encode('utf-8'), salt, KDF_ITERATIONS, dklen=64)
+        self.fernet = Fernet(base64.urlsafe_b64encode(material[:32]))
+        self.chat_key = material[32:]
+
+    def reset(self):
+        """Очистить кэш и зашифровать его заново текущим паролем"""
+        salt = os.urandom(16)
+        self.derive_keys(salt)
+        with self.conn:
+            self.conn.execute('DELETE FROM messages')
+            self.conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', ('salt', salt))
+            self.conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+                              ('check', self.fernet.encrypt(CHECK_VALUE)))
+        self.valid = True
+
+    def chat_id(self, peer):
+        """Ключ чата: HMAC от имени собеседника, '' - общий чат"""
+        return hmac.new(self.chat_key, (peer or '').encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+    def last_seen_id(self):
+        """Наибольший id в кэше или None"""
+        if not self.valid:
+            return None
+        return self.conn.execute('SELECT MAX(id) FROM messages').fetchone()[0]
+
+    def load(self, limit=CACHE_ROWS_PER_CHAT):
+        """Последние limit строк каждого чата: {собеседник или None: [строки]}"""
+        if not self.valid:
+            return {}
+        chats = {}
+        for (chat,) in self.conn.execute('SELECT DISTINCT chat FROM messages').fetchall():
+            rows = self.conn.execute(
+                'SELECT data FROM messages WHERE chat = ? ORDER BY id DESC LIMIT ?', (chat, limit)
+            ).fetchall()
+            peer = None
+            decoded = []
+            for (data,) in reversed(rows):
+                try:
+                    entry = json.loads(self.fernet.decrypt(data))
+                except (InvalidToken, ValueError):
+                    continue
+                peer = entry.pop('chat')
+                decoded.append(entry)
+            if decoded:
+                chats[peer] = decoded
+        # Общий чат первым, ЛС - в порядке последней активности
+        return dict(sorted(chats.items(), key=lambda item: (item[0] is not None, item[1][-1]['id'])))
+
+    def store(self, entries):
+        """Сохранить строки [(собеседник или None, строка)] одной транзакцией"""
+        if not self.valid or not entries:
+            return
+        values = []
+        for peer, row in entries:
+            if row.get('id') is None:
+                continue
+            data = json.dumps({**row, 'chat': peer}, ensure_ascii=False).encode('utf-8')
+            values.append((row['id'], self.chat_id(peer), self.fernet.encrypt(data)))
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO messages (id, chat, data) VALUES (?, ?, ?)', values)
+
+    def trim(self, keep=CACHE_ROWS_PER_CHAT):
+        """Оставить в каждом чате не больше keep последних строк"""
+        if not self.valid:
+            return
+        with self.conn:
+            self.conn.execute('''DELETE FROM messages WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY chat ORDER BY id DESC) AS position
+                    FROM messages
+                ) WHERE position > ?
+            )''', (keep,))
+
+    def clear(self):
+        """Удалить все строки (сервер сообщил о разрыве истории)"""
+        if self.valid:
+            with self.conn:
+                self.conn.execute('DELETE FROM messages')
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
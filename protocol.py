@@ -0,0 +1,174 @@
+import json
+import socket
+import struct
+
+# Разделитель JSON-кадров текстового канала
+SEPARATOR = b'\n###END###\n'
+
+# Пустой кадр голосового канала (длина 0) - ping/pong
+VOICE_PING = (0).to_bytes(4, 'big')
+
+# Heartbeat прикладного уровня (секунды)
+HEARTBEAT_INTERVAL = 15
+HEARTBEAT_TIMEOUT = 45
+
+# TCP keepalive (секунды)
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+# Голосовые каналы: канал выбирается в voice_join
+DEFAULT_VOICE_CHANNEL = 'general'
+MAX_VOICE_CHANNEL_LENGTH = 32
+
+# Наибольшее тело голосового кадра от клиента; длиннее - обрыв соединения
+MAX_VOICE_FRAME = 64 * 1024
+
+# Рукопожатие голосового канала: кадр длина (4 байта) + JSON
+MAX_HANDSHAKE_SIZE = 4096
+
+# Переподключение клиента (секунды)
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
+def enable_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL,
+                     count=KEEPALIVE_COUNT, user_timeout=HEARTBEAT_TIMEOUT):
+    """Включить TCP keepalive; параметры выставляются там, где ОС их поддерживает"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    options = (
+        ('TCP_KEEPIDLE', idle),
+        ('TCP_KEEPALIVE', idle),  # macOS
+        ('TCP_KEEPINTVL', interval),
+        ('TCP_KEEPCNT', count),
+        # Linux: обрыв, если отправленные данные не подтверждены за user_timeout
+        ('TCP_USER_TIMEOUT', int(user_timeout * 1000)),
+    )
+    for name, value in options:
+        option = getattr(socket, name, None)
+        if option is None:
+            continue
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, option, value)
+        except OSError:
+            pass
+
+# Кадр голоса от сервера к клиенту: длина (4 байта), длина имени говорящего
+# (1 байт), имя в UTF-8 и PCM float32
+def speaker_header(username):
+    """Заголовок говорящего, который сервер добавляет к пересылаемому кадру"""
+    name = username.encode('utf-8')[:255]
+    return bytes([len(name)]) + name
+
+def split_voice_frame(data):
+    """Разобрать тело кадра сервера на имя говорящего и PCM"""
+    name_length = data[0]
+    speaker = bytes(data[1:1 + name_length]).decode('utf-8', errors='replace')
+    return speaker, data[1 + name_length:]
+
+# Маркер тишины (DTX) вместо аудио: тип (1 байт) и уровень шума float32.
+# Длина 5 не кратна 4, поэтому маркер не спутать с PCM
+SILENCE_MARKER = 1
+SILENCE_FRAME_SIZE = 5
+
+def silence_frame(level):
+    """Тело кадра-маркера тишины с уровнем (RMS) для комфортного шума"""
+    return bytes([SILENCE_MARKER]) + struct.pack('<f', level)
+
+def parse_silence_frame(payload):
+    """Уровень шума, если тело кадра - маркер тишины, иначе None"""
+    if len(payload) != SILENCE_FRAME_SIZE or payload[0] != SILENCE_MARKER:
+        return None
+    return struct.unpack('<f', payload[1:])[0]
+
+def recv_exact(sock, num_bytes):
+    """Прочитать ровно num_bytes; None, если соединение закрыто раньше"""
+    data = bytearray()
+    while len(data) < num_bytes:
+        packet = sock.recv(num_bytes - len(data))
+        if not packet:
+            return None
+        data += packet
+    return bytes(data)
+
+def pack_handshake(message):
+    """Кадр рукопожатия голосового канала: длина + JSON"""
+    data = json.dumps(message).encode('utf-8')
+    return len(data).to_bytes(4, 'big') + data
+
+def recv_handshake(sock):
+    """Прочитать кадр рукопожатия; None при обрыве, ValueError при некорректном кадре"""
+    length_bytes = recv_exact(sock, 4)
+    if not length_bytes:
+        return None
+    length = int.from_bytes(length_bytes, 'big')
+    if not 0 < length <= MAX_HANDSHAKE_SIZE:
+        raise ValueError(f'недопустимая длина рукопожатия: {length}')
+    data = recv_exact(sock, length)
+    if data is None:
+        return None
+    message = json.loads(data.decode('utf-8'))
+    if not isinstance(message, dict):
+        raise ValueError('рукопожатие должно быть объектом')
+    return message
+
+class FrameReader:
+    """Чтение кадров длина + тело через recv_into в один переиспользуемый буфер.
+
+    Буфер устроен как исходящий кадр: [длина][prefix][тело], поэтому тело
+    можно переслать дальше вместе с prefix (например, именем говорящего)
+    без промежуточного копирования. Тело действительно до следующего read().
+    """
+    def __init__(self, sock, max_size, prefix=b''):
+        self.sock = sock
+        self.max_size = max_size
+        self.length_bytes = bytearray(4)
+        self.length_view = memoryview(self.length_bytes)
+        self.prefix_size = len(prefix)
+        self.body_offset = 4 + len(prefix)
+        self.buffer = bytearray(self.body_offset + max_size)
+        self.buffer[4:self.body_offset] = prefix
+        self.view = memoryview(self.buffer)
+        # Голосовые кадры обычно одной длины: срезы буфера кэшируются по длине
+        self.length = -1
+        self.body_view = None
+        self.frame_view = None
+
+    def fill(self, view):
+        """Заполнить view целиком; False, если соединение закрыто"""
+        size = len(view)
+        received = self.sock.recv_into(view, size)
+        while received < size:
+            if not received:
+                return False
+            count = self.sock.recv_into(view[received:], size - received)
+            if not count:
+                return False
+            received += count
+        return True
+
+    def read(self):
+        """Прочитать кадр; длина тела или None, если соединение закрыто"""
+        if not self.fill(self.length_view):
+            return None
+        length = int.from_bytes(self.length_bytes, 'big')
+        if length != self.length:
+            if length > self.max_size:
+                raise ValueError(f'кадр длиннее {self.max_size} байт: {length}')
+            self.length = length
+            self.body_view = self.view[self.body_offset:self.body_offset + length]
+            self.frame_view = None
+        if length and not self.fill(self.body_view):
+            return None
+        return length
+
+    def body(self):
+        """Тело последнего кадра (memoryview без копирования)"""
+        return self.body_view
+
+    def relay_frame(self):
+        """Последний кадр с prefix перед телом, готовый к отправке"""
+        if self.frame_view is None:
+            total = self.prefix_size + self.length
+            self.buffer[:4] = total.to_bytes(4, 'big')
+            self.frame_view = self.view[:4 + total]
+        return self.frame_view
@@ -1,197 +1,636 @@
 import socket
 import threading
 import json
-from datetime import datetime
-import sqlite3
-import hashlib
+import gzip
+import bisect
+from datetime import datetime, timedelta, timezone
 import os
+import secrets
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from chat_logging import setup_logging, get_logger
+from storage import ChatDatabase, open_storage
+from protocol import (SEPARATOR, VOICE_PING, HEARTBEAT_TIMEOUT, MAX_VOICE_CHANNEL_LENGTH,
+                      MAX_VOICE_FRAME, FrameReader, enable_keepalive, speaker_header, pack_handshake,
+                      recv_handshake)
 
-class ChatDatabase:
-    """Класс для работы с базой данных"""
-    def __init__(self, db_path='chat_server.db'):
-        self.db_path = db_path
-        self.init_database()
-    
-    def get_connection(self):
-        """Получить соединение с БД"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
-    
-    def init_database(self):
-        """Инициализация базы данных"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица сообщений
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_private BOOLEAN DEFAULT 0,
-                recipient TEXT
-            )
-        ''')
-        
-        # Таблица друзей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS friendships (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user1 TEXT NOT NULL,
-                user2 TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user1, user2)
-            )
-        ''')
+log = get_logger('server')
+
+# Высокочастотные события логируются выборочно: {event: каждая N-я запись}
+LOG_SAMPLE_RATES = {
+    'private_message': 10,
+    'broadcast_error': 100,
+    'voice_broadcast_error': 100,
+    'bad_frame': 100,
+}
+
+# Лимиты на пользователя: {тип: (токенов в секунду, размер корзины)}
+# default - для остальных типов кадров, voice_bytes - байты голоса в секунду
+RATE_LIMITS = {
+    'message': (5, 10),
+    'private_message': (5, 10),
+    'friend_request': (0.2, 3),
+    'friend_response': (1, 5),
+    'default': (20, 40),
+    'history': (2, 5),
+    'search': (1, 5),
+    'who_online': (2, 5),
+    'typing': (1, 3),
+    'voice_bytes': (128 * 1024, 256 * 1024),
+    # Не чаще одного служебного уведомления (rate_limited, error) в секунду
+    'error_notice': (1, 1),
+}
+
+# Наибольшая страница истории по запросу history
+MAX_HISTORY_PAGE = 100
+
+# Поиск по истории: длина запроса и наибольшая страница результатов
+MAX_SEARCH_QUERY = 200
+MAX_SEARCH_PAGE = 50
+
+# Присутствие: 'friends' - о входе и выходе узнают только друзья, о голосовом
+# канале - его участники и друзья, полный список - по запросу who_online;
+# 'broadcast' - всем подключённым и полный список users при каждом изменении
+PRESENCE_MODE = 'friends'
+
+# Наибольшая страница who_online
+MAX_WHO_ONLINE_PAGE = 100
+
+# Запрос в друзья ждёт ответа FRIEND_REQUEST_TTL секунд; при входе
+# доставляется не больше MAX_PENDING_FRIEND_REQUESTS самых старых
+FRIEND_REQUEST_TTL = 30 * 24 * 3600
+MAX_PENDING_FRIEND_REQUESTS = 100
+
+# Индикаторы набора: события за TYPING_TICK секунд сводятся в один кадр на
+# разговор, в кадре не больше MAX_TYPING_USERS имён (остальные - в more)
+TYPING_TICK = 0.5
+MAX_TYPING_USERS = 20
+
+# Наибольшая дельта истории после since при входе; больше - полная выдача заново
+MAX_SYNC_MESSAGES = 500
+
+# Хранение истории: {вид: {max_age_days, max_count}}, None - без ограничения.
+# Сообщения сверх политики удаляет фоновая компакция (RetentionJob)
+RETENTION_POLICIES = {
+    'public': {'max_age_days': None, 'max_count': None},
+    'private': {'max_age_days': None, 'max_count': None},
+}
+
+# Компакция: раз в RETENTION_INTERVAL секунд, пачками по RETENTION_BATCH строк
+RETENTION_INTERVAL = 3600
+RETENTION_BATCH = 500
+# Пауза между пачками, чтобы запись сообщений не ждала компакцию
+RETENTION_PAUSE = 0.05
+# Страниц за один шаг incremental_vacuum
+VACUUM_STEP_PAGES = 1000
+
+def optional(field_type):
+    """Необязательное поле схемы: может отсутствовать или быть None"""
+    return (field_type, False)
+
+# Поля кадров: {тип: {поле: тип значения или optional(тип)}}
+FRAME_SCHEMAS = {
+    'login': {'username': str, 'password': str, 'since': optional(int)},
+    'register': {'username': str, 'password': str},
+    'message': {'message': str},
+    'private_message': {'to': str, 'message': str},
+    'friend_request': {'to': str},
+    'friend_response': {'to': str, 'accepted': bool},
+    'ping': {},
+    'history': {'before': optional(int), 'with': optional(str), 'limit': optional(int)},
+    'search': {'query': str, 'before': optional(int), 'with': optional(str), 'limit': optional(int)},
+    'who_online': {'after': optional(str), 'limit': optional(int)},
+    'typing': {'to': optional(str), 'active': optional(bool)},
+    'voice_join': {'token': str, 'channel': str},
+}
+
+def validate_frame(message, schema):
+    """Проверка полей кадра по схеме; возвращает текст ошибки или None"""
+    for field, rule in schema.items():
+        field_type, required = rule if isinstance(rule, tuple) else (rule, True)
+        value = message.get(field)
+        if value is None and not required:
+            continue
+        # bool - подкласс int, но числом в протоколе не считается
+        if not isinstance(value, field_type) or field_type is int and isinstance(value, bool):
+            return f'поле {field} отсутствует или имеет неверный тип'
+    return None
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не более capacity"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, amount=1):
+        """Забрать amount токенов, если они есть"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def full(self, now):
+        """Наполнилась ли корзина к моменту now (неотличима от новой)"""
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class RateLimiter:
+    """Token bucket на пару (пользователь, тип кадра).
+
+    Раз в prune_interval секунд полные корзины удаляются: новая корзина
+    создаётся полной, так что лимит от этого не ослабевает, а словарь не
+    растёт за время жизни сервера.
+    """
+    def __init__(self, limits, prune_interval=60):
+        self.limits = limits
+        self.buckets = {}  # {(username, kind): TokenBucket}
+        self.prune_interval = prune_interval
+        self.pruned = time.monotonic()
+        self.prune_lock = threading.Lock()
+
+    def allow(self, username, kind, amount=1):
+        """Можно ли обработать кадр; тип без своего лимита идёт в default"""
+        if kind not in self.limits:
+            kind = 'default'
+            if kind not in self.limits:
+                return True
         
-        conn.commit()
-        conn.close()
-        print('[БД] База данных инициализирована')
-    
-    def hash_password(self, password):
-        """Хэширование пароля SHA256"""
-        return hashlib.sha256(password.encode()).hexdigest()
-    
-    def register_user(self, username, password):
-        """Регистрация нового пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        if time.monotonic() - self.pruned >= self.prune_interval:
+            self.prune()
         
+        key = (username, kind)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets.setdefault(key, TokenBucket(*self.limits[kind]))
+        return bucket.consume(amount)
+
+    def prune(self):
+        """Удалить полные корзины; вызывает один поток за раз"""
+        if not self.prune_lock.acquire(blocking=False):
+            return
         try:
-            password_hash = self.hash_password(password)
-            cursor.execute(
-                'INSERT INTO users (username, password_hash) VALUES (?, ?)',
-                (username, password_hash)
-            )
-            conn.commit()
-            conn.close()
-            return True, 'Регистрация успешна'
-        except sqlite3.IntegrityError:
-            conn.close()
-            return False, 'Пользователь уже существует'
-        except Exception as e:
-            conn.close()
-            return False, f'Ошибка: {e}'
-    
-    def verify_user(self, username, password):
-        """Проверка логина и пароля"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        password_hash = self.hash_password(password)
-        cursor.execute(
-            'SELECT * FROM users WHERE username = ? AND password_hash = ?',
-            (username, password_hash)
-        )
-        
-        user = cursor.fetchone()
-        conn.close()
-        
-        return user is not None
-    
-    def save_message(self, sender, message, is_private=False, recipient=None):
-        """Сохранение сообщения"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            'INSERT INTO messages (sender, message, is_private, recipient) VALUES (?, ?, ?, ?)',
-            (sender, message, is_private, recipient)
-        )
-        
-        conn.commit()
-        conn.close()
-    
-    def get_messages(self, limit=100, username=None):
-        """Получить сообщения из БД"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        if username:
-            # Получаем только публичные сообщения и ЛС для конкретного пользователя
-            cursor.execute(
-                '''SELECT sender, message, timestamp, is_private, recipient 
-                FROM messages 
-                WHERE is_private = 0 OR recipient = ? OR sender = ?
-                ORDER BY timestamp DESC LIMIT ?''',
-                (username, username, limit)
-            )
-        else:
-            # Получаем только публичные сообщения
-            cursor.execute(
-                'SELECT sender, message, timestamp FROM messages WHERE is_private = 0 ORDER BY timestamp DESC LIMIT ?',
-                (limit,)
-            )
-        
-        messages = cursor.fetchall()
-        conn.close()
-        
-        # Переворачиваем чтобы старые были сверху
-        return list(reversed(messages))
-    
+            now = self.pruned = time.monotonic()
+            for key, bucket in list(self.buckets.items()):
+                if bucket.full(now):
+                    self.buckets.pop(key, None)
+        finally:
+            self.prune_lock.release()
+
+class SocialGraph:
+    """Кэш дружб в памяти: {пользователь: set друзей}.
+
+    Список пользователя загружается из хранилища при первом обращении и
+    живёт, пока он в сети (evict при отключении). add_friendship
+    инвалидирует обе записи; загрузка, начатая до инвалидации, свой
+    результат не кэширует, поэтому устаревший список не задержится.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.adjacency = {}  # {username: set друзей}
+        self.generation = 0
+
+    def friends(self, username):
+        """Множество друзей username (не изменять)"""
+        friends = self.adjacency.get(username)
+        if friends is not None:
+            return friends
+        generation = self.generation
+        friends = set(self.db.get_friends(username))
+        with self.lock:
+            if generation == self.generation:
+                self.adjacency[username] = friends
+        return friends
+
+    def are_friends(self, user1, user2):
+        """Дружат ли user1 и user2; O(1), если один из них в кэше"""
+        friends = self.adjacency.get(user2)
+        if friends is not None:
+            return user1 in friends
+        return user2 in self.friends(user1)
+
+    def online_friends(self, username, online):
+        """Друзья username среди online (множество или dict по имени)"""
+        friends = self.friends(username)
+        if len(friends) > len(online):
+            return [user for user in online if user in friends]
+        return [user for user in friends if user in online]
+
     def add_friendship(self, user1, user2):
-        """Добавить дружбу"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        """Записать дружбу в хранилище; True, если она новая"""
+        added = self.db.add_friendship(user1, user2)
+        self.invalidate(user1, user2)
+        return added
+
+    def invalidate(self, *usernames):
+        with self.lock:
+            self.generation += 1
+            for username in usernames:
+                self.adjacency.pop(username, None)
+
+    def evict(self, username):
+        """Пользователь вышел: его список больше не нужен"""
+        self.invalidate(username)
+
+class TypingCoalescer:
+    """Эфемерные события набора текста, сведённые за тик.
+
+    update() только запоминает последнее состояние пары (пользователь,
+    получатель), поэтому частые события одного отправителя за тик
+    схлопываются в одно. drain() забирает накопленное, сгруппированное по
+    разговорам. В messages ничего не пишется.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # {(username, to): печатает ли}, to=None - общий чат
+
+    def update(self, username, to, active):
+        with self.lock:
+            self.pending[(username, to)] = active
+
+    def drain(self):
+        """Накопленное за тик: (общий чат, {получатель ЛС: состояние})"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        public = {'users': [], 'stopped': []}
+        private = {}
+        for (username, to), active in pending.items():
+            state = public if to is None else private.setdefault(to, {'users': [], 'stopped': []})
+            state['users' if active else 'stopped'].append(username)
+        return public, private
+
+class RetentionJob:
+    """Фоновая компакция messages по политикам хранения.
+
+    Пачка из batch_size устаревших строк выбирается на соединении чтения
+    и дописывается в сжатый архив (JSON lines в gzip), если задан
+    archive_dir; единственный писатель занят только DELETE этой пачки по
+    id, поэтому save_message ждёт компакцию не дольше одного удаления.
+    После компакции свободные страницы возвращаются через incremental_vacuum.
+    """
+    def __init__(self, db, policies, archive_dir=None, interval=RETENTION_INTERVAL, batch_size=RETENTION_BATCH,
+                 pause=RETENTION_PAUSE, metrics=None):
+        self.db = db
+        self.policies = policies
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.metrics = metrics
+        self.stop_event = threading.Event()
+
+    def enabled(self):
+        """Есть ли хоть одно ограничение"""
+        return any(value is not None for policy in self.policies.values() for value in policy.values())
+
+    def run(self):
+        """Цикл фонового потока: компакция раз в interval секунд"""
+        while not self.stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                log.exception('[КОМПАКЦИЯ] Ошибка: %s', e, extra={'event': 'retention_error'})
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run_once(self):
+        """Один проход по всем политикам; возвращает {вид: удалено строк}"""
+        started = time.monotonic()
+        deleted = {}
+        for kind, policy in self.policies.items():
+            deleted[kind] = self.compact(kind == 'private', policy)
+        if any(deleted.values()):
+            self.vacuum()
+        elapsed = time.monotonic() - started
+        if self.metrics:
+            self.metrics.observe('chat_retention_seconds', elapsed)
+        log.info('[КОМПАКЦИЯ] Удалено %s за %.1f с', deleted, elapsed,
+                 extra={'event': 'retention', 'deleted': deleted, 'seconds': round(elapsed, 3)})
+        return deleted
+
+    def compact(self, is_private, policy):
+        """Удалить сообщения вида is_private сверх policy; возвращает число удалённых"""
+        conditions = []
+        params = []
+        upper = None
+        if policy.get('max_age_days') is not None:
+            cutoff = datetime.now(timezone.utc) - timedelta(days=policy['max_age_days'])
+            # timestamp хранится как CURRENT_TIMESTAMP (UTC, 'YYYY-MM-DD HH:MM:SS')
+            cutoff = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+            conditions.append('timestamp < ?')
+            params.append(cutoff)
+            upper = self.age_boundary(is_private, cutoff)
+        if policy.get('max_count') is not None:
+            boundary = self.count_boundary(is_private, policy['max_count'])
+            if boundary is not None:
+                conditions.append('id <= ?')
+                params.append(boundary)
+                upper = max(upper or 0, boundary)
+        if not conditions or upper is None:
+            return 0
+
+        kind = 'private' if is_private else 'public'
+        # Диапазон id ограничен сверху: выборка идёт по индексу (is_private, id)
+        # и не просматривает свежую часть таблицы
+        query = f'''SELECT id, sender, message, timestamp, is_private, recipient FROM messages
+            WHERE is_private = ? AND id > ? AND id <= ? AND ({' OR '.join(conditions)}) ORDER BY id LIMIT ?'''
+        total = 0
+        last_id = 0
+        while not self.stop_event.is_set():
+            # Выборка и архив - на соединении чтения; писатель занят только удалением пачки
+            with self.db.reading() as conn:
+                rows = conn.execute(query, [int(is_private), last_id, upper, *params, self.batch_size]).fetchall()
+            if not rows:
+                break
+            if self.archive_dir:
+                self.archive(kind, rows)
+            ids = [row['id'] for row in rows]
+            with self.db.writing() as conn:
+                conn.execute(f'DELETE FROM messages WHERE id IN ({",".join("?" * len(ids))})', ids)
+            last_id = ids[-1]
+            total += len(rows)
+            if self.metrics:
+                self.metrics.inc('chat_retention_deleted_total', len(rows), kind=kind)
+            if len(rows) < self.batch_size:
+                break
+            time.sleep(self.pause)
+        return total
+
+    def age_boundary(self, is_private, cutoff):
+        """Наибольший id вида старше cutoff; id растут вместе со временем вставки"""
+        with self.db.reading() as conn:
+            row = conn.execute(
+                'SELECT id FROM messages WHERE is_private = ? AND timestamp >= ? ORDER BY id LIMIT 1',
+                (int(is_private), cutoff)
+            ).fetchone()
+            if row is not None:
+                return row['id'] - 1
+            return conn.execute('SELECT MAX(id) FROM messages WHERE is_private = ?', (int(is_private),)).fetchone()[0]
+
+    def count_boundary(self, is_private, max_count):
+        """id, до которого включительно сообщения вида не входят в max_count последних"""
+        with self.db.reading() as conn:
+            row = conn.execute(
+                'SELECT id FROM messages WHERE is_private = ? ORDER BY id DESC LIMIT 1 OFFSET ?',
+                (int(is_private), max_count)
+            ).fetchone()
+        return row['id'] if row else None
+
+    def archive(self, kind, rows):
+        """Дописать пачку в архив дня; gzip в режиме ab добавляет новый член файла"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        day = datetime.now(timezone.utc).strftime('%Y%m%d')
+        path = os.path.join(self.archive_dir, f'messages-{kind}-{day}.jsonl.gz')
+        lines = ''.join(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows)
+        with gzip.open(path, 'ab') as archive:
+            archive.write(lines.encode('utf-8'))
+        if self.metrics:
+            self.metrics.inc('chat_retention_archived_total', len(rows), kind=kind)
+
+    def vacuum(self):
+        """Вернуть свободные страницы небольшими шагами и сбросить WAL"""
+        while not self.stop_event.is_set():
+            with self.db.writing() as conn:
+                free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if not free_pages or conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                    break
+                conn.execute(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})')
+            time.sleep(self.pause)
+        # PASSIVE не ждёт читателей и писателей
+        with self.db.writing() as conn:
+            conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+class Metrics:
+    """Счётчики, гистограммы и gauge в формате Prometheus"""
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}  # {name: {labels: value}}
+        self.histograms = {}  # {name: {labels: [counts, sum, count]}}
+        self.gauges = {}  # {name: callable -> {labels: value}}
+        self.descriptions = {}
+
+    def describe(self, name, text):
+        """Задать описание метрики (# HELP)"""
+        self.descriptions[name] = text
+
+    def inc(self, name, value=1, **labels):
+        """Увеличить счётчик"""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Записать наблюдение в гистограмму"""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Замер длительности блока в секундах"""
+        start = time.perf_counter()
         try:
-            # Сортируем имена чтобы избежать дубликатов
-            users = sorted([user1, user2])
-            cursor.execute(
-                'INSERT INTO friendships (user1, user2) VALUES (?, ?)',
-                (users[0], users[1])
-            )
-            conn.commit()
-            conn.close()
-            return True
-        except sqlite3.IntegrityError:
-            conn.close()
-            return False
-    
-    def get_friends(self, username):
-        """Получить список друзей"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            '''SELECT CASE 
-                WHEN user1 = ? THEN user2 
-                ELSE user1 
-            END as friend
-            FROM friendships 
-            WHERE user1 = ? OR user2 = ?''',
-            (username, username, username)
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, func):
+        """Gauge, вычисляемый при чтении: func() -> число или {labels: число}"""
+        self.gauges[name] = func
+
+    @staticmethod
+    def format_labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        body = ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in pairs
         )
-        
-        friends = [row['friend'] for row in cursor.fetchall()]
-        conn.close()
-        
-        return friends
+        return '{' + body + '}'
+
+    def render(self):
+        """Выгрузка в текстовом формате Prometheus"""
+        lines = []
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {
+                name: {key: (list(state[0]), state[1], state[2]) for key, state in series.items()}
+                for name, series in self.histograms.items()
+            }
+
+        for name, series in sorted(counters.items()):
+            if name in self.descriptions:
+                lines.append(f'# HELP {name} {self.descriptions[name]}')
+            lines.append(f'# TYPE {name} counter')
+            for key, value in series.items():
+                lines.append(f'{name}{self.format_labels(key)} {value}')
+
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            if name in self.descriptions:
+                lines.append(f'# HELP {name} {self.descriptions[name]}')
+            lines.append(f'# TYPE {name} gauge')
+            if isinstance(value, dict):
+                for labels, v in value.items():
+                    lines.append(f'{name}{self.format_labels(tuple(sorted(labels)))} {v}')
+            else:
+                lines.append(f'{name} {value}')
+
+        for name, series in sorted(histograms.items()):
+            if name in self.descriptions:
+                lines.append(f'# HELP {name} {self.descriptions[name]}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, (counts, total, count) in series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{self.format_labels(key, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_bucket{self.format_labels(key, [("le", "+Inf")])} {count}')
+                lines.append(f'{name}_sum{self.format_labels(key)} {total}')
+                lines.append(f'{name}_count{self.format_labels(key)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """HTTP-обработчик /metrics"""
+    metrics = None
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555, voice_port=5556):
+    def __init__(self, host='0.0.0.0', port=5555, voice_port=5556, metrics_port=None,
+                 heartbeat_timeout=HEARTBEAT_TIMEOUT, rate_limits=None, retention=None, archive_dir=None,
+                 storage=None, presence_mode=PRESENCE_MODE):
         self.host = host
         self.port = port
         self.voice_port = voice_port
+        self.metrics_port = metrics_port
+        # Соединение без входящих данных дольше этого времени считается мёртвым
+        self.heartbeat_timeout = heartbeat_timeout
+        self.presence_mode = presence_mode
         self.clients = {}  # {socket: username}
+        self.online = {}  # {username: socket} - текущая сессия пользователя
+        self.online_sorted = []  # имена из online по алфавиту, для страниц who_online
+        self.online_lock = threading.Lock()
         self.voice_clients = {}  # {socket: username}
+        self.voice_send_locks = {}  # {socket: Lock} - пакеты разных говорящих не перемешиваются
+        self.voice_channels = {}  # {канал: {socket: username}} - слушатели канала
+        self.voice_client_channels = {}  # {socket: канал}
+        self.voice_lock = threading.Lock()
+        # Голосовой токен выдаётся текстовой сессией и живёт, пока она открыта
+        self.voice_tokens = {}  # {token: текстовый socket}
+        self.session_tokens = {}  # {текстовый socket: token}
+        self.session_voice = {}  # {текстовый socket: голосовой socket}
         self.server_socket = None
         self.voice_server_socket = None
+        self.metrics_server = None
+        
+        # База данных: любой ChatStorage, по умолчанию SQLite-файл
+        self.db = storage or ChatDatabase()
+        
+        # Кэш дружб пользователей в сети
+        self.social = SocialGraph(self.db)
+        
+        # Защита от флуда
+        self.rate_limiter = RateLimiter(rate_limits or RATE_LIMITS)
+        
+        # Обработчики кадров: {тип: (handler, схема)}
+        self.handlers = {}
+        self.register_handlers()
+        
+        # Метрики
+        self.metrics = Metrics()
+        self.init_metrics()
         
-        # База данных
-        self.db = ChatDatabase()
+        # Ожидание соединений хранилища попадает в метрики сервера
+        self.db.metrics = self.metrics
+        
+        # Индикаторы набора текста, рассылаются раз в TYPING_TICK
+        self.typing = TypingCoalescer()
+        
+        # Фоновая компакция истории
+        self.retention = RetentionJob(self.db, retention or RETENTION_POLICIES, archive_dir, metrics=self.metrics)
+
+    def init_metrics(self):
+        """Описание метрик сервера"""
+        m = self.metrics
+        m.describe('chat_connections_total', 'Принятые подключения')
+        m.describe('chat_frames_in_total', 'Полученные кадры по типу')
+        m.describe('chat_frames_out_total', 'Отправленные кадры по типу')
+        m.describe('chat_bytes_in_total', 'Полученные байты')
+        m.describe('chat_bytes_out_total', 'Отправленные байты')
+        m.describe('chat_voice_packets_relayed_total', 'Голосовые пакеты, доставленные слушателям')
+        m.describe('chat_voice_packets_dropped_total', 'Голосовые пакеты, не доставленные слушателям')
+        m.describe('chat_broadcast_seconds', 'Время рассылки broadcast')
+        m.describe('chat_voice_broadcast_seconds', 'Время рассылки голосового пакета')
+        m.describe('chat_db_save_message_seconds', 'Задержка save_message')
+        m.describe('chat_db_get_messages_seconds', 'Задержка get_messages')
+        m.describe('chat_db_search_seconds', 'Задержка полнотекстового поиска')
+        m.describe('chat_db_read_wait_seconds', 'Ожидание соединения пула чтения')
+        m.describe('chat_db_write_wait_seconds', 'Ожидание единственного писателя')
+        m.describe('chat_retention_deleted_total', 'Сообщения, удалённые политикой хранения')
+        m.describe('chat_retention_archived_total', 'Сообщения, записанные в архив')
+        m.describe('chat_retention_seconds', 'Длительность прохода компакции')
+        m.describe('chat_typing_flush_seconds', 'Время рассылки индикаторов набора за тик')
+        m.describe('chat_idle_reaped_total', 'Соединения, закрытые по таймауту heartbeat')
+        m.describe('chat_rate_limited_total', 'Кадры, отклонённые лимитом')
+        m.describe('chat_frames_invalid_total', 'Отклонённые некорректные кадры')
+        m.describe('chat_handler_seconds', 'Время обработчика кадра по типу')
+        m.describe('chat_handler_errors_total', 'Исключения в обработчиках кадров')
+        m.describe('chat_clients', 'Подключённые клиенты')
+        m.gauge('chat_clients', lambda: {
+            (('kind', 'text'),): len(self.clients),
+            (('kind', 'voice'),): len(self.voice_clients),
+        })
+        m.describe('chat_voice_channels', 'Голосовые каналы с участниками')
+        m.gauge('chat_voice_channels', lambda: {(): len(self.voice_channels)})
+
+    def start_metrics_server(self):
+        """Запуск локального HTTP-эндпоинта /metrics"""
+        handler = type('BoundMetricsHandler', (MetricsHandler,), {'metrics': self.metrics})
+        self.metrics_server = ThreadingHTTPServer(('127.0.0.1', self.metrics_port), handler)
+        self.metrics_server.daemon_threads = True
+        threading.Thread(target=self.metrics_server.serve_forever, daemon=True).start()
+        log.info('[МЕТРИКИ] http://127.0.0.1:%s/metrics', self.metrics_port,
+                 extra={'event': 'metrics_start', 'port': self.metrics_port})
 
     def start(self):
         """Запуск серверов"""
@@ -199,23 +638,38 @@ class ChatServer:
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
-        print(f'[ТЕКСТОВЫЙ СЕРВЕР] Запущен на {self.host}:{self.port}')
+        log.info('[ТЕКСТОВЫЙ СЕРВЕР] Запущен на %s:%s', self.host, self.port,
+                 extra={'event': 'server_start', 'kind': 'text', 'host': self.host, 'port': self.port})
         
         self.voice_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.voice_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.voice_server_socket.bind((self.host, self.voice_port))
         self.voice_server_socket.listen(5)
-        print(f'[ГОЛОСОВОЙ СЕРВЕР] Запущен на {self.host}:{self.voice_port}')
+        log.info('[ГОЛОСОВОЙ СЕРВЕР] Запущен на %s:%s', self.host, self.voice_port,
+                 extra={'event': 'server_start', 'kind': 'voice', 'host': self.host, 'port': self.voice_port})
+        
+        if self.metrics_port:
+            self.start_metrics_server()
         
         threading.Thread(target=self.accept_voice_connections, daemon=True).start()
+        threading.Thread(target=self.run_typing, daemon=True, name='typing').start()
+        if self.retention.enabled():
+            if self.db.supports_retention:
+                threading.Thread(target=self.retention.run, daemon=True, name='retention').start()
+            else:
+                log.warning('[КОМПАКЦИЯ] %s не поддерживает компакцию, политика хранения не применяется',
+                            type(self.db).__name__, extra={'event': 'retention_unsupported',
+                                                           'backend': type(self.db).__name__})
         
         while True:
             try:
                 client_socket, address = self.server_socket.accept()
-                print(f'[ПОДКЛЮЧЕНИЕ] {address}')
+                self.metrics.inc('chat_connections_total', kind='text')
+                log.info('[ПОДКЛЮЧЕНИЕ] %s', address, extra={'event': 'connect', 'kind': 'text', 'address': address[0]})
+                self.configure_client_socket(client_socket)
                 threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
             except Exception as e:
-                print(f'[ОШИБКА] {e}')
+                log.error('[ОШИБКА] %s', e, extra={'event': 'accept_error', 'kind': 'text'})
                 break
 
     def accept_voice_connections(self):
@@ -223,72 +677,239 @@ class ChatServer:
         while True:
             try:
                 voice_socket, address = self.voice_server_socket.accept()
-                print(f'[ГОЛОСОВОЕ ПОДКЛЮЧЕНИЕ] {address}')
+                self.metrics.inc('chat_connections_total', kind='voice')
+                log.info('[ГОЛОСОВОЕ ПОДКЛЮЧЕНИЕ] %s', address, extra={'event': 'connect', 'kind': 'voice', 'address': address[0]})
+                self.configure_client_socket(voice_socket)
                 threading.Thread(target=self.handle_voice_client, args=(voice_socket,), daemon=True).start()
             except Exception as e:
-                print(f'[ОШИБКА ГОЛОСОВОГО СЕРВЕРА] {e}')
+                log.error('[ОШИБКА ГОЛОСОВОГО СЕРВЕРА] %s', e, extra={'event': 'accept_error', 'kind': 'voice'})
                 break
 
-    def recv_exact(self, sock, num_bytes):
-        """Получить точное количество байт"""
-        data = b''
-        while len(data) < num_bytes:
-            try:
-                packet = sock.recv(num_bytes - len(data))
-                if not packet:
-                    return None
-                data += packet
-            except:
-                return None
-        return data
+    def configure_client_socket(self, sock):
+        """TCP keepalive и таймаут простоя для принятого соединения"""
+        enable_keepalive(sock, user_timeout=self.heartbeat_timeout)
+        # recv без данных дольше heartbeat_timeout бросает socket.timeout,
+        # и поток-обработчик сам закрывает мёртвую сессию
+        sock.settimeout(self.heartbeat_timeout)
 
     def handle_voice_client(self, voice_socket):
         """Обработка голосового клиента"""
         username = None
+        client_socket = None
         try:
-            data = voice_socket.recv(1024).decode('utf-8')
-            message = json.loads(data)
-            if message['type'] == 'voice_join':
-                username = message['username']
-                self.voice_clients[voice_socket] = username
-                print(f'[ГОЛОС] {username} подключился')
+            message = recv_handshake(voice_socket)
+            if message is None:
+                return
+            error = validate_frame(message, FRAME_SCHEMAS['voice_join']) if message.get('type') == 'voice_join' \
+                else 'ожидался voice_join'
+            channel = message.get('channel')
+            if not error and not 0 < len(channel) <= MAX_VOICE_CHANNEL_LENGTH:
+                error = 'недопустимое имя канала'
+            if not error:
+                client_socket = self.voice_tokens.get(message['token'])
+                username = self.clients.get(client_socket)
+                if username is None:
+                    error = 'недействительный голосовой токен'
+            if error:
+                self.metrics.inc('chat_frames_invalid_total', type='voice_join')
+                log.info('[ГОЛОС] Рукопожатие отклонено: %s', error, extra={'event': 'voice_handshake_rejected', 'reason': error})
+                voice_socket.sendall(pack_handshake({'type': 'voice_reject', 'message': error}))
+                return
+            
+            # Голосовой сокет привязан к текстовой сессии: прежний закрываем
+            self.attach_voice_session(client_socket, voice_socket)
+            if client_socket not in self.clients:
+                # Текстовая сессия закрылась во время рукопожатия
+                return
+            self.voice_send_locks[voice_socket] = threading.Lock()
+            self.send_voice(voice_socket, pack_handshake({'type': 'voice_accept', 'username': username, 'channel': channel}))
+            self.join_voice_channel(voice_socket, username, channel)
+            # Пересылаемые кадры помечаются именем говорящего для микширования на клиенте;
+            # тело читается сразу за заголовком и уходит слушателям без копирования
+            reader = FrameReader(voice_socket, MAX_VOICE_FRAME, prefix=speaker_header(username))
             
             while True:
-                length_bytes = self.recv_exact(voice_socket, 4)
-                if not length_bytes:
+                length = reader.read()
+                if length is None:
                     break
                     
-                length = int.from_bytes(length_bytes, 'big')
-                audio_data = self.recv_exact(voice_socket, length)
-                if not audio_data:
-                    break
+                if length == 0:
+                    # Ping - отвечаем пустым кадром только отправителю
+                    self.send_voice(voice_socket, VOICE_PING)
+                    continue
+                
+                self.metrics.inc('chat_frames_in_total', type='voice')
+                self.metrics.inc('chat_bytes_in_total', 4 + length, kind='voice')
+                if not self.rate_limiter.allow(username, 'voice_bytes', length):
+                    self.metrics.inc('chat_rate_limited_total', type='voice')
+                    continue
                 
-                self.broadcast_voice(length_bytes + audio_data, exclude=voice_socket)
+                self.broadcast_voice(reader.relay_frame(), channel, exclude=voice_socket)
                 
+        except socket.timeout:
+            self.metrics.inc('chat_idle_reaped_total', kind='voice')
+            log.info('[ГОЛОС] %s не отвечает', username, extra={'event': 'idle_timeout', 'kind': 'voice', 'username': username})
         except Exception as e:
-            print(f'[ОШИБКА ГОЛОСОВОГО КЛИЕНТА] {e}')
+            log.warning('[ОШИБКА ГОЛОСОВОГО КЛИЕНТА] %s', e, extra={'event': 'voice_client_error', 'username': username})
         finally:
             if voice_socket in self.voice_clients:
-                username = self.voice_clients[voice_socket]
-                del self.voice_clients[voice_socket]
-                try:
-                    voice_socket.close()
-                except:
-                    pass
-                print(f'[ГОЛОС] {username} отключился')
+                self.leave_voice_channel(voice_socket)
+                self.voice_send_locks.pop(voice_socket, None)
+            if client_socket is not None and self.session_voice.get(client_socket) is voice_socket:
+                del self.session_voice[client_socket]
+            try:
+                voice_socket.close()
+            except:
+                pass
+
+    def issue_voice_token(self, client_socket):
+        """Выдать текстовой сессии токен для голосового канала"""
+        token = secrets.token_urlsafe(24)
+        self.voice_tokens[token] = client_socket
+        self.session_tokens[client_socket] = token
+        self.send_json(client_socket, {'type': 'voice_token', 'token': token})
+
+    def attach_voice_session(self, client_socket, voice_socket):
+        """Привязать голосовой сокет к текстовой сессии (один на сессию)"""
+        previous = self.session_voice.get(client_socket)
+        self.session_voice[client_socket] = voice_socket
+        if previous is not None and previous is not voice_socket:
+            try:
+                previous.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close_voice_session(self, client_socket):
+        """Отозвать токен и закрыть голос завершённой текстовой сессии"""
+        token = self.session_tokens.pop(client_socket, None)
+        self.voice_tokens.pop(token, None)
+        voice_socket = self.session_voice.pop(client_socket, None)
+        if voice_socket is not None:
+            try:
+                voice_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def join_voice_channel(self, voice_socket, username, channel):
+        """Добавить слушателя в голосовой канал и оповестить о входе"""
+        with self.voice_lock:
+            self.voice_clients[voice_socket] = username
+            self.voice_client_channels[voice_socket] = channel
+            listeners = self.voice_channels.setdefault(channel, {})
+            listeners[voice_socket] = username
+            members = sorted(listeners.values())
+        log.info('[ГОЛОС] %s подключился к каналу %s', username, channel,
+                 extra={'event': 'voice_join', 'username': username, 'channel': channel})
+        self.send_voice_presence('join', username, channel, members)
+
+    def leave_voice_channel(self, voice_socket):
+        """Убрать слушателя из канала; пустой канал удаляется"""
+        with self.voice_lock:
+            username = self.voice_clients.pop(voice_socket, None)
+            channel = self.voice_client_channels.pop(voice_socket, None)
+            listeners = self.voice_channels.get(channel, {})
+            listeners.pop(voice_socket, None)
+            if not listeners:
+                self.voice_channels.pop(channel, None)
+            members = sorted(listeners.values())
+        log.info('[ГОЛОС] %s покинул канал %s', username, channel,
+                 extra={'event': 'voice_leave', 'username': username, 'channel': channel})
+        self.send_voice_presence('leave', username, channel, members)
+
+    def get_voice_channels(self):
+        """Участники голосовых каналов: {канал: [имена]}"""
+        with self.voice_lock:
+            return {channel: sorted(listeners.values()) for channel, listeners in self.voice_channels.items()}
+
+    def send_voice_presence(self, action, username, channel, members):
+        """Оповестить текстовых клиентов о входе/выходе из голосового канала"""
+        message = {
+            'type': 'voice_presence',
+            'action': action,
+            'username': username,
+            'channel': channel,
+            'members': members
+        }
+        if self.presence_mode == 'broadcast':
+            self.broadcast(message)
+            return
+        
+        # Участники канала, сам пользователь и его друзья
+        recipients = {self.online.get(member) for member in (*members, username)}
+        recipients.update(self.presence_recipients(username))
+        recipients.discard(None)
+        self.send_many(recipients, message)
 
     def get_socket_by_username(self, username):
         """Найти сокет по имени пользователя"""
-        for sock, user in self.clients.items():
-            if user == username:
-                return sock
-        return None
+        return self.online.get(username)
+
+    def add_session(self, client_socket, username):
+        """Новая сессия пользователя заменяет предыдущую в индексе online"""
+        self.close_previous_session(username)
+        with self.online_lock:
+            self.clients[client_socket] = username
+            if username not in self.online:
+                bisect.insort(self.online_sorted, username)
+            self.online[username] = client_socket
+
+    def remove_session(self, client_socket):
+        """Убрать сессию; False, если её уже нет. Пользователь выходит из
+        online, только если это его текущая сессия"""
+        with self.online_lock:
+            username = self.clients.pop(client_socket, None)
+            if username is None:
+                return False
+            if self.online.get(username) is client_socket:
+                del self.online[username]
+                del self.online_sorted[bisect.bisect_left(self.online_sorted, username)]
+        return True
+
+    def presence_recipients(self, username):
+        """Сокеты друзей username в сети"""
+        recipients = []
+        for friend in self.social.online_friends(username, self.online):
+            sock = self.online.get(friend)
+            if sock is not None:
+                recipients.append(sock)
+        return recipients
+
+    def announce_presence(self, client_socket, username, online):
+        """Сообщить о входе или выходе username"""
+        if self.presence_mode == 'broadcast':
+            action = 'присоединился к чату' if online else 'покинул чат'
+            self.broadcast({
+                'type': 'system',
+                'message': f'{username} {action}',
+                'timestamp': datetime.now().strftime('%H:%M:%S')
+            }, exclude=client_socket)
+            self.send_user_list()
+            return
+        
+        # Старая сессия закрылась после входа новой: пользователь в сети
+        if not online and username in self.online:
+            return
+        self.send_many(self.presence_recipients(username), {
+            'type': 'presence',
+            'username': username,
+            'online': online,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        })
+
+    def close_previous_session(self, username):
+        """Закрыть предыдущую текстовую сессию пользователя (переподключение)"""
+        old_socket = self.get_socket_by_username(username)
+        if old_socket:
+            try:
+                old_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def handle_client(self, client_socket):
         """Обработка текстового клиента с буферизацией"""
         username = None
         buffer = b""
-        separator = b'\n###END###\n'
+        separator = SEPARATOR
         
         try:
             # Получаем первое сообщение (login/register/join)
@@ -296,69 +917,74 @@ class ChatServer:
                 data = client_socket.recv(4096)
                 if not data:
                     return
+                self.metrics.inc('chat_bytes_in_total', len(data), kind='text')
                 buffer += data
             
             message_data, buffer = buffer.split(separator, 1)
             message = json.loads(message_data.decode('utf-8'))
+            kind = message.get('type') if isinstance(message, dict) else None
+            if kind not in ('login', 'register') or validate_frame(message, FRAME_SCHEMAS[kind]):
+                client_socket.close()
+                return
+            self.metrics.inc('chat_frames_in_total', type=kind)
             
             # Обработка регистрации
             if message['type'] == 'register':
                 success, msg = self.db.register_user(message['username'], message['password'])
-                response = json.dumps({
+                self.send_json(client_socket, {
                     'type': 'register_response',
                     'success': success,
                     'message': msg
-                }) + '\n###END###\n'
-                client_socket.send(response.encode('utf-8'))
+                })
                 
                 if not success:
                     client_socket.close()
                     return
                 
                 username = message['username']
-                self.clients[client_socket] = username
-                print(f'[РЕГИСТРАЦИЯ] {username}')
+                self.add_session(client_socket, username)
+                log.info('[РЕГИСТРАЦИЯ] %s', username, extra={'event': 'register', 'username': username})
                 
             # Обработка входа
             elif message['type'] == 'login':
                 if self.db.verify_user(message['username'], message['password']):
                     username = message['username']
-                    self.clients[client_socket] = username
+                    self.add_session(client_socket, username)
                     
-                    response = json.dumps({
+                    self.send_json(client_socket, {
                         'type': 'login_response',
                         'success': True,
                         'message': 'Успешный вход'
-                    }) + '\n###END###\n'
-                    client_socket.send(response.encode('utf-8'))
+                    })
                     
-                    print(f'[ВХОД] {username}')
+                    log.info('[ВХОД] %s', username, extra={'event': 'login', 'username': username})
                 else:
-                    response = json.dumps({
+                    self.send_json(client_socket, {
                         'type': 'login_response',
                         'success': False,
                         'message': 'Неверный логин или пароль'
-                    }) + '\n###END###\n'
-                    client_socket.send(response.encode('utf-8'))
+                    })
                     client_socket.close()
                     return
-            else:
-                client_socket.close()
-                return
             
-            # Отправляем историю сообщений
-            self.send_message_history(client_socket, username)
+            # Токен для подключения к голосовому каналу
+            self.issue_voice_token(client_socket)
             
-            # Уведомляем всех о новом пользователе
-            self.broadcast({
-                'type': 'system',
-                'message': f'{username} присоединился к чату',
-                'timestamp': datetime.now().strftime('%H:%M:%S')
-            }, exclude=client_socket)
+            # Отправляем историю сообщений: клиенту с кэшем - только новее since
+            self.send_message_history(client_socket, username, message.get('since'))
             
-            # Отправляем список пользователей и друзей
-            self.send_user_list()
+            # События, накопленные пока пользователь был не в сети
+            self.deliver_offline(client_socket, username)
+            
+            # Уведомляем друзей (или всех) о новом пользователе
+            self.announce_presence(client_socket, username, True)
+            
+            # Отправляем список друзей и голосовых каналов
             self.send_friends_list(client_socket, username)
+            self.send_json(client_socket, {
+                'type': 'voice_channels',
+                'channels': self.get_voice_channels()
+            })
             
             # Обработка сообщений
             while True:
@@ -366,6 +992,7 @@ class ChatServer:
                 if not data:
                     break
                 
+                self.metrics.inc('chat_bytes_in_total', len(data), kind='text')
                 buffer += data
                 
                 while separator in buffer:
@@ -373,209 +1000,514 @@ class ChatServer:
                     
                     try:
                         message = json.loads(message_data.decode('utf-8'))
+                    except ValueError as e:
+                        self.reject_frame(client_socket, username, 'invalid', f'некорректный JSON: {e}')
+                        continue
+                    
+                    if not isinstance(message, dict) or not isinstance(message.get('type'), str):
+                        self.reject_frame(client_socket, username, 'invalid', 'кадр должен быть объектом с полем type')
+                        continue
+                    
+                    kind = message['type']
+                    # Неизвестные типы не порождают новых серий метрик
+                    label = kind if kind in self.handlers else 'unknown'
+                    self.metrics.inc('chat_frames_in_total', type=label)
+                    
+                    if not self.rate_limiter.allow(username, kind):
+                        self.reject_rate_limited(client_socket, username, label)
+                        continue
+                    
+                    self.dispatch(client_socket, username, message)
                         
-                        if message['type'] == 'message':
-                            # Сохраняем в БД
-                            self.db.save_message(username, message['message'])
-                            
-                            self.broadcast({
-                                'type': 'message',
-                                'username': username,
-                                'message': message['message'],
-                                'timestamp': datetime.now().strftime('%H:%M:%S')
-                            })
-                        
-                        elif message['type'] == 'private_message':
-                            # Сохраняем ЛС в БД
-                            self.db.save_message(
-                                username, 
-                                message['message'], 
-                                is_private=True, 
-                                recipient=message['to']
-                            )
-                            self.handle_private_message(username, message)
-                        
-                        elif message['type'] == 'friend_request':
-                            self.handle_friend_request(username, message['to'])
-                        
-                        elif message['type'] == 'friend_response':
-                            self.handle_friend_response(username, message['to'], message['accepted'])
-                            
-                    except json.JSONDecodeError as e:
-                        print(f'[ОШИБКА JSON] {e}')
-                        
+        except socket.timeout:
+            self.metrics.inc('chat_idle_reaped_total', kind='text')
+            log.info('[КЛИЕНТ] %s не отвечает', username, extra={'event': 'idle_timeout', 'kind': 'text', 'username': username})
         except Exception as e:
-            print(f'[ОШИБКА КЛИЕНТА] {e}')
+            log.warning('[ОШИБКА КЛИЕНТА] %s', e, extra={'event': 'client_error', 'username': username})
         finally:
-            if client_socket in self.clients:
-                username = self.clients[client_socket]
-                del self.clients[client_socket]
+            self.close_voice_session(client_socket)
+            if self.remove_session(client_socket):
                 try:
                     client_socket.close()
                 except:
                     pass
                 
-                self.broadcast({
-                    'type': 'system',
-                    'message': f'{username} покинул чат',
-                    'timestamp': datetime.now().strftime('%H:%M:%S')
-                })
-                self.send_user_list()
-                print(f'[КЛИЕНТ] {username} отключился')
+                self.announce_presence(client_socket, username, False)
+                if username not in self.online:
+                    self.social.evict(username)
+                log.info('[КЛИЕНТ] %s отключился', username, extra={'event': 'disconnect', 'username': username})
 
-    def send_message_history(self, client_socket, username):
-        """Отправить историю сообщений"""
-        messages = self.db.get_messages(limit=50, username=username)
+    def register_handler(self, kind, handler, schema=None):
+        """Зарегистрировать обработчик кадра: handler(client_socket, username, message)"""
+        if schema is None:
+            schema = FRAME_SCHEMAS.get(kind, {})
+        self.handlers[kind] = (handler, schema)
+
+    def register_handlers(self):
+        """Обработчики кадров после входа"""
+        self.register_handler('message', self.on_message)
+        self.register_handler('private_message', self.on_private_message)
+        self.register_handler('friend_request', self.on_friend_request)
+        self.register_handler('friend_response', self.on_friend_response)
+        self.register_handler('ping', self.on_ping)
+        self.register_handler('history', self.on_history)
+        self.register_handler('search', self.on_search)
+        self.register_handler('who_online', self.on_who_online)
+        self.register_handler('typing', self.on_typing)
+
+    def dispatch(self, client_socket, username, message):
+        """Проверить кадр по схеме и вызвать обработчик его типа"""
+        kind = message.get('type')
+        entry = self.handlers.get(kind)
+        if entry is None:
+            self.reject_frame(client_socket, username, 'unknown', f'неизвестный тип кадра: {kind}')
+            return
+        
+        handler, schema = entry
+        error = validate_frame(message, schema)
+        if error:
+            self.reject_frame(client_socket, username, kind, error)
+            return
+        
+        # Ошибка обработчика не должна рвать соединение
+        try:
+            with self.metrics.timer('chat_handler_seconds', type=kind):
+                handler(client_socket, username, message)
+        except Exception as e:
+            self.metrics.inc('chat_handler_errors_total', type=kind)
+            log.exception('[ОШИБКА ОБРАБОТЧИКА] %s: %s', kind, e,
+                          extra={'event': 'handler_error', 'type': kind, 'username': username})
+
+    def on_message(self, client_socket, username, message):
+        """Сообщение в общий чат"""
+        # Сохраняем в БД
+        with self.metrics.timer('chat_db_save_message_seconds'):
+            message_id = self.db.save_message(username, message['message'])
+        
+        self.broadcast({
+            'type': 'message',
+            'id': message_id,
+            'username': username,
+            'message': message['message'],
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        })
+
+    def on_private_message(self, client_socket, username, message):
+        """Личное сообщение"""
+        # Сохраняем ЛС в БД
+        with self.metrics.timer('chat_db_save_message_seconds'):
+            message_id = self.db.save_message(
+                username, 
+                message['message'], 
+                is_private=True, 
+                recipient=message['to']
+            )
+        self.handle_private_message(username, message, message_id)
+        
+        # Отправителю - подтверждение с id, чтобы ЛС попало в его локальный кэш
+        self.send_json(client_socket, {
+            'type': 'private_message_sent',
+            'id': message_id,
+            'to': message['to'],
+            'message': message['message'],
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        })
+
+    def on_friend_request(self, client_socket, username, message):
+        """Запрос в друзья"""
+        self.handle_friend_request(username, message['to'])
+
+    def on_friend_response(self, client_socket, username, message):
+        """Ответ на запрос в друзья"""
+        self.handle_friend_response(username, message['to'], message['accepted'])
+
+    def on_ping(self, client_socket, username, message):
+        """Heartbeat"""
+        self.send_json(client_socket, {'type': 'pong'})
+
+    def send_notice(self, client_socket, username, message):
+        """Служебный ответ клиенту; во время флуда не чаще лимита error_notice"""
+        if self.rate_limiter.allow(username, 'error_notice'):
+            try:
+                self.send_json(client_socket, message)
+            except:
+                pass
+
+    def reject_frame(self, client_socket, username, kind, error):
+        """Отклонить некорректный кадр, не разрывая соединение"""
+        self.metrics.inc('chat_frames_invalid_total', type=kind)
+        log.warning('[НЕКОРРЕКТНЫЙ КАДР] %s: %s', kind, error,
+                    extra={'event': 'bad_frame', 'type': kind, 'username': username})
+        self.send_notice(client_socket, username, {'type': 'error', 'for': kind, 'message': error})
+
+    def reject_rate_limited(self, client_socket, username, kind):
+        """Отклонить кадр сверх лимита"""
+        self.metrics.inc('chat_rate_limited_total', type=kind)
+        # Лишний индикатор набора отбрасывается молча: клиенту тут нечего показать
+        if kind == 'typing':
+            return
+        self.send_notice(client_socket, username, {'type': 'rate_limited', 'for': kind})
+
+    def send_message_history(self, client_socket, username, since=None):
+        """Отправить историю сообщений: последние 50 или дельту после since"""
+        with self.metrics.timer('chat_db_get_messages_seconds'):
+            if since is None:
+                messages = self.db.get_messages(limit=50, username=username)
+            else:
+                messages = self.db.get_messages(limit=MAX_SYNC_MESSAGES + 1, username=username, after_id=since)
+        
+        # Дельта слишком длинная - кэш клиента устарел, выдаём последние 50 заново
+        reset = since is None or len(messages) > MAX_SYNC_MESSAGES
+        if reset and since is not None:
+            messages = messages[-50:]
+        try:
+            self.send_json(client_socket, {'type': 'history_sync', 'since': since, 'reset': reset, 'count': len(messages)})
+        except:
+            pass
         
         for msg in messages:
             if msg['is_private'] == 0:
                 # Публичное сообщение
-                history_msg = json.dumps({
+                history_msg = {
                     'type': 'message',
+                    'id': msg['id'],
                     'username': msg['sender'],
                     'message': msg['message'],
                     'timestamp': msg['timestamp']
-                }) + '\n###END###\n'
+                }
             else:
                 # Личное сообщение
                 if msg['recipient'] == username:
                     # Входящее ЛС
-                    history_msg = json.dumps({
+                    history_msg = {
                         'type': 'private_message',
+                        'id': msg['id'],
                         'from': msg['sender'],
                         'message': msg['message'],
                         'timestamp': msg['timestamp']
-                    }) + '\n###END###\n'
+                    }
                 else:
                     # Исходящее ЛС
-                    history_msg = json.dumps({
+                    history_msg = {
                         'type': 'private_message_sent',
+                        'id': msg['id'],
                         'to': msg['recipient'],
                         'message': msg['message'],
                         'timestamp': msg['timestamp']
-                    }) + '\n###END###\n'
+                    }
             
             try:
-                client_socket.send(history_msg.encode('utf-8'))
+                self.send_json(client_socket, history_msg)
             except:
                 pass
 
-    def handle_private_message(self, from_user, message):
+    def on_history(self, client_socket, username, message):
+        """Страница более старой истории общего чата или ЛС"""
+        before = message.get('before')
+        peer = message.get('with')
+        limit = message.get('limit')
+        limit = 50 if limit is None else max(1, min(limit, MAX_HISTORY_PAGE))
+        
+        with self.metrics.timer('chat_db_get_messages_seconds'):
+            messages = self.db.get_history(username, peer, before, limit)
+        
+        self.send_json(client_socket, {
+            'type': 'history',
+            'with': peer,
+            'before': before,
+            'complete': len(messages) < limit,
+            'messages': [{
+                'id': msg['id'],
+                'username': msg['sender'],
+                'message': msg['message'],
+                'timestamp': msg['timestamp']
+            } for msg in messages]
+        })
+
+    def on_search(self, client_socket, username, message):
+        """Полнотекстовый поиск по истории, страницы от новых к старым"""
+        query = message['query'].strip()
+        before = message.get('before')
+        peer = message.get('with')
+        limit = message.get('limit')
+        if not query or len(query) > MAX_SEARCH_QUERY:
+            self.reject_frame(client_socket, username, 'search', 'пустой или слишком длинный запрос')
+            return
+        if not self.db.search_enabled:
+            self.reject_frame(client_socket, username, 'search', 'поиск недоступен на этом сервере')
+            return
+        limit = 20 if limit is None else max(1, min(limit, MAX_SEARCH_PAGE))
+        
+        with self.metrics.timer('chat_db_search_seconds'):
+            messages = self.db.search_messages(username, query, peer, before, limit)
+        
+        self.send_json(client_socket, {
+            'type': 'search_results',
+            'query': query,
+            'with': peer,
+            'before': before,
+            'complete': len(messages) < limit,
+            'messages': [{
+                'id': msg['id'],
+                'username': msg['sender'],
+                'message': msg['message'],
+                'timestamp': msg['timestamp'],
+                # Собеседник для ЛС, None - общий чат
+                'chat': (msg['recipient'] if msg['sender'] == username else msg['sender']) if msg['is_private'] else None
+            } for msg in messages]
+        })
+
+    def on_typing(self, client_socket, username, message):
+        """Пользователь печатает в общем чате (to=None) или в ЛС; active=False - перестал"""
+        to = message.get('to')
+        if to == username:
+            return
+        self.typing.update(username, to, message.get('active') is not False)
+
+    def run_typing(self):
+        """Рассылка индикаторов набора раз в TYPING_TICK"""
+        while True:
+            time.sleep(TYPING_TICK)
+            try:
+                self.flush_typing()
+            except Exception as e:
+                log.warning('[НАБОР] %s', e, extra={'event': 'typing_error'})
+
+    def flush_typing(self):
+        """Один кадр typing на разговор: общий чат - всем, ЛС - получателю"""
+        public, private = self.typing.drain()
+        if not public['users'] and not public['stopped'] and not private:
+            return
+        with self.metrics.timer('chat_typing_flush_seconds'):
+            if public['users'] or public['stopped']:
+                self.send_many(list(self.clients), self.typing_frame(None, public))
+            for to, state in private.items():
+                sock = self.online.get(to)
+                if sock is not None:
+                    self.send_many((sock,), self.typing_frame(to, state))
+
+    @staticmethod
+    def typing_frame(to, state):
+        """Кадр typing; chat - 'public' или 'private' (имена в users - собеседники)"""
+        users = state['users']
+        return {
+            'type': 'typing',
+            'chat': 'public' if to is None else 'private',
+            'users': users[:MAX_TYPING_USERS],
+            'stopped': state['stopped'][:MAX_TYPING_USERS],
+            'more': max(0, len(users) - MAX_TYPING_USERS)
+        }
+
+    def on_who_online(self, client_socket, username, message):
+        """Страница списка пользователей в сети по алфавиту, после after"""
+        after = message.get('after')
+        limit = message.get('limit')
+        limit = MAX_WHO_ONLINE_PAGE if limit is None else max(1, min(limit, MAX_WHO_ONLINE_PAGE))
+        
+        with self.online_lock:
+            users = self.online_sorted
+            start = bisect.bisect_right(users, after) if after is not None else 0
+            page = users[start:start + limit]
+            total = len(users)
+        self.send_json(client_socket, {
+            'type': 'who_online',
+            'after': after,
+            'users': page,
+            'total': total,
+            'complete': start + limit >= total
+        })
+
+    def handle_private_message(self, from_user, message, message_id=None):
         """Обработка личного сообщения"""
         to_user = message['to']
         to_socket = self.get_socket_by_username(to_user)
         
         if to_socket:
             try:
-                pm = (json.dumps({
+                self.send_json(to_socket, {
                     'type': 'private_message',
+                    'id': message_id,
                     'from': from_user,
                     'message': message['message'],
                     'timestamp': datetime.now().strftime('%H:%M:%S')
-                }) + '\n###END###\n').encode('utf-8')
-                to_socket.send(pm)
-                print(f'[ЛС] {from_user} -> {to_user}: {message["message"][:30]}...')
+                })
+                log.debug('[ЛС] %s -> %s', from_user, to_user, extra={
+                    'event': 'private_message', 'from': from_user, 'to': to_user, 'length': len(message['message'])
+                })
             except Exception as e:
-                print(f'[ОШИБКА ЛС] {e}')
+                log.warning('[ОШИБКА ЛС] %s', e, extra={'event': 'private_message_error', 'to': to_user})
         else:
             from_socket = self.get_socket_by_username(from_user)
             if from_socket:
                 try:
-                    error_msg = (json.dumps({
+                    self.send_json(from_socket, {
                         'type': 'system',
                         'message': f'{to_user} сейчас оффлайн (сообщение сохранено)'
-                    }) + '\n###END###\n').encode('utf-8')
-                    from_socket.send(error_msg)
+                    })
                 except:
                     pass
 
     def handle_friend_request(self, from_user, to_user):
         """Обработка запроса в друзья"""
-        to_socket = self.get_socket_by_username(to_user)
+        if to_user == from_user or self.social.are_friends(from_user, to_user):
+            return
+        
+        # Встречный запрос: обе стороны хотят дружить
+        if self.db.remove_friend_request(to_user, from_user):
+            self.add_friendship(from_user, to_user)
+            return
         
+        # Повторный запрос и запрос несуществующему пользователю никуда не отправляются
+        if not self.db.add_friend_request(from_user, to_user, time.time() + FRIEND_REQUEST_TTL):
+            return
+        
+        # Не в сети - запрос придёт при входе вместе со списком друзей
+        to_socket = self.get_socket_by_username(to_user)
         if to_socket:
             try:
-                request = (json.dumps({
+                self.send_json(to_socket, {
                     'type': 'friend_request',
                     'from': from_user
-                }) + '\n###END###\n').encode('utf-8')
-                to_socket.send(request)
-                print(f'[ДРУЗЬЯ] {from_user} отправил запрос -> {to_user}')
+                })
+                log.info('[ДРУЗЬЯ] %s отправил запрос -> %s', from_user, to_user,
+                         extra={'event': 'friend_request', 'from': from_user, 'to': to_user})
             except Exception as e:
-                print(f'[ОШИБКА ЗАПРОСА] {e}')
+                log.warning('[ОШИБКА ЗАПРОСА] %s', e, extra={'event': 'friend_request_error', 'to': to_user})
 
     def handle_friend_response(self, from_user, to_user, accepted):
         """Обработка ответа на запрос в друзья"""
+        # Ответ без действующего запроса от to_user игнорируется
+        if not self.db.remove_friend_request(to_user, from_user):
+            return
+        
         if accepted:
-            # Добавляем в БД
-            if self.db.add_friendship(from_user, to_user):
-                from_socket = self.get_socket_by_username(from_user)
-                to_socket = self.get_socket_by_username(to_user)
-                
-                if from_socket:
-                    try:
-                        msg = (json.dumps({
-                            'type': 'friend_added',
-                            'friend': to_user
-                        }) + '\n###END###\n').encode('utf-8')
-                        from_socket.send(msg)
-                    except:
-                        pass
-                
-                if to_socket:
-                    try:
-                        msg = (json.dumps({
-                            'type': 'friend_added',
-                            'friend': from_user
-                        }) + '\n###END###\n').encode('utf-8')
-                        to_socket.send(msg)
-                    except:
-                        pass
-                
-                print(f'[ДРУЗЬЯ] {from_user} и {to_user} теперь друзья')
+            self.add_friendship(from_user, to_user)
         else:
+            notice = {'type': 'system', 'message': f'{from_user} отклонил запрос в друзья'}
             to_socket = self.get_socket_by_username(to_user)
             if to_socket:
                 try:
-                    msg = (json.dumps({
-                        'type': 'system',
-                        'message': f'{from_user} отклонил запрос в друзья'
-                    }) + '\n###END###\n').encode('utf-8')
-                    to_socket.send(msg)
+                    self.send_json(to_socket, notice)
                 except:
                     pass
+            else:
+                self.db.queue_offline(to_user, notice)
 
+    def add_friendship(self, from_user, to_user):
+        """Записать дружбу и сообщить обоим"""
+        if not self.social.add_friendship(from_user, to_user):
+            return
+        from_socket = self.get_socket_by_username(from_user)
+        to_socket = self.get_socket_by_username(to_user)
+        
+        if from_socket:
+            try:
+                self.send_json(from_socket, {
+                    'type': 'friend_added',
+                    'friend': to_user,
+                    'online': to_user in self.online
+                })
+            except:
+                pass
+        
+        if to_socket:
+            try:
+                self.send_json(to_socket, {
+                    'type': 'friend_added',
+                    'friend': from_user,
+                    'online': from_user in self.online
+                })
+            except:
+                pass
+        
+        log.info('[ДРУЗЬЯ] %s и %s теперь друзья', from_user, to_user,
+                 extra={'event': 'friend_added', 'from': from_user, 'to': to_user})
+
+    def deliver_offline(self, client_socket, username):
+        """Отправить события, отложенные до входа username"""
+        for event in self.db.take_offline(username):
+            try:
+                self.send_json(client_socket, event)
+            except OSError:
+                # Соединение оборвалось: недоставленное вернётся в очередь
+                self.db.queue_offline(username, event)
+    
     def send_friends_list(self, client_socket, username):
-        """Отправить список друзей"""
-        friends = self.db.get_friends(username)
+        """Отправить список друзей и ожидающие ответа запросы в друзья"""
+        friends = sorted(self.social.friends(username))
+        requests = self.db.get_friend_requests(username, MAX_PENDING_FRIEND_REQUESTS)
         
         try:
-            msg = (json.dumps({
+            self.send_json(client_socket, {
                 'type': 'friends_list',
-                'friends': friends
-            }) + '\n###END###\n').encode('utf-8')
-            client_socket.send(msg)
+                'friends': friends,
+                'online': [friend for friend in friends if friend in self.online],
+                'requests': requests
+            })
         except Exception as e:
-            print(f'[ОШИБКА ОТПРАВКИ ДРУЗЕЙ] {e}')
+            log.warning('[ОШИБКА ОТПРАВКИ ДРУЗЕЙ] %s', e, extra={'event': 'friends_list_error', 'username': username})
+
+    def send_json(self, sock, message):
+        """Отправить один JSON-кадр с разделителем"""
+        data = json.dumps(message).encode('utf-8') + SEPARATOR
+        sock.sendall(data)
+        self.metrics.inc('chat_frames_out_total', type=message.get('type'))
+        self.metrics.inc('chat_bytes_out_total', len(data), kind='text')
 
     def broadcast(self, message, exclude=None):
         """Отправка с разделителем"""
-        data = (json.dumps(message) + '\n###END###\n').encode('utf-8')
-        for client in list(self.clients.keys()):
-            if client != exclude:
-                try:
-                    client.send(data)
-                except Exception as e:
-                    print(f'[ОШИБКА BROADCAST] {e}')
-
-    def broadcast_voice(self, audio_data, exclude=None):
-        """Отправка голосовых данных"""
-        for voice_client in list(self.voice_clients.keys()):
-            if voice_client != exclude:
-                try:
-                    voice_client.sendall(audio_data)
-                except Exception as e:
-                    print(f'[ОШИБКА VOICE BROADCAST] {e}')
+        data = json.dumps(message).encode('utf-8') + SEPARATOR
+        sent = 0
+        with self.metrics.timer('chat_broadcast_seconds'):
+            for client in list(self.clients.keys()):
+                if client != exclude:
+                    try:
+                        client.send(data)
+                        sent += 1
+                    except Exception as e:
+                        log.warning('[ОШИБКА BROADCAST] %s', e, extra={'event': 'broadcast_error'})
+        self.metrics.inc('chat_frames_out_total', sent, type=message.get('type'))
+        self.metrics.inc('chat_bytes_out_total', sent * len(data), kind='text')
+
+    def send_many(self, sockets, message):
+        """Один кадр нескольким клиентам; JSON кодируется один раз"""
+        data = json.dumps(message).encode('utf-8') + SEPARATOR
+        sent = 0
+        for sock in sockets:
+            try:
+                sock.sendall(data)
+                sent += 1
+            except OSError as e:
+                log.warning('[ОШИБКА BROADCAST] %s', e, extra={'event': 'broadcast_error'})
+        self.metrics.inc('chat_frames_out_total', sent, type=message.get('type'))
+        self.metrics.inc('chat_bytes_out_total', sent * len(data), kind='text')
+
+    def send_voice(self, voice_socket, data):
+        """Отправить кадр голосовому клиенту целиком"""
+        lock = self.voice_send_locks.get(voice_socket)
+        if lock is None:
+            raise ConnectionError('голосовой клиент отключён')
+        with lock:
+            voice_socket.sendall(data)
+
+    def broadcast_voice(self, audio_data, channel, exclude=None):
+        """Отправка голосовых данных слушателям канала"""
+        relayed = 0
+        dropped = 0
+        with self.metrics.timer('chat_voice_broadcast_seconds'):
+            for voice_client in list(self.voice_channels.get(channel, ())):
+                if voice_client != exclude:
+                    try:
+                        self.send_voice(voice_client, audio_data)
+                        relayed += 1
+                    except Exception as e:
+                        dropped += 1
+                        log.warning('[ОШИБКА VOICE BROADCAST] %s', e, extra={'event': 'voice_broadcast_error'})
+        if relayed:
+            self.metrics.inc('chat_voice_packets_relayed_total', relayed)
+            self.metrics.inc('chat_bytes_out_total', relayed * len(audio_data), kind='voice')
+        if dropped:
+            self.metrics.inc('chat_voice_packets_dropped_total', dropped)
 
     def send_user_list(self):
         """Отправка списка пользователей"""
@@ -586,6 +1518,8 @@ class ChatServer:
         })
 
 if __name__ == '__main__':
+    setup_logging(sample_rates=LOG_SAMPLE_RATES)
+    
     print('=' * 60)
     print('PyMessenger Pro Server v2.0')
     print('=' * 60)
@@ -594,14 +1528,17 @@ if __name__ == '__main__':
     port = input('Порт (Enter для 5555): ').strip()
     port = int(port) if port else 5555
     
-    server = ChatServer(host=host, port=port, voice_port=port+1)
+    # Хранилище: файл SQLite, postgresql://... или memory:
+    database = os.environ.get('PYMESSENGER_DATABASE_URL', 'chat_server.db')
+    server = ChatServer(host=host, port=port, voice_port=port+1, metrics_port=port+2, storage=open_storage(database))
     
     print('\n✅ Сервер готов к работе!')
     print(f'📡 Клиенты могут подключаться к: {host}:{port}')
-    print(f'💾 База данных: chat_server.db')
+    print(f'💾 База данных: {database.rsplit("@", 1)[-1]}')
+    print(f'📈 Метрики: http://127.0.0.1:{port+2}/metrics')
     print('⌨️  Нажмите Ctrl+C для остановки\n')
     
     try:
         server.start()
     except KeyboardInterrupt:
-        print('\n[СЕРВЕР] Остановлен')
+        log.info('[СЕРВЕР] Остановлен', extra={'event': 'server_stop'})
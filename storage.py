@@ -0,0 +1,874 @@
+import re
+import json
+import queue
+import sqlite3
+import time
+import hashlib
+import pathlib
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from chat_logging import get_logger
+
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:  # PostgresStorage доступен только с psycopg2
+    psycopg2 = None
+
+log = get_logger('storage')
+
+# Соединений только для чтения у SQLiteStorage
+SQLITE_READ_POOL_SIZE = 4
+
+# Слова для поиска в MemoryStorage
+WORD_PATTERN = re.compile(r'\w+')
+
+class ChatStorage:
+    """Интерфейс хранилища сервера: пользователи, сообщения, дружба, история,
+    поиск и очередь событий для пользователей не в сети.
+
+    Строки сообщений - отображения с ключами id, sender, message, timestamp
+    ('YYYY-MM-DD HH:MM:SS', UTC), is_private и recipient. Видимость везде
+    одна: публичные сообщения и ЛС, где пользователь отправитель или получатель.
+    """
+    # Есть ли полнотекстовый поиск
+    search_enabled = False
+    # Поддерживает ли хранилище компакцию RetentionJob (нужны reading/writing SQLite)
+    supports_retention = False
+    # Metrics сервера, если подключены: задержки ожидания соединений
+    metrics = None
+
+    def observe(self, name, value):
+        if self.metrics is not None:
+            self.metrics.observe(name, value)
+
+    def hash_password(self, password):
+        """Хэширование пароля SHA256"""
+        return hashlib.sha256(password.encode()).hexdigest()
+
+    def register_user(self, username, password):
+        """(успех, текст для клиента)"""
+        raise NotImplementedError
+
+    def verify_user(self, username, password):
+        raise NotImplementedError
+
+    def save_message(self, sender, message, is_private=False, recipient=None):
+        """Сохранить сообщение; возвращает его id"""
+        raise NotImplementedError
+
+    def get_messages(self, limit=100, username=None, after_id=None):
+        """Последние limit видимых сообщений (или новее after_id), старые первыми"""
+        raise NotImplementedError
+
+    def get_history(self, username, peer=None, before_id=None, limit=50):
+        """Страница общего чата или переписки с peer до before_id, старые первыми"""
+        raise NotImplementedError
+
+    def search_messages(self, username, query, peer=None, before_id=None, limit=20):
+        """Видимые сообщения со всеми словами query, новые первыми"""
+        raise NotImplementedError
+
+    def add_friendship(self, user1, user2):
+        """False, если дружба уже есть"""
+        raise NotImplementedError
+
+    def get_friends(self, username):
+        raise NotImplementedError
+
+    def add_friend_request(self, from_user, to_user, expires_at):
+        """Сохранить запрос до expires_at (unix-время). False, если to_user нет
+        или такой запрос уже ждёт ответа; истёкшие запросы к to_user удаляются"""
+        raise NotImplementedError
+
+    def get_friend_requests(self, username, limit=100):
+        """Отправители действующих запросов к username, от старых к новым"""
+        raise NotImplementedError
+
+    def remove_friend_request(self, from_user, to_user):
+        """Удалить запрос; True, если он был и не истёк"""
+        raise NotImplementedError
+
+    def queue_offline(self, username, event):
+        """Отложить событие (dict) до входа username"""
+        raise NotImplementedError
+
+    def take_offline(self, username):
+        """Забрать и удалить отложенные события username в порядке постановки"""
+        raise NotImplementedError
+
+    def close(self):
+        """Освободить соединения"""
+
+class ConnectionPool:
+    """Пул DB-API соединений: не больше size, свободные переиспользуются.
+
+    connect - фабрика соединения без аргументов. Соединение, блок которого
+    завершился исключением, закрывается, а не возвращается в пул: после
+    ошибки драйвера (обрыв, отменённый запрос) его состояние неизвестно.
+    """
+    def __init__(self, connect, size=10, timeout=10):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """Соединение на время блока: commit при успехе, rollback и закрытие при исключении"""
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f'нет свободного соединения в пуле за {self.timeout} с')
+        conn = None
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            yield conn
+            conn.commit()
+            self.idle.put(conn)
+        except BaseException:
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                conn.close()
+            raise
+        finally:
+            self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class SQLiteStorage(ChatStorage):
+    """Хранилище в файле SQLite в режиме WAL, FTS5 для поиска.
+
+    Все записи идут через одно соединение-писатель под блокировкой, чтение -
+    через пул соединений только для чтения. В WAL читатель видит снимок на
+    начало запроса и не ждёт писателя, а писатель не ждёт читателей.
+    """
+    supports_retention = True
+
+    def __init__(self, db_path='chat_server.db', read_pool_size=SQLITE_READ_POOL_SIZE):
+        self.db_path = db_path
+        self.init_database()
+        self.writer = self.get_connection(check_same_thread=False)
+        self.write_lock = threading.Lock()
+        self.read_pool = ConnectionPool(self.open_reader, read_pool_size)
+    
+    def get_connection(self, **options):
+        """Получить соединение с БД"""
+        conn = sqlite3.connect(self.db_path, **options)
+        conn.row_factory = sqlite3.Row
+        return conn
+    
+    def open_reader(self):
+        """Соединение пула чтения: mode=ro, запись через него невозможна"""
+        uri = pathlib.Path(self.db_path).absolute().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+    
+    @contextmanager
+    def reading(self):
+        """Соединение для чтения из пула"""
+        started = time.perf_counter()
+        with self.read_pool.connection() as conn:
+            self.observe('chat_db_read_wait_seconds', time.perf_counter() - started)
+            yield conn
+    
+    @contextmanager
+    def writing(self):
+        """Единственный писатель: commit при успехе, rollback при исключении"""
+        started = time.perf_counter()
+        with self.write_lock:
+            self.observe('chat_db_write_wait_seconds', time.perf_counter() - started)
+            try:
+                yield self.writer
+                self.writer.commit()
+            except BaseException:
+                self.writer.rollback()
+                raise
+    
+    def init_database(self):
+        """Инициализация базы данных"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        # WAL: чтение из снимка параллельно с записью; режим сохраняется в файле
+        cursor.execute('PRAGMA journal_mode = WAL')
+        
+        # Освобождённые компакцией страницы возвращаются в ОС через incremental_vacuum.
+        # Для новой базы режим включается до создания таблиц, существующей нужен разовый VACUUM
+        if not cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table'").fetchone():
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        elif cursor.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            log.info('[БД] incremental_vacuum выключен: включите PRAGMA auto_vacuum = INCREMENTAL и VACUUM',
+                     extra={'event': 'db_auto_vacuum_off', 'db_path': self.db_path})
+        
+        # Таблица пользователей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Таблица сообщений
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_private BOOLEAN DEFAULT 0,
+                recipient TEXT
+            )
+        ''')
+        
+        # Компакция выбирает строки по id внутри вида сообщений
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_kind_id ON messages(is_private, id)')
+        
+        # Таблица друзей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS friendships (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user1 TEXT NOT NULL,
+                user2 TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(user1, user2)
+            )
+        ''')
+        
+        # События для пользователей не в сети, доставляются при входе
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS offline_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                event TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_offline_events_username ON offline_events(username, id)')
+        
+        # Запросы в друзья до ответа или истечения; повторный запрос той же паре не создаётся
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS friend_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                from_user TEXT NOT NULL,
+                to_user TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at INTEGER NOT NULL,
+                UNIQUE(from_user, to_user)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_friend_requests_to_user ON friend_requests(to_user, id)')
+        
+        self.init_search_index(cursor)
+        
+        conn.commit()
+        conn.close()
+        log.info('[БД] База данных инициализирована', extra={'event': 'db_init', 'db_path': self.db_path})
+    
+    def init_search_index(self, cursor):
+        """Полнотекстовый индекс FTS5 по messages, синхронизируется триггерами"""
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone()
+        try:
+            # External content: текст хранится только в messages, индекс - в messages_fts
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    message, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            self.search_enabled = False
+            log.warning('[БД] FTS5 недоступен, поиск отключён: %s', e, extra={'event': 'db_fts_unavailable'})
+            return
+        self.search_enabled = True
+        
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+            END
+        ''')
+        if not exists:
+            # Индекс появился в уже заполненной базе - строим по существующим сообщениям
+            cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    
+    def register_user(self, username, password):
+        """Регистрация нового пользователя"""
+        try:
+            password_hash = self.hash_password(password)
+            with self.writing() as conn:
+                conn.execute(
+                    'INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                    (username, password_hash)
+                )
+            return True, 'Регистрация успешна'
+        except sqlite3.IntegrityError:
+            return False, 'Пользователь уже существует'
+        except Exception as e:
+            return False, f'Ошибка: {e}'
+    
+    def verify_user(self, username, password):
+        """Проверка логина и пароля"""
+        password_hash = self.hash_password(password)
+        with self.reading() as conn:
+            user = conn.execute(
+                'SELECT * FROM users WHERE username = ? AND password_hash = ?',
+                (username, password_hash)
+            ).fetchone()
+        
+        return user is not None
+    
+    def save_message(self, sender, message, is_private=False, recipient=None):
+        """Сохранение сообщения"""
+        with self.writing() as conn:
+            cursor = conn.execute(
+                'INSERT INTO messages (sender, message, is_private, recipient) VALUES (?, ?, ?, ?)',
+                (sender, message, is_private, recipient)
+            )
+            return cursor.lastrowid
+    
+    def get_messages(self, limit=100, username=None, after_id=None):
+        """Получить сообщения из БД; after_id - только новее этого id"""
+        with self.reading() as conn:
+            if username and after_id is not None:
+                # Дельта для клиента с локальным кэшем
+                cursor = conn.execute(
+                    '''SELECT id, sender, message, timestamp, is_private, recipient 
+                    FROM messages 
+                    WHERE id > ? AND (is_private = 0 OR recipient = ? OR sender = ?)
+                    ORDER BY id DESC LIMIT ?''',
+                    (after_id, username, username, limit)
+                )
+            elif username:
+                # Получаем только публичные сообщения и ЛС для конкретного пользователя
+                cursor = conn.execute(
+                    '''SELECT id, sender, message, timestamp, is_private, recipient 
+                    FROM messages 
+                    WHERE is_private = 0 OR recipient = ? OR sender = ?
+                    ORDER BY timestamp DESC, id DESC LIMIT ?''',
+                    (username, username, limit)
+                )
+            else:
+                # Получаем только публичные сообщения
+                cursor = conn.execute(
+                    'SELECT id, sender, message, timestamp FROM messages WHERE is_private = 0 ORDER BY timestamp DESC, id DESC LIMIT ?',
+                    (limit,)
+                )
+            messages = cursor.fetchall()
+        
+        # Переворачиваем чтобы старые были сверху
+        return list(reversed(messages))
+    
+    def get_history(self, username, peer=None, before_id=None, limit=50):
+        """Страница истории до before_id: общий чат или переписка username с peer"""
+        if peer:
+            query = '''SELECT id, sender, message, timestamp FROM messages
+                WHERE is_private = 1 AND ((sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?))'''
+            params = [username, peer, peer, username]
+        else:
+            query = 'SELECT id, sender, message, timestamp FROM messages WHERE is_private = 0'
+            params = []
+        if before_id is not None:
+            query += ' AND id < ?'
+            params.append(before_id)
+        query += ' ORDER BY id DESC LIMIT ?'
+        params.append(limit)
+        
+        with self.reading() as conn:
+            messages = conn.execute(query, params).fetchall()
+        
+        return list(reversed(messages))
+    
+    def search_messages(self, username, query, peer=None, before_id=None, limit=20):
+        """Поиск по видимым username сообщениям, новые первыми; страницы по before_id"""
+        # Каждое слово - отдельная фраза в кавычках: синтаксис FTS5 из запроса не исполняется
+        terms = ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+        if not terms:
+            return []
+        
+        sql = '''SELECT m.id, m.sender, m.message, m.timestamp, m.is_private, m.recipient
+            FROM messages_fts f JOIN messages m ON m.id = f.rowid
+            WHERE messages_fts MATCH ?'''
+        params = [terms]
+        if peer:
+            sql += ' AND m.is_private = 1 AND ((m.sender = ? AND m.recipient = ?) OR (m.sender = ? AND m.recipient = ?))'
+            params += [username, peer, peer, username]
+        else:
+            # Те же правила видимости, что в get_messages
+            sql += ' AND (m.is_private = 0 OR m.recipient = ? OR m.sender = ?)'
+            params += [username, username]
+        if before_id is not None:
+            sql += ' AND f.rowid < ?'
+            params.append(before_id)
+        # Обход индекса по убыванию rowid без сортировки всех совпадений
+        sql += ' ORDER BY f.rowid DESC LIMIT ?'
+        params.append(limit)
+        
+        with self.reading() as conn:
+            return conn.execute(sql, params).fetchall()
+    
+    def add_friendship(self, user1, user2):
+        """Добавить дружбу"""
+        try:
+            # Сортируем имена чтобы избежать дубликатов
+            users = sorted([user1, user2])
+            with self.writing() as conn:
+                conn.execute(
+                    'INSERT INTO friendships (user1, user2) VALUES (?, ?)',
+                    (users[0], users[1])
+                )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+    
+    def get_friends(self, username):
+        """Получить список друзей"""
+        with self.reading() as conn:
+            rows = conn.execute(
+                '''SELECT CASE 
+                    WHEN user1 = ? THEN user2 
+                    ELSE user1 
+                END as friend
+                FROM friendships 
+                WHERE user1 = ? OR user2 = ?''',
+                (username, username, username)
+            ).fetchall()
+        
+        return [row['friend'] for row in rows]
+    
+    def add_friend_request(self, from_user, to_user, expires_at):
+        """Сохранить запрос в друзья, если такого ещё нет"""
+        with self.writing() as conn:
+            if not conn.execute('SELECT 1 FROM users WHERE username = ?', (to_user,)).fetchone():
+                return False
+            conn.execute('DELETE FROM friend_requests WHERE to_user = ? AND expires_at <= ?', (to_user, time.time()))
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO friend_requests (from_user, to_user, expires_at) VALUES (?, ?, ?)',
+                (from_user, to_user, int(expires_at))
+            )
+            return cursor.rowcount == 1
+    
+    def get_friend_requests(self, username, limit=100):
+        """Ожидающие ответа запросы к username"""
+        with self.reading() as conn:
+            rows = conn.execute(
+                'SELECT from_user FROM friend_requests WHERE to_user = ? AND expires_at > ? ORDER BY id LIMIT ?',
+                (username, time.time(), limit)
+            ).fetchall()
+        return [row['from_user'] for row in rows]
+    
+    def remove_friend_request(self, from_user, to_user):
+        """Удалить запрос после ответа"""
+        with self.writing() as conn:
+            row = conn.execute(
+                'SELECT expires_at FROM friend_requests WHERE from_user = ? AND to_user = ?', (from_user, to_user)
+            ).fetchone()
+            if row is None:
+                return False
+            conn.execute('DELETE FROM friend_requests WHERE from_user = ? AND to_user = ?', (from_user, to_user))
+        return row['expires_at'] > time.time()
+    
+    def queue_offline(self, username, event):
+        """Отложить событие до входа username"""
+        with self.writing() as conn:
+            conn.execute('INSERT INTO offline_events (username, event) VALUES (?, ?)',
+                         (username, json.dumps(event, ensure_ascii=False)))
+    
+    def take_offline(self, username):
+        """Забрать и удалить отложенные события username в порядке постановки"""
+        # Выборка и удаление под блокировкой писателя - событие не достанется двоим
+        with self.writing() as conn:
+            rows = conn.execute(
+                'SELECT id, event FROM offline_events WHERE username = ? ORDER BY id', (username,)
+            ).fetchall()
+            if rows:
+                conn.execute('DELETE FROM offline_events WHERE username = ? AND id <= ?', (username, rows[-1]['id']))
+        return [json.loads(row['event']) for row in rows]
+    
+    def close(self):
+        self.read_pool.close()
+        self.writer.close()
+
+class MemoryStorage(ChatStorage):
+    """Хранилище в памяти процесса: для отладки и бенчмарков, без сохранения.
+
+    Поиск - по словам без учёта регистра (как unicode61 в FTS5, но без
+    снятия диакритики).
+    """
+    search_enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}  # {username: password_hash}
+        self.messages = []  # строки по возрастанию id
+        self.message_ids = []  # id для bisect
+        self.friendships = set()  # {(user1, user2)}, имена отсортированы
+        self.offline = {}  # {username: [событие]}
+        self.friend_requests = {}  # {(from_user, to_user): expires_at}, по порядку добавления
+
+    def register_user(self, username, password):
+        with self.lock:
+            if username in self.users:
+                return False, 'Пользователь уже существует'
+            self.users[username] = self.hash_password(password)
+        return True, 'Регистрация успешна'
+
+    def verify_user(self, username, password):
+        return self.users.get(username) == self.hash_password(password)
+
+    def save_message(self, sender, message, is_private=False, recipient=None):
+        with self.lock:
+            message_id = self.message_ids[-1] + 1 if self.message_ids else 1
+            self.messages.append({
+                'id': message_id,
+                'sender': sender,
+                'message': message,
+                'timestamp': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+                'is_private': int(bool(is_private)),
+                'recipient': recipient,
+                'words': frozenset(word.casefold() for word in WORD_PATTERN.findall(message)),
+            })
+            self.message_ids.append(message_id)
+        return message_id
+
+    def scan(self, match, before_id=None, after_id=None, limit=50):
+        """Совпадения match от новых к старым в диапазоне (after_id, before_id)"""
+        end = len(self.message_ids) if before_id is None else bisect_left(self.message_ids, before_id)
+        found = []
+        for i in range(end - 1, -1, -1):
+            row = self.messages[i]
+            if after_id is not None and row['id'] <= after_id or len(found) >= limit:
+                break
+            if match(row):
+                found.append(self.public_row(row))
+        return found
+
+    @staticmethod
+    def public_row(row):
+        return {key: value for key, value in row.items() if key != 'words'}
+
+    @staticmethod
+    def visible(username, peer=None):
+        """Предикат видимости как в SQL-хранилищах"""
+        if peer:
+            pairs = ((username, peer), (peer, username))
+            return lambda row: row['is_private'] and (row['sender'], row['recipient']) in pairs
+        if username:
+            return lambda row: not row['is_private'] or row['recipient'] == username or row['sender'] == username
+        return lambda row: not row['is_private']
+
+    def get_messages(self, limit=100, username=None, after_id=None):
+        return list(reversed(self.scan(self.visible(username), after_id=after_id, limit=limit)))
+
+    def get_history(self, username, peer=None, before_id=None, limit=50):
+        match = self.visible(username, peer) if peer else (lambda row: not row['is_private'])
+        return list(reversed(self.scan(match, before_id=before_id, limit=limit)))
+
+    def search_messages(self, username, query, peer=None, before_id=None, limit=20):
+        words = {word.casefold() for word in WORD_PATTERN.findall(query)}
+        if not words:
+            return []
+        visible = self.visible(username, peer)
+        return self.scan(lambda row: words <= row['words'] and visible(row), before_id=before_id, limit=limit)
+
+    def add_friendship(self, user1, user2):
+        pair = tuple(sorted([user1, user2]))
+        with self.lock:
+            if pair in self.friendships:
+                return False
+            self.friendships.add(pair)
+        return True
+
+    def get_friends(self, username):
+        return [user2 if user1 == username else user1
+                for user1, user2 in self.friendships if username in (user1, user2)]
+
+    def add_friend_request(self, from_user, to_user, expires_at):
+        now = time.time()
+        with self.lock:
+            if to_user not in self.users:
+                return False
+            for key in [key for key, expires in self.friend_requests.items() if key[1] == to_user and expires <= now]:
+                del self.friend_requests[key]
+            if (from_user, to_user) in self.friend_requests:
+                return False
+            self.friend_requests[(from_user, to_user)] = expires_at
+        return True
+
+    def get_friend_requests(self, username, limit=100):
+        now = time.time()
+        return [from_user for (from_user, to_user), expires in list(self.friend_requests.items())
+                if to_user == username and expires > now][:limit]
+
+    def remove_friend_request(self, from_user, to_user):
+        with self.lock:
+            expires = self.friend_requests.pop((from_user, to_user), None)
+        return expires is not None and expires > time.time()
+
+    def queue_offline(self, username, event):
+        with self.lock:
+            self.offline.setdefault(username, []).append(event)
+
+    def take_offline(self, username):
+        with self.lock:
+            return self.offline.pop(username, [])
+
+class PostgresStorage(ChatStorage):
+    """Хранилище в PostgreSQL через psycopg2 с пулом соединений.
+
+    Позволяет вынести базу на отдельный сервер и запускать несколько
+    процессов чата. Поиск - tsvector с GIN-индексом, запрос через
+    plainto_tsquery, поэтому синтаксис tsquery из ввода не исполняется.
+
+    connect(dsn) открывает соединение со строками-словарями (по умолчанию
+    psycopg2 с RealDictCursor) и используется и для dsn, и для read_dsn.
+    """
+    search_enabled = True
+
+    # Время в том же виде, что CURRENT_TIMESTAMP в SQLite
+    MESSAGE_COLUMNS = "id, sender, message, to_char(timestamp, 'YYYY-MM-DD HH24:MI:SS') AS timestamp, " \
+                      "is_private::int AS is_private, recipient"
+
+    def __init__(self, dsn, pool_size=10, connect=None, read_dsn=None):
+        if connect is None:
+            if psycopg2 is None:
+                raise RuntimeError('для PostgresStorage нужен пакет psycopg2')
+            connect = lambda dsn: psycopg2.connect(dsn, cursor_factory=psycopg2.extras.RealDictCursor)
+        self.pool = ConnectionPool(lambda: connect(dsn), pool_size)
+        # Чтение истории и друзей - с реплики, если задана; запись всегда в основную базу
+        self.read_pool = self.pool
+        if read_dsn:
+            self.read_pool = ConnectionPool(lambda: connect(read_dsn), pool_size)
+        self.init_database()
+
+    def execute(self, sql, params=(), fetch=None, read=False):
+        """Запрос в соединении из пула; fetch: None, 'one' или 'all'"""
+        pool = self.read_pool if read else self.pool
+        started = time.perf_counter()
+        with pool.connection() as conn:
+            self.observe('chat_db_read_wait_seconds' if read else 'chat_db_write_wait_seconds',
+                         time.perf_counter() - started)
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                if fetch == 'one':
+                    return cursor.fetchone()
+                if fetch == 'all':
+                    return cursor.fetchall()
+                return cursor.rowcount
+
+    def init_database(self):
+        """Схема и индексы; IF NOT EXISTS - можно запускать на существующей базе"""
+        self.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id SERIAL PRIMARY KEY,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id BIGSERIAL PRIMARY KEY,
+                sender TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+                is_private BOOLEAN NOT NULL DEFAULT FALSE,
+                recipient TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender, id);
+            CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages (recipient, id);
+            CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (to_tsvector('simple', message));
+            CREATE TABLE IF NOT EXISTS friendships (
+                id SERIAL PRIMARY KEY,
+                user1 TEXT NOT NULL,
+                user2 TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+                UNIQUE (user1, user2)
+            );
+            CREATE TABLE IF NOT EXISTS offline_events (
+                id BIGSERIAL PRIMARY KEY,
+                username TEXT NOT NULL,
+                event TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+            );
+            CREATE INDEX IF NOT EXISTS idx_offline_events_username ON offline_events (username, id);
+            CREATE TABLE IF NOT EXISTS friend_requests (
+                id BIGSERIAL PRIMARY KEY,
+                from_user TEXT NOT NULL,
+                to_user TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+                expires_at BIGINT NOT NULL,
+                UNIQUE (from_user, to_user)
+            );
+            CREATE INDEX IF NOT EXISTS idx_friend_requests_to_user ON friend_requests (to_user, id);
+        ''')
+        log.info('[БД] PostgreSQL инициализирован', extra={'event': 'db_init', 'backend': 'postgres'})
+
+    def register_user(self, username, password):
+        try:
+            row = self.execute(
+                'INSERT INTO users (username, password_hash) VALUES (%s, %s) ON CONFLICT (username) DO NOTHING RETURNING id',
+                (username, self.hash_password(password)), fetch='one'
+            )
+        except Exception as e:
+            return False, f'Ошибка: {e}'
+        if row is None:
+            return False, 'Пользователь уже существует'
+        return True, 'Регистрация успешна'
+
+    def verify_user(self, username, password):
+        return self.execute(
+            'SELECT 1 FROM users WHERE username = %s AND password_hash = %s',
+            (username, self.hash_password(password)), fetch='one', read=True
+        ) is not None
+
+    def save_message(self, sender, message, is_private=False, recipient=None):
+        return self.execute(
+            'INSERT INTO messages (sender, message, is_private, recipient) VALUES (%s, %s, %s, %s) RETURNING id',
+            (sender, message, bool(is_private), recipient), fetch='one'
+        )['id']
+
+    def get_messages(self, limit=100, username=None, after_id=None):
+        columns = self.MESSAGE_COLUMNS
+        if username and after_id is not None:
+            rows = self.execute(
+                f'''SELECT {columns} FROM messages
+                WHERE id > %s AND (NOT is_private OR recipient = %s OR sender = %s)
+                ORDER BY id DESC LIMIT %s''',
+                (after_id, username, username, limit), fetch='all', read=True
+            )
+        elif username:
+            rows = self.execute(
+                f'''SELECT {columns} FROM messages
+                WHERE NOT is_private OR recipient = %s OR sender = %s
+                ORDER BY timestamp DESC, id DESC LIMIT %s''',
+                (username, username, limit), fetch='all', read=True
+            )
+        else:
+            rows = self.execute(
+                f'SELECT {columns} FROM messages WHERE NOT is_private ORDER BY timestamp DESC, id DESC LIMIT %s',
+                (limit,), fetch='all', read=True
+            )
+        return list(reversed(rows))
+
+    def get_history(self, username, peer=None, before_id=None, limit=50):
+        if peer:
+            sql = f'''SELECT {self.MESSAGE_COLUMNS} FROM messages
+                WHERE is_private AND ((sender = %s AND recipient = %s) OR (sender = %s AND recipient = %s))'''
+            params = [username, peer, peer, username]
+        else:
+            sql = f'SELECT {self.MESSAGE_COLUMNS} FROM messages WHERE NOT is_private'
+            params = []
+        if before_id is not None:
+            sql += ' AND id < %s'
+            params.append(before_id)
+        sql += ' ORDER BY id DESC LIMIT %s'
+        params.append(limit)
+        return list(reversed(self.execute(sql, params, fetch='all', read=True)))
+
+    def search_messages(self, username, query, peer=None, before_id=None, limit=20):
+        if not query.split():
+            return []
+        sql = f'''SELECT {self.MESSAGE_COLUMNS} FROM messages
+            WHERE to_tsvector('simple', message) @@ plainto_tsquery('simple', %s)'''
+        params = [query]
+        if peer:
+            sql += ' AND is_private AND ((sender = %s AND recipient = %s) OR (sender = %s AND recipient = %s))'
+            params += [username, peer, peer, username]
+        else:
+            sql += ' AND (NOT is_private OR recipient = %s OR sender = %s)'
+            params += [username, username]
+        if before_id is not None:
+            sql += ' AND id < %s'
+            params.append(before_id)
+        sql += ' ORDER BY id DESC LIMIT %s'
+        params.append(limit)
+        return self.execute(sql, params, fetch='all', read=True)
+
+    def add_friendship(self, user1, user2):
+        users = sorted([user1, user2])
+        return self.execute(
+            'INSERT INTO friendships (user1, user2) VALUES (%s, %s) ON CONFLICT DO NOTHING', users
+        ) == 1
+
+    def get_friends(self, username):
+        rows = self.execute(
+            '''SELECT CASE WHEN user1 = %s THEN user2 ELSE user1 END AS friend
+            FROM friendships WHERE user1 = %s OR user2 = %s''',
+            (username, username, username), fetch='all', read=True
+        )
+        return [row['friend'] for row in rows]
+
+    def add_friend_request(self, from_user, to_user, expires_at):
+        # Одна транзакция: сначала истёкшие запросы к to_user, затем вставка
+        return self.execute(
+            '''DELETE FROM friend_requests WHERE to_user = %s AND expires_at <= %s;
+            INSERT INTO friend_requests (from_user, to_user, expires_at)
+            SELECT %s, %s, %s WHERE EXISTS (SELECT 1 FROM users WHERE username = %s)
+            ON CONFLICT DO NOTHING''',
+            (to_user, int(time.time()), from_user, to_user, int(expires_at), to_user)
+        ) == 1
+
+    def get_friend_requests(self, username, limit=100):
+        # С основной базы: на реплике только что принятый запрос ещё может висеть
+        rows = self.execute(
+            'SELECT from_user FROM friend_requests WHERE to_user = %s AND expires_at > %s ORDER BY id LIMIT %s',
+            (username, int(time.time()), limit), fetch='all'
+        )
+        return [row['from_user'] for row in rows]
+
+    def remove_friend_request(self, from_user, to_user):
+        row = self.execute(
+            'DELETE FROM friend_requests WHERE from_user = %s AND to_user = %s RETURNING expires_at',
+            (from_user, to_user), fetch='one'
+        )
+        return row is not None and row['expires_at'] > time.time()
+
+    def queue_offline(self, username, event):
+        self.execute('INSERT INTO offline_events (username, event) VALUES (%s, %s)',
+                     (username, json.dumps(event, ensure_ascii=False)))
+
+    def take_offline(self, username):
+        rows = self.execute('DELETE FROM offline_events WHERE username = %s RETURNING id, event',
+                            (username,), fetch='all')
+        return [json.loads(row['event']) for row in sorted(rows, key=lambda row: row['id'])]
+
+    def close(self):
+        self.pool.close()
+        if self.read_pool is not self.pool:
+            self.read_pool.close()
+
+def open_storage(url):
+    """Хранилище по адресу: postgresql://... , memory: или путь к файлу SQLite"""
+    if url.startswith(('postgresql://', 'postgres://')):
+        return PostgresStorage(url)
+    if url == 'memory:':
+        return MemoryStorage()
+    return SQLiteStorage(url)
+
+# Прежнее имя SQLite-хранилища
+ChatDatabase = SQLiteStorage
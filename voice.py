@@ -0,0 +1,425 @@
+import time
+import queue
+import socket
+import random
+import threading
+import numpy as np
+import sounddevice as sd
+from chat_logging import get_logger
+from audio import AudioRingBuffer, JitterBuffer, StreamingDenoiser, VoiceActivityDetector
+from protocol import (VOICE_PING, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, RECONNECT_MIN_DELAY,
+                      RECONNECT_MAX_DELAY, DEFAULT_VOICE_CHANNEL, MAX_VOICE_FRAME, FrameReader,
+                      enable_keepalive, split_voice_frame, silence_frame, parse_silence_frame,
+                      pack_handshake, recv_handshake)
+
+log = get_logger('voice')
+
+class VoiceChat:
+    """Голосовой чат с обработкой аудио"""
+    def __init__(self, host, port, username, token, settings, speaker_volumes=None, channel=DEFAULT_VOICE_CHANNEL):
+        self.host = host
+        self.port = port
+        self.username = username
+        # Голосовой токен, выданный текстовой сессией
+        self.token = token
+        self.channel = channel
+        self.voice_socket = None
+        self.is_active = False
+        self.settings = settings
+        
+        # Heartbeat и переподключение
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+        self.heartbeat_timeout = HEARTBEAT_TIMEOUT
+        self.last_received = 0.0
+        self.last_ping = 0.0
+        self.connection_lost = False
+        
+        # Параметры аудио
+        self.sample_rate = 16000
+        self.channels = 1
+        self.blocksize = 512
+        
+        # Захват: callback только копирует в кольцевой буфер,
+        # обработка идёт в dsp_worker окнами по dsp_hop сэмплов
+        self.dsp_hop = self.blocksize * 2
+        self.capture_buffer = AudioRingBuffer(16384)
+        self.dsp_frame = np.zeros(self.dsp_hop, dtype=np.float32)
+        self.denoiser = StreamingDenoiser()
+        
+        # VAD: в паузах вместо аудио уходит один маркер тишины (DTX)
+        self.vad = VoiceActivityDetector(self.dsp_hop)
+        self.transmitting = False
+        
+        # Счётчики для диагностики захвата
+        self.input_overflows = 0
+        self.dsp_frames = 0
+        self.frames_sent = 0
+        self.frames_suppressed = 0
+        self.stage_seconds = {'gain': 0.0, 'noise_reduction': 0.0, 'gate': 0.0}
+        
+        # Воспроизведение: у каждого говорящего свой буфер джиттера,
+        # output_callback смешивает их в заранее выделенный буфер
+        self.max_frames = 4096
+        self.speakers = {}  # {имя: JitterBuffer}, меняет только receive_audio
+        self.speaker_streams = ()  # снимок для output_callback, заменяется целиком
+        self.speaker_volumes = speaker_volumes if speaker_volumes is not None else {}
+        self.speaker_timeout = 30
+        self.active_speaker_window = 0.3
+        self.mix_buffer = np.zeros(self.max_frames, dtype=np.float32)
+        self.output_underflows = 0
+        self.finished_underruns = 0
+        self.finished_trims = 0
+        self.finished_overruns = 0
+        
+        # Очереди
+        self.audio_send_queue = queue.Queue(maxsize=10)
+        
+    def start(self):
+        """Запуск голосового чата"""
+        try:
+            self.connect_socket()
+            
+            self.is_active = True
+            
+            threading.Thread(target=self.send_audio_worker, daemon=True).start()
+            threading.Thread(target=self.dsp_worker, daemon=True).start()
+            
+            self.input_stream = sd.InputStream(
+                samplerate=self.sample_rate,
+                channels=self.channels,
+                dtype='float32',
+                callback=self.input_callback,
+                blocksize=self.blocksize
+            )
+            
+            self.output_stream = sd.OutputStream(
+                samplerate=self.sample_rate,
+                channels=self.channels,
+                dtype='float32',
+                callback=self.output_callback,
+                blocksize=self.blocksize
+            )
+            
+            self.input_stream.start()
+            self.output_stream.start()
+            
+            log.info('[ГОЛОС] Подключено', extra={'event': 'voice_start', 'host': self.host, 'port': self.port})
+            return True
+        except Exception as e:
+            log.error('[ОШИБКА ГОЛОСА] %s', e, extra={'event': 'voice_start_error'})
+            return False
+    
+    def connect_socket(self):
+        """Подключение голосового сокета и запуск приёма"""
+        sock = socket.create_connection((self.host, self.port), timeout=10)
+        enable_keepalive(sock)
+        
+        # Рукопожатие: кадр с токеном, ждём подтверждения до начала аудио
+        try:
+            sock.sendall(pack_handshake({
+                'type': 'voice_join',
+                'token': self.token,
+                'channel': self.channel
+            }))
+            reply = recv_handshake(sock)
+        except (OSError, ValueError):
+            sock.close()
+            raise
+        if reply is None or reply.get('type') != 'voice_accept':
+            sock.close()
+            reason = reply.get('message', '') if reply else 'соединение закрыто'
+            raise PermissionError(f'сервер отклонил голосовое подключение: {reason}')
+        sock.settimeout(None)
+        
+        # Буферы говорящих прошлого соединения (или канала) больше не нужны
+        self.speakers = {}
+        self.speaker_streams = ()
+        self.voice_socket = sock
+        self.connection_lost = False
+        self.last_received = time.monotonic()
+        threading.Thread(target=self.receive_audio, args=(sock,), daemon=True).start()
+    
+    def reconnect(self):
+        """Переподключение с экспоненциальной задержкой, аудиопотоки продолжают работать"""
+        if self.voice_socket:
+            try:
+                self.voice_socket.close()
+            except:
+                pass
+        
+        delay = RECONNECT_MIN_DELAY
+        while self.is_active:
+            try:
+                self.connect_socket()
+                log.info('[ГОЛОС] Переподключено', extra={'event': 'voice_reconnect'})
+                return
+            except PermissionError as e:
+                # Токен отозван (текстовая сессия закрыта) - повтор бесполезен
+                log.error('[ГОЛОС] %s', e, extra={'event': 'voice_rejected'})
+                self.stop()
+                return
+            except (OSError, ValueError) as e:
+                log.warning('[ГОЛОС] Переподключение через %.1f с: %s', delay, e,
+                            extra={'event': 'voice_reconnect_error', 'delay': delay})
+                time.sleep(delay * random.uniform(0.8, 1.2))
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    
+    def switch_channel(self, channel):
+        """Перейти в другой канал: send_audio_worker переподключится с новым voice_join"""
+        if channel != self.channel:
+            self.channel = channel
+            self.connection_lost = True
+    
+    def apply_noise_reduction(self, audio):
+        """Применить шумоподавление"""
+        if not self.settings['noise_reduction']:
+            return audio
+        
+        return self.denoiser.process(audio, self.settings['noise_reduction_strength'])
+    
+    def queue_audio(self, audio):
+        """Поставить окно в очередь отправки блоками исходного размера"""
+        for start in range(0, len(audio), self.blocksize):
+            try:
+                self.audio_send_queue.put_nowait(audio[start:start + self.blocksize].tobytes())
+            except queue.Full:
+                return
+        self.frames_sent += 1
+    
+    def apply_voice_activity(self, audio):
+        """VAD и DTX: речь с pre-roll и hangover, в паузах - маркер тишины"""
+        if not self.settings['voice_gate_enabled']:
+            self.queue_audio(audio)
+            return
+        
+        if self.vad.update(audio, self.settings['voice_gate_threshold']):
+            if not self.transmitting:
+                self.transmitting = True
+                for frame in self.vad.take_preroll():
+                    self.queue_audio(frame)
+            self.queue_audio(audio)
+            return
+        
+        if self.transmitting:
+            self.transmitting = False
+            try:
+                self.audio_send_queue.put_nowait(silence_frame(self.vad.noise_floor))
+            except queue.Full:
+                pass
+        self.vad.remember(audio)
+        self.frames_suppressed += 1
+    
+    def input_callback(self, indata, frames, time, status):
+        """Callback для захвата аудио: только копирование в кольцевой буфер"""
+        if status.input_overflow:
+            self.input_overflows += 1
+        self.capture_buffer.write(indata[:, 0])
+    
+    def dsp_worker(self):
+        """Обработка захваченного аудио вне потока PortAudio"""
+        frame = self.dsp_frame
+        idle_sleep = self.blocksize / self.sample_rate / 4
+        last_stats = time.monotonic()
+        
+        while self.is_active:
+            if not self.capture_buffer.read(frame):
+                time.sleep(idle_sleep)
+                continue
+            
+            # Усиление на месте
+            t0 = time.perf_counter()
+            np.multiply(frame, self.settings['input_gain'], out=frame)
+            np.clip(frame, -1.0, 1.0, out=frame)
+            
+            # Шумоподавление
+            t1 = time.perf_counter()
+            audio = self.apply_noise_reduction(frame)
+            
+            # VAD и отправка
+            t2 = time.perf_counter()
+            self.apply_voice_activity(audio)
+            t3 = time.perf_counter()
+            
+            self.stage_seconds['gain'] += t1 - t0
+            self.stage_seconds['noise_reduction'] += t2 - t1
+            self.stage_seconds['gate'] += t3 - t2
+            self.dsp_frames += 1
+            
+            if t3 - last_stats >= 10:
+                last_stats = t3
+                log.debug('[АУДИО] статистика', extra={'event': 'audio_stats', **self.get_audio_stats()})
+    
+    def get_audio_stats(self):
+        """Переполнения, опустошения и среднее время этапов обработки (мс на окно)"""
+        frames = max(self.dsp_frames, 1)
+        stats = {
+            'input_overflows': self.input_overflows,
+            'capture_overruns': self.capture_buffer.overruns,
+            'dsp_frames': self.dsp_frames,
+            'frames_sent': self.frames_sent,
+            'frames_suppressed': self.frames_suppressed,
+            'output_underflows': self.output_underflows,
+            'speakers': len(self.speaker_streams),
+            'playback_underruns': self.finished_underruns + sum(s.underruns for s in self.speaker_streams),
+            'playback_overruns': self.finished_overruns + sum(s.ring.overruns for s in self.speaker_streams),
+            'playback_trims': self.finished_trims + sum(s.trims for s in self.speaker_streams),
+        }
+        for stage, seconds in self.stage_seconds.items():
+            stats[f'{stage}_ms'] = round(seconds * 1000 / frames, 3)
+        return stats
+    
+    def output_callback(self, outdata, frames, time, status):
+        """Callback для воспроизведения: микширование говорящих без аллокаций"""
+        if status.output_underflow:
+            self.output_underflows += 1
+        
+        frames = min(frames, self.max_frames)
+        mix = self.mix_buffer[:frames]
+        mix.fill(0)
+        target = int(self.settings.get('playback_latency_ms', 80) * self.sample_rate / 1000)
+        
+        for stream in self.speaker_streams:
+            if stream.read(frames, target):
+                # Громкость говорящего и сложение на месте
+                frame = stream.frame[:frames]
+                np.multiply(frame, stream.volume, out=frame)
+                np.add(mix, frame, out=mix)
+        
+        # Общая громкость на месте
+        np.multiply(mix, self.settings['output_volume'], out=outdata[:frames, 0])
+        outdata[frames:] = 0
+        np.clip(outdata, -1.0, 1.0, out=outdata)
+    
+    def get_speaker_stream(self, speaker):
+        """Буфер говорящего; новый создаётся в потоке приёма"""
+        stream = self.speakers.get(speaker)
+        if stream is None:
+            stream = JitterBuffer(16384, self.max_frames, self.speaker_volumes.get(speaker, 1.0))
+            self.speakers[speaker] = stream
+            self.speaker_streams = tuple(self.speakers.values())
+        return stream
+    
+    def prune_speakers(self):
+        """Удалить буферы давно молчащих говорящих"""
+        deadline = time.monotonic() - self.speaker_timeout
+        stale = [name for name, stream in self.speakers.items() if stream.last_packet < deadline]
+        if not stale:
+            return
+        for name in stale:
+            stream = self.speakers.pop(name)
+            self.finished_underruns += stream.underruns
+            self.finished_trims += stream.trims
+            self.finished_overruns += stream.ring.overruns
+        self.speaker_streams = tuple(self.speakers.values())
+    
+    def set_speaker_volume(self, speaker, volume):
+        """Громкость отдельного говорящего (1.0 - без изменений)"""
+        self.speaker_volumes[speaker] = volume
+        stream = self.speakers.get(speaker)
+        if stream is not None:
+            stream.volume = volume
+    
+    def get_active_speakers(self):
+        """Кто говорит прямо сейчас"""
+        since = time.monotonic() - self.active_speaker_window
+        return sorted(name for name, stream in list(self.speakers.items())
+                      if stream.last_packet >= since)
+    
+    def send_audio_worker(self):
+        """Отправка аудио, heartbeat и переподключение"""
+        while self.is_active:
+            now = time.monotonic()
+            if self.connection_lost or now - self.last_received > self.heartbeat_timeout:
+                log.warning('[ГОЛОС] Соединение потеряно', extra={'event': 'voice_connection_lost'})
+                self.reconnect()
+                continue
+            
+            try:
+                if now - self.last_ping >= self.heartbeat_interval:
+                    self.last_ping = now
+                    self.voice_socket.sendall(VOICE_PING)
+                
+                payload = self.audio_send_queue.get(timeout=0.1)
+                length = len(payload).to_bytes(4, 'big')
+                self.voice_socket.sendall(length + payload)
+            except queue.Empty:
+                continue
+            except Exception as e:
+                if self.is_active:
+                    log.warning('[ОШИБКА ОТПРАВКИ] %s', e, extra={'event': 'voice_send_error'})
+                    self.connection_lost = True
+    
+    def receive_audio(self, sock):
+        """Получение аудио"""
+        last_prune = time.monotonic()
+        # Сервер добавляет к кадру имя говорящего (до 256 байт)
+        reader = FrameReader(sock, MAX_VOICE_FRAME + 256)
+        while self.is_active and sock is self.voice_socket:
+            try:
+                length = reader.read()
+                if length is None:
+                    break
+                
+                self.last_received = time.monotonic()
+                if self.last_received - last_prune >= self.speaker_timeout:
+                    last_prune = self.last_received
+                    self.prune_speakers()
+                
+                if length == 0:
+                    # Pong
+                    continue
+                
+                # Пакет любой длины копируется из буфера чтения в буфер своего говорящего
+                speaker, pcm = split_voice_frame(reader.body())
+                level = parse_silence_frame(pcm)
+                if level is not None:
+                    self.get_speaker_stream(speaker).mark_silence(level)
+                    continue
+                samples = np.frombuffer(pcm, dtype=np.float32, count=len(pcm) // 4)
+                self.get_speaker_stream(speaker).write(samples)
+                
+            except Exception as e:
+                if self.is_active:
+                    log.warning('[ОШИБКА ПОЛУЧЕНИЯ] %s', e, extra={'event': 'voice_receive_error'})
+                break
+        
+        # Переподключением занимается send_audio_worker
+        if sock is self.voice_socket:
+            self.connection_lost = True
+    
+    def update_settings(self, settings):
+        """Обновить настройки на лету"""
+        self.settings = settings
+    
+    def stop(self):
+        """Остановка"""
+        self.is_active = False
+        
+        if hasattr(self, 'input_stream') and self.input_stream:
+            try:
+                self.input_stream.stop()
+                self.input_stream.close()
+            except:
+                pass
+            
+        if hasattr(self, 'output_stream') and self.output_stream:
+            try:
+                self.output_stream.stop()
+                self.output_stream.close()
+            except:
+                pass
+            
+        if self.voice_socket:
+            try:
+                self.voice_socket.shutdown(socket.SHUT_RDWR)
+                self.voice_socket.close()
+            except:
+                pass
+                
+        while not self.audio_send_queue.empty():
+            try:
+                self.audio_send_queue.get_nowait()
+            except:
+                pass
+                
+        log.info('[ГОЛОС] Отключено', extra={'event': 'voice_stop', **self.get_audio_stats()})